@@ -0,0 +1,183 @@
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import shutil
+import threading
+import time
+import uuid
+import re
+import numpy as np
+
+# Only short messages are cached - small talk like "hi", "how are you" or "thanks". The
+# reply to anything longer depends too much on the conversation around it.
+MAX_CACHED_WORDS = 8
+
+# How alike (cosine similarity of the embeddings) two messages have to be to share a reply
+SIMILARITY_THRESHOLD = 0.92
+
+def normalise(text: str) -> str:
+    # Lowercase with punctuation and extra spaces gone, so "Hi!!" and "hi" are the same message
+    return " ".join(re.sub(r"[^\w\s']", " ", text.lower()).split())
+
+def context_hash(context: str | None) -> str:
+    # Short fingerprint of the memory context a reply was written with
+    return hashlib.sha1((context or "").encode("utf-8")).hexdigest()[:16]
+
+class ResponseCache:
+    # Recent replies to short messages, with their speech audio, so repeated small talk
+    # skips both the language model and TTS. A message matches an entry from the same
+    # namespace (whose memories and conversation the reply was written for - by default
+    # the session) with the same memory context when its normalised text is the same, or
+    # failing that when its embedding is at least `threshold` similar. Least recently used
+    # entries go past `max_entries`, and any entry older than `ttl_seconds`.
+    def __init__(self, embed=None, threshold=SIMILARITY_THRESHOLD, max_entries=512, ttl_seconds=3600,
+                 max_words=MAX_CACHED_WORDS, audio_folder="cache/replies"):
+        self.embed = embed  # Anything with embed_query (e.g. the memories' model) - None for exact matches only
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_words = max_words
+        self.audio_folder = Path(audio_folder)
+        self.entries = OrderedDict()  # key -> entry, most recently used last
+        self.opted_out = set()  # Sessions that always get a freshly generated reply
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "exact_hits": 0, "semantic_hits": 0, "misses": 0,
+                      "stores": 0, "evictions": 0, "expired": 0}
+    
+    def set_enabled(self, session_id, enabled: bool):
+        # Per-session opt-out (and back in)
+        with self.lock:
+            if enabled:
+                self.opted_out.discard(session_id)
+            else:
+                self.opted_out.add(session_id)
+    
+    def enabled(self, session_id) -> bool:
+        with self.lock:
+            return session_id not in self.opted_out
+    
+    def _cacheable(self, session_id, text) -> bool:
+        return bool(text) and len(text.split()) <= self.max_words and self.enabled(session_id)
+    
+    def _vector(self, text):
+        # Unit-length embedding of a normalised message, or None without a usable model
+        if self.embed is None:
+            return None
+        try:
+            vector = np.asarray(self.embed.embed_query(text), dtype="float32")
+            return vector / (np.linalg.norm(vector) or 1.0)
+        except Exception as e:
+            print(f"⚠️ Response cache embedding failed: {e}")
+            return None
+    
+    def lookup(self, session_id, user_text, context=None, namespace=None) -> dict | None:
+        # A cached reply for this message: {"response", "audio", "similarity", "match"},
+        # or None to generate one as usual. Only replies stored for the same namespace
+        # (the session's, unless one is given) can be reused.
+        text = normalise(user_text)
+        if not self._cacheable(session_id, text):
+            return None
+        scope = (namespace or session_id, context_hash(context))
+        
+        with self.lock:
+            self._expire()
+            entry = self.entries.get((*scope, text))
+            if entry is not None:
+                self.stats["exact_hits"] += 1
+                return self._hit(entry, 1.0, "exact")
+            candidates = [e for e in self.entries.values() if e["scope"] == scope and e["vector"] is not None]
+        
+        # No exact match - compare meanings with the other replies written for this context
+        vector = self._vector(text) if candidates else None
+        if vector is not None:
+            similarities = np.stack([e["vector"] for e in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            with self.lock:
+                entry = candidates[best]
+                if similarities[best] >= self.threshold and self.entries.get(entry["key"]) is entry:
+                    self.stats["semantic_hits"] += 1
+                    return self._hit(entry, float(similarities[best]), "semantic")
+        
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+    
+    def _hit(self, entry, similarity, match) -> dict:
+        # (lock held)
+        self.entries.move_to_end(entry["key"])
+        self.stats["hits"] += 1
+        entry["hits"] += 1
+        return {"response": entry["response"], "audio": entry["audio"], "similarity": similarity, "match": match}
+    
+    def store(self, session_id, user_text, context, response, audio_path=None, namespace=None):
+        # Remember a freshly generated reply, with a copy of its audio file if there is one
+        text = normalise(user_text)
+        if not response or not self._cacheable(session_id, text):
+            return
+        vector = self._vector(text)
+        
+        audio = None
+        if audio_path is not None and Path(audio_path).exists():
+            try:
+                self.audio_folder.mkdir(parents=True, exist_ok=True)
+                audio = self.audio_folder / f"{uuid.uuid4().hex}{Path(audio_path).suffix}"
+                shutil.copyfile(audio_path, audio)
+            except OSError as e:
+                print(f"⚠️ Couldn't cache reply audio: {e}")
+                audio = None
+        
+        key = (namespace or session_id, context_hash(context), text)
+        entry = {"key": key, "scope": key[:2], "vector": vector, "response": response,
+                 "audio": audio, "created": time.time(), "hits": 0}
+        with self.lock:
+            dropped = [self.entries.pop(key)] if key in self.entries else []
+            self.entries[key] = entry
+            self.stats["stores"] += 1
+            while len(self.entries) > self.max_entries:
+                dropped.append(self.entries.popitem(last=False)[1])
+                self.stats["evictions"] += 1
+        self._remove_audio(dropped)
+    
+    def restore_audio(self, hit, destination) -> bool:
+        # Put a hit's cached audio where a new reply's would go; False if it has none
+        if hit.get("audio") is None:
+            return False
+        try:
+            shutil.copyfile(hit["audio"], destination)
+            return True
+        except OSError:
+            return False  # Evicted in the meantime
+    
+    def _expire(self):
+        # Drop entries past their time to live (lock held)
+        if not self.ttl_seconds:
+            return
+        cutoff = time.time() - self.ttl_seconds
+        expired = [entry for entry in self.entries.values() if entry["created"] < cutoff]
+        for entry in expired:
+            del self.entries[entry["key"]]
+            self.stats["expired"] += 1
+        self._remove_audio(expired)
+    
+    @staticmethod
+    def _remove_audio(entries):
+        for entry in entries:
+            if entry["audio"] is not None:
+                entry["audio"].unlink(missing_ok=True)
+    
+    def clear(self):
+        with self.lock:
+            dropped = list(self.entries.values())
+            self.entries.clear()
+        self._remove_audio(dropped)
+    
+    def get_stats(self) -> dict:
+        # Hit rate and size of the cache
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self.entries),
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+                "opted_out_sessions": len(self.opted_out)
+            }
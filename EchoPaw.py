@@ -1,13 +1,23 @@
 from STT import transcribe_once
-from LLM import generate_reply
+from LLM import generate_reply, preload, add_metrics_sink
+from Metrics import PercentileSink
 from TTS import speak
 from RAG import EchoMemory
+from Cache import ResponseCache
+from pathlib import Path
 import sys
 
 # Initialize the memory system when EchoPaw starts
 print("🚀 Initializing EchoPaw...")
 mem = EchoMemory()
 
+# Replies to repeated small talk, matched with the memory's embeddings model
+response_cache = ResponseCache(embed=mem.embed)
+
+# Reply latencies across the session, for the stats command
+latency = PercentileSink()
+add_metrics_sink(latency)
+
 # Words that will end the conversation
 EXIT_WORDS = {"quit", "exit", "goodbye", "good-bye", "good bye", "Goodbye", "Good Bye", "Good bye"}
 
@@ -21,6 +31,7 @@ def main():
     print("="*60)
     print("Commands:")
     print(" • Press Enter to record audio")
+    print(" • Type 'cache off' / 'cache on' to stop or resume reusing replies")
     print(" • Say 'good-bye' to exit")
     print("="*60)
     
@@ -40,6 +51,18 @@ def main():
                 print(f"\n📊 Memory Statistics:")
                 for key, value in stats.items():
                     print(f"   {key}: {value}")
+                cache_stats = response_cache.get_stats()
+                print(f"   reply cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%})")
+                summary = latency.summary()
+                for name, key, scale, unit in [("first token", "time_to_first_token", 1, "s"), ("prefill", "prefill_time", 1, "s"),
+                                               ("per token", "inter_token_latency", 1000, "ms")]:
+                    if summary[key]["count"]:
+                        print(f"   {name}: p50 {summary[key]['p50'] * scale:.2f}{unit}, p90 {summary[key]['p90'] * scale:.2f}{unit}, "
+                              f"p99 {summary[key]['p99'] * scale:.2f}{unit}")
+                continue
+            elif user_input.lower() in ('cache on', 'cache off'):
+                response_cache.set_enabled("cli", user_input.lower() == 'cache on')
+                print(f"♻️ Reply cache {user_input.lower().split()[1]}")
                 continue
             elif user_input.lower() in EXIT_WORDS:
                 break  # Exit the conversation
@@ -87,33 +110,53 @@ def main():
                 # No relevant memories found
                 memory_context = "I don't have any specific memories about you yet."
             
-            # Create the system prompt with memory context
+            # The system prompt stays the same every turn and the memories go with this
+            # turn, so the conversation so far stays cached between turns
             system_prefix = (
-                f"You are EchoPaw, a friendly AI companion. {memory_context}\n\n"
+                "You are EchoPaw, a friendly AI companion.\n\n"
                 "Respond naturally and empathetically. If you remember something specific "
                 "about the user, reference it naturally in conversation. Keep responses "
                 "concise but warm."
             )
             
+            # Small talk answered recently gets the same reply and audio again
+            cached = response_cache.lookup("cli", user_text, memory_context)
+            if cached is not None:
+                print(f"🐾 ECHO ➜ {cached['response']} (reused)")
+                history += [{"role": "user", "content": user_text, "context": memory_context},
+                            {"role": "assistant", "content": cached["response"]}]
+                if not response_cache.restore_audio(cached, Path.cwd() / "EchoPaw.wav"):
+                    try:
+                        speak(cached["response"])
+                    except Exception as e:
+                        print(f"⚠️ TTS failed: {e}")
+                continue
+            
             # Generate AI response using the LLM
             print("🤔 Thinking...")
             assistant_text, history, metrics = generate_reply(
                 user_text, 
                 history, 
                 system_prompt=system_prefix, 
-                max_new_tokens=150  # Keep responses reasonably short
+                max_new_tokens=150,  # Keep responses reasonably short
+                session_id="cli",
+                context=memory_context
             )
             
             # Show the AI's response
             print(f"🐾 ECHO ➜ {assistant_text}")
             
             # Show performance metrics
-            print(f"📊 Performance: {metrics['tokens_per_second']:.1f} tokens/sec on {metrics['device']} ({metrics['tokens_generated']} tokens in {metrics['generation_time']:.2f}s)")
+            print(f"📊 Performance: {metrics['tokens_per_second']:.1f} tokens/sec on {metrics['device']} ({metrics['tokens_generated']} tokens in {metrics['generation_time']:.2f}s, "
+                  f"first after {metrics.get('time_to_first_token', 0.0):.2f}s)")
             
             # Convert response to speech (with error handling)
             try:
                 print("🔊 Speaking...")
-                speak(assistant_text)
+                audio_path = Path.cwd() / "EchoPaw.wav"
+                audio_path.unlink(missing_ok=True)  # Only cache audio made for this reply
+                speak(assistant_text, audio_path)
+                response_cache.store("cli", user_text, memory_context, assistant_text, audio_path)
             except Exception as e:
                 print(f"⚠️ TTS failed: {e}")
                 print("Continuing without audio...")  # Don't crash if TTS fails
@@ -141,10 +184,13 @@ if __name__ == "__main__":
         # Show what devices each component is using
         print(f"   STT Device: {stt_device()}")
         print(f"   LLM Device: {llm_device}")
-        print(f"   Memory: {len(mem.vstore.docstore)} stored memories")
+        print(f"   Memory: {mem.count()} stored memories")
         print("✅ All systems ready!")
     except Exception as e:
         print(f"⚠️ System check warning: {e}")
     
+    # Load the language model while the first question is being asked
+    preload()
+    
     # Start the main conversation loop
     main()
\ No newline at end of file
@@ -1,7 +1,19 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
+from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig, GenerationConfig, DynamicCache, StoppingCriteria, StoppingCriteriaList
+from transformers.modeling_utils import no_init_weights
+from transformers.generation.streamers import BaseStreamer
+from collections import OrderedDict, deque
+from functools import lru_cache
+from queue import Queue
+from Metrics import describe
+from pathlib import Path
+import threading
 import torch
 import time
+import json
+import math
+import gc
 import sys
+import os
 
 def get_optimal_device():
     # Check if CUDA GPU is available first
@@ -17,6 +29,10 @@ def get_optimal_device():
 # The therapy-oriented model we want to use
 MODEL_ID = "lavanyamurugesan123/Llama3.2-3B-Instruct-finetuned-Therapy-oriented"
 
+# Optional smaller model with the same tokenizer (e.g. meta-llama/Llama-3.2-1B-Instruct)
+# that drafts a few tokens at a time for MODEL_ID to check in one pass - off unless set
+DRAFT_MODEL_ID = os.environ.get("ECHOPAW_LLM_DRAFT") or None
+
 # Find the best device available on this machine
 _device = get_optimal_device()
 print(f"LLM using device: {_device}")
@@ -29,47 +45,303 @@ elif _device == "mps":
 else:
     _dtype = torch.float32  # CPU needs full precision
 
-# Load the tokenizer (converts text to numbers)
-tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
-
-# Load the model with device-specific settings
-try:
-    if _device == "cuda":
-        # GPU loading with automatic memory management
-        model = AutoModelForCausalLM.from_pretrained(
-            MODEL_ID,
-            torch_dtype=_dtype,
-            low_cpu_mem_usage=True,  # Don't use too much RAM during loading
-            device_map="auto"  # Let transformers decide GPU placement
-        )
-    elif _device == "mps":
-        # Apple Silicon loading
-        model = AutoModelForCausalLM.from_pretrained(
-            MODEL_ID,
-            torch_dtype=_dtype,
-            low_cpu_mem_usage=True,
-        ).to("mps")  # Move to Apple Silicon GPU
-    else:
-        # CPU loading
-        model = AutoModelForCausalLM.from_pretrained(
-            MODEL_ID,
-            torch_dtype=_dtype,
-            low_cpu_mem_usage=True,
-        ).to("cpu")  # Keep on CPU
-    
-    print(f"Model loaded successfully on {_device}")
-    
-except Exception as e:
-    # If loading fails, try CPU as backup
-    print(f"Error loading model on {_device}: {e}")
-    print("Falling back to CPU...")
-    _device = "cpu"
-    _dtype = torch.float32
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_ID,
-        torch_dtype=_dtype,
-        low_cpu_mem_usage=True,
-    ).to("cpu")
+# How the model runs on CPU (ECHOPAW_LLM_QUANT): "fp32" as before, "bf16" weights and
+# maths, "int8-dynamic" int8 Linear layers with float32 activations (PyTorch only), or
+# weight-only "int8-weight" / "int4-weight" with bf16 maths (needs torchao). The torchao
+# modes' quantized weights are saved under models/llm/ so quantizing happens once.
+# The other modes don't need a cache. bf16 loads straight in bf16, and int8-dynamic
+# only takes seconds to quantize.
+CPU_QUANT_MODES = ("fp32", "bf16", "int8-dynamic", "int8-weight", "int4-weight")
+CPU_QUANT = os.environ.get("ECHOPAW_LLM_QUANT", "fp32")
+QUANT_CACHE = Path("models/llm")
+
+# Fixed prompts for checking a quantized model against fp32
+QUANT_CHECK_PROMPTS = [
+    "I keep forgetting where I put my keys and it scares me.",
+    "My daughter visited today and we looked at old photos together.",
+    "I can't sleep at night and I feel anxious in the mornings.",
+    "Tell me something nice to look forward to this week.",
+    "I used to love gardening but my hands hurt now.",
+]
+
+def quantize_for_cpu(model, mode):
+    # Convert a float32 model to one of CPU_QUANT_MODES
+    if mode == "fp32":
+        return model
+    if mode == "bf16":
+        return model.to(torch.bfloat16)
+    if mode == "int8-dynamic":
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if mode in ("int8-weight", "int4-weight"):
+        from torchao.quantization import quantize_, int8_weight_only, int4_weight_only
+        model = model.to(torch.bfloat16)
+        if mode == "int8-weight":
+            quantize_(model, int8_weight_only())
+        else:
+            try:
+                from torchao.dtypes import Int4CPULayout  # The CPU kernel layout in newer torchao
+                quantize_(model, int4_weight_only(group_size=128, layout=Int4CPULayout()))
+            except ImportError:
+                quantize_(model, int4_weight_only(group_size=128))
+        return model
+    raise ValueError(f"Unknown CPU quantization '{mode}' - use one of {', '.join(CPU_QUANT_MODES)}")
+
+def load_cpu_model(model_id, mode):
+    # The model quantized for CPU, from models/llm/ when it's been quantized before
+    if mode == "bf16":
+        return AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True)
+    if mode not in ("int8-weight", "int4-weight"):
+        model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+        return quantize_for_cpu(model, mode)
+    
+    folder = QUANT_CACHE / model_id.replace("/", "--")
+    file = folder / f"{mode}.weights.pt"
+    settings_file = folder / f"{mode}.json"
+    # A cache written by another torch or torchao version may not load, so it's redone instead
+    versions = {"torch": torch.__version__, "torchao": _torchao_version()}
+    if file.exists() and settings_file.exists() and json.loads(settings_file.read_text()) == versions:
+        try:
+            return _load_quantized_weights(model_id, file)
+        except Exception as e:
+            print(f"⚠️ Couldn't load quantized model cache, quantizing again: {e}")
+    
+    print(f"📦 Quantizing {model_id} to {mode} (first run only)...")
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+    model = quantize_for_cpu(model, mode)
+    folder.mkdir(parents=True, exist_ok=True)
+    # Only the weights are saved - torchao's tensor types load with weights_only=True,
+    # so reading the cache never unpickles arbitrary objects
+    torch.save(model.state_dict(), file)
+    settings_file.write_text(json.dumps(versions))
+    return model
+
+def _load_quantized_weights(model_id, file):
+    # Rebuild the model from its config (without initialising weights that are about to be
+    # replaced) and put the saved quantized weights into it. torchao has been imported by
+    # now (_torchao_version), which registers its tensor types as safe to load.
+    config = AutoConfig.from_pretrained(model_id)
+    with no_init_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.bfloat16)
+    state = torch.load(file, map_location="cpu", weights_only=True, mmap=True)
+    model.load_state_dict(state, assign=True)
+    model.tie_weights()
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_id)
+    except OSError:
+        pass  # The model has no generation_config.json
+    return model.eval()
+
+def _torchao_version():
+    try:
+        import torchao
+        return torchao.__version__
+    except ImportError:
+        return None
+
+class ModelRuntime:
+    # The tokenizer and model, loaded when something first needs them (or by warmup())
+    # rather than on import - so importing LLM.py, checking the device or counting tokens
+    # doesn't wait for 3B parameters. Each loading stage is timed for the startup report.
+    def __init__(self, model_id=MODEL_ID, cpu_quant=CPU_QUANT, draft_id=DRAFT_MODEL_ID):
+        if cpu_quant not in CPU_QUANT_MODES:
+            raise ValueError(f"Unknown CPU quantization '{cpu_quant}' - use one of {', '.join(CPU_QUANT_MODES)}")
+        self.model_id = model_id
+        self.cpu_quant = cpu_quant  # Only used when the model runs on the CPU
+        self.draft_id = draft_id
+        self.tokenizer = None
+        self.model = None
+        self.draft = None
+        self.draft_failed = False
+        self.lock = threading.RLock()
+        self.preloader = None
+        self.report = {"model_id": model_id, "loaded": False}
+    
+    def get_tokenizer(self):
+        if self.tokenizer is None:
+            with self.lock:
+                if self.tokenizer is None:
+                    # Load the tokenizer (converts text to numbers)
+                    start = time.perf_counter()
+                    self.tokenizer = AutoTokenizer.from_pretrained(self.model_id)
+                    self.report["tokenizer_load_s"] = time.perf_counter() - start
+        return self.tokenizer
+    
+    def get_model(self):
+        if self.model is None:
+            with self.lock:
+                if self.model is None:
+                    self.get_tokenizer()
+                    self._load_model()
+        return self.model
+    
+    def _load_model(self):
+        # Load the model with device-specific settings, timing the weight load and the
+        # move to the device separately
+        global _device, _dtype
+        quantized = "fp32" if _device == "cpu" else None
+        try:
+            start = time.perf_counter()
+            if _device == "cuda":
+                # GPU loading with automatic memory management - the weights go straight to
+                # the GPU, so there's no separate transfer
+                model = AutoModelForCausalLM.from_pretrained(
+                    self.model_id,
+                    torch_dtype=_dtype,
+                    low_cpu_mem_usage=True,  # Don't use too much RAM during loading
+                    device_map="auto"  # Let transformers decide GPU placement
+                )
+                loaded = time.perf_counter()
+            elif _device == "cpu" and self.cpu_quant != "fp32":
+                # Quantized CPU model, already on the CPU
+                model = load_cpu_model(self.model_id, self.cpu_quant)
+                loaded = time.perf_counter()
+                quantized = self.cpu_quant
+                if quantized != "int8-dynamic":
+                    _dtype = torch.bfloat16  # The maths runs in bf16 for the other modes
+            else:
+                # Apple Silicon or CPU loading
+                model = AutoModelForCausalLM.from_pretrained(
+                    self.model_id,
+                    torch_dtype=_dtype,
+                    low_cpu_mem_usage=True,
+                )
+                loaded = time.perf_counter()
+                model = model.to(_device)  # Move to Apple Silicon GPU, or keep on CPU
+            
+            print(f"Model loaded successfully on {_device}" + (f" ({quantized})" if quantized else ""))
+
+        except Exception as e:
+            # If loading fails, try CPU as backup
+            print(f"Error loading model on {_device}: {e}")
+            print("Falling back to CPU...")
+            _device = "cpu"
+            _dtype = torch.float32
+            quantized = "fp32"
+            start = time.perf_counter()
+            model = AutoModelForCausalLM.from_pretrained(
+                self.model_id,
+                torch_dtype=_dtype,
+                low_cpu_mem_usage=True,
+            )
+            loaded = time.perf_counter()
+            model = model.to("cpu")
+        
+        model.eval()
+        self.report.update({
+            "weight_load_s": loaded - start,
+            "device_transfer_s": time.perf_counter() - loaded,
+            "device": _device,
+            "dtype": str(_dtype).replace("torch.", ""),
+            "cpu_quant": quantized,
+            "loaded": True
+        })
+        self.model = model
+    
+    def get_draft(self):
+        # The draft model for assisted decoding, or None when none is set or it can't be used
+        if self.draft is None and self.draft_id and not self.draft_failed:
+            with self.lock:
+                if self.draft is None and not self.draft_failed:
+                    model = self.get_model()
+                    try:
+                        start = time.perf_counter()
+                        draft = AutoModelForCausalLM.from_pretrained(
+                            self.draft_id,
+                            torch_dtype=_dtype,
+                            low_cpu_mem_usage=True,
+                        ).to(_device)
+                        # Drafted token ids only mean the same thing with the same vocabulary
+                        if draft.config.vocab_size != model.config.vocab_size:
+                            raise ValueError(f"its vocabulary ({draft.config.vocab_size}) doesn't match "
+                                             f"{self.model_id} ({model.config.vocab_size})")
+                        draft.eval()
+                        self.report["draft_load_s"] = time.perf_counter() - start
+                        self.draft = draft
+                        print(f"Draft model {self.draft_id} loaded for assisted decoding")
+                    except Exception as e:
+                        print(f"⚠️ Not using draft model {self.draft_id}: {e}")
+                        self.draft_failed = True
+        return self.draft
+    
+    def warmup(self, generate=True) -> dict:
+        # Load everything now, and run a one-token generation so the first real reply
+        # doesn't pay for kernel selection and memory allocation either
+        with self.lock:
+            start = time.perf_counter()
+            model = self.get_model()
+            self.get_draft()
+            if generate and "first_token_s" not in self.report:
+                tokenizer = self.get_tokenizer()
+                inputs = tokenizer("Hello", return_tensors="pt").to(_device)
+                first = time.perf_counter()
+                with torch.no_grad():
+                    model.generate(**inputs, max_new_tokens=1, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+                self.report["first_token_s"] = time.perf_counter() - first
+            if "total_s" not in self.report:
+                self.report["total_s"] = sum(self.report.get(stage, 0.0) for stage in STARTUP_STAGES)
+            self.report["warmup_call_s"] = time.perf_counter() - start
+        return self.startup_report()
+    
+    def preload(self, generate=True):
+        # warmup() in a background thread, so a server can start answering right away
+        with self.lock:
+            if self.preloader is None:
+                self.preloader = threading.Thread(target=self._preload, args=(generate,), daemon=True)
+                self.preloader.start()
+        return self.preloader
+    
+    def _preload(self, generate):
+        try:
+            self.print_report(self.warmup(generate))
+        except Exception as e:
+            print(f"⚠️ LLM preload failed: {e}")
+    
+    def startup_report(self) -> dict:
+        # Time spent in each loading stage so far (seconds)
+        return dict(self.report)
+    
+    @staticmethod
+    def print_report(report):
+        stages = ", ".join(f"{stage.replace('_s', '').replace('_', ' ')} {report[stage]:.2f}s"
+                           for stage in STARTUP_STAGES if stage in report)
+        print(f"⏱️ LLM startup on {report.get('device', _device)}: {stages}")
+
+# Loading stages in the startup report
+STARTUP_STAGES = ("tokenizer_load_s", "weight_load_s", "device_transfer_s", "draft_load_s", "first_token_s")
+
+# The tokenizer and model, loaded on first use
+runtime = ModelRuntime()
+
+def get_tokenizer():
+    return runtime.get_tokenizer()
+
+def get_model():
+    return runtime.get_model()
+
+def warmup(generate=True) -> dict:
+    # Load the model now (instead of on the first reply) and report how long it took
+    report = runtime.warmup(generate)
+    runtime.print_report(report)
+    return report
+
+def preload(generate=True):
+    # Load and warm up the model in the background
+    return runtime.preload(generate)
+
+def is_loaded() -> bool:
+    return runtime.model is not None
+
+def startup_report() -> dict:
+    # How long each loading stage took - never loads anything itself
+    return runtime.startup_report()
+
+# Most prompt tokens a conversation may use (system prompt and summary included) - older
+# turns are replaced by a summary beyond this
+HISTORY_BUDGET = 1536
+SUMMARY_MAX_TOKENS = 160
+
+# Most conversations decoded together in one batch (0 = each reply runs model.generate alone)
+MAX_BATCH = int(os.environ.get("ECHOPAW_LLM_BATCH", "8"))
 
 # The system prompt that tells the AI how to behave
 SYSTEM = (
@@ -81,8 +353,755 @@ SYSTEM = (
 )
 
 def count_tokens(text: str) -> int:
-    # Convert text to tokens and count them
-    return len(tokenizer.encode(text))
+    # Convert text to tokens and count them (only needs the tokenizer, not the model)
+    return len(get_tokenizer().encode(text))
+
+@lru_cache(maxsize=4096)
+def _segment_ids(segment: str) -> tuple:
+    # Token ids for one piece of the dialogue - each turn is encoded once, not every time
+    # the conversation is rebuilt
+    return tuple(get_tokenizer().encode(segment, add_special_tokens=False))
+
+def _head_segments(system_prompt, summary=None) -> list[str]:
+    # The start of the prompt: system prompt, then the summary of earlier turns if any
+    segments = [
+        "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n"
+        f"{system_prompt}<|eot_id|>"
+    ]
+    if summary:
+        segments.append(f"<|start_header_id|>system<|end_header_id|>\nEarlier in this conversation: {summary}<|eot_id|>")
+    return segments
+
+def _turn_segments(turn) -> list[str]:
+    # A turn's "context" (e.g. recalled memories) goes in a system message just before
+    # it, so the system prompt itself stays the same from turn to turn
+    segments = []
+    if turn.get("context"):
+        segments.append(f"<|start_header_id|>system<|end_header_id|>\n{turn['context']}<|eot_id|>")
+    role_tag = "user" if turn["role"] == "user" else "assistant"
+    segments.append(f"<|start_header_id|>{role_tag}<|end_header_id|>\n{turn['content']}<|eot_id|>")
+    return segments
+
+def turn_tokens(turn) -> int:
+    # Prompt tokens a history turn takes, counted once and kept with the turn
+    if "tokens" not in turn:
+        turn["tokens"] = sum(len(_segment_ids(segment)) for segment in _turn_segments(turn))
+    return turn["tokens"]
+
+def build_prompt(history: list, system_prompt: str = SYSTEM, summary: str | None = None) -> list[int]:
+    # The conversation as Llama 3 chat tokens, ending with the assistant's header
+    segments = _head_segments(system_prompt, summary)
+    for turn in history:
+        segments.extend(_turn_segments(turn))
+    segments.append("<|start_header_id|>assistant<|end_header_id|>\n")
+    
+    ids = []
+    for segment in segments:
+        ids.extend(_segment_ids(segment))
+    return ids
+
+def summarise_turns(previous: str | None, turns: list) -> str:
+    # Fold some conversation turns into the running summary with the model itself
+    lines = [f"{'User' if turn['role'] == 'user' else 'EchoPaw'}: {turn['content']}" for turn in turns]
+    request = (f"Summary so far: {previous}\n\n" if previous else "") + "Conversation:\n" + "\n".join(lines)
+    dialogue = (
+        "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n"
+        "Summarise this conversation between a user and EchoPaw in a few sentences. "
+        "Keep the names, people, events and feelings the user mentioned.<|eot_id|>"
+        f"<|start_header_id|>user<|end_header_id|>\n{request}<|eot_id|>"
+        "<|start_header_id|>assistant<|end_header_id|>\n"
+    )
+    tokenizer = get_tokenizer()
+    inputs = tokenizer(dialogue, return_tensors="pt", add_special_tokens=False).to(_device)
+    if scheduler.max_batch:
+        # Decoded greedily (a summary should be stable, not creative) alongside the replies
+        request = scheduler.generate(inputs["input_ids"][0].tolist(), SUMMARY_MAX_TOKENS, temperature=0.0)
+        return tokenizer.decode(request.generated, skip_special_tokens=True).strip()
+    with torch.no_grad():
+        output = get_model().generate(
+            **inputs,
+            max_new_tokens=SUMMARY_MAX_TOKENS,
+            do_sample=False,  # A summary should be stable, not creative
+            pad_token_id=tokenizer.eos_token_id
+        )
+    return tokenizer.decode(output[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True).strip()
+
+class ConversationWindow:
+    # Keeps each session's prompt within a token budget. When a conversation outgrows it,
+    # the oldest turns leave the prompt and a background thread folds them into a rolling
+    # summary that takes their place. The summary is written after the reply, so no turn
+    # waits for it - until it's ready the prompt just starts at the kept turns.
+    def __init__(self, max_sessions=1000):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # session_id -> {"start", "covered", "summary", "busy"}
+        self.lock = threading.Lock()
+        self.jobs = Queue()
+        self.worker = None
+    
+    def window(self, history, session_id, system_prompt, budget) -> tuple[int, str | None]:
+        # (first history turn to put in the prompt, summary of the turns before it)
+        with self.lock:
+            state = self.sessions.pop(session_id, None) if session_id is not None else None
+            state = state or {"start": 0, "covered": 0, "summary": None, "busy": False}
+            if session_id is not None:
+                self.sessions[session_id] = state
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            start, summary = state["start"], state["summary"]
+        
+        head = sum(len(_segment_ids(segment)) for segment in _head_segments(system_prompt, summary))
+        total = head + sum(turn_tokens(turn) for turn in history[start:])
+        if total > budget:
+            # Trim to two thirds of the budget, so the prompt's start (and the cached
+            # conversation behind it) stays the same for the next few turns
+            target = budget * 2 // 3
+            while start < len(history) - 1 and (total > target or history[start]["role"] != "user"):
+                total -= turn_tokens(history[start])
+                start += 1
+            with self.lock:
+                state["start"] = start
+        return start, summary
+    
+    def catch_up(self, history, session_id):
+        # Summarise the turns that have left the prompt, off the critical path
+        with self.lock:
+            state = self.sessions.get(session_id)
+            if state is None or state["busy"] or state["start"] <= state["covered"]:
+                return
+            state["busy"] = True
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work, daemon=True)
+                self.worker.start()
+        self.jobs.put((state, history))
+    
+    def _work(self):
+        while True:
+            state, history = self.jobs.get()
+            try:
+                end = state["start"]
+                summary = summarise_turns(state["summary"], history[state["covered"]:end])
+                with self.lock:
+                    state["summary"], state["covered"] = summary, end
+            except Exception as e:
+                print(f"⚠️ Conversation summary failed: {e}")
+            finally:
+                with self.lock:
+                    state["busy"] = False
+    
+    def drop(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+# Prompt windows and rolling summaries for generate_reply calls
+conversation_window = ConversationWindow()
+
+def _cache_bytes(cache) -> int:
+    # Memory held by a KV cache's key and value tensors
+    tensors = [*getattr(cache, "key_cache", []), *getattr(cache, "value_cache", [])]
+    for layer in getattr(cache, "layers", []):  # Newer transformers keep them per layer
+        tensors += [layer.keys, layer.values]
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+class PromptCache:
+    # The KV cache of each session's conversation so far. A new turn shares its prompt
+    # with the last one up to the new user message, so only those tokens need a prefill
+    # instead of the whole conversation. A session's cache is dropped when its system
+    # prompt changes, and the least recently used ones go when the budget is exceeded.
+    def __init__(self, budget_mb=2048, max_sessions=64):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()  # session_id -> (system_prompt, token ids, cache, bytes)
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "reused_tokens": 0, "evictions": 0}
+    
+    def take(self, session_id, system_prompt, ids) -> tuple:
+        # (cache, reused) for a prompt: the session's cache trimmed to what it shares with
+        # `ids`, or a fresh cache. The entry is taken out while the turn runs.
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+            if entry is None or entry[0] != system_prompt:
+                self.stats["misses"] += 1
+                return DynamicCache(), 0
+        
+        _, cached_ids, cache, _ = entry
+        # At least the last prompt token has to run through the model to start the reply
+        limit = min(cache.get_seq_length(), len(cached_ids), len(ids) - 1)
+        reused = 0
+        while reused < limit and cached_ids[reused] == ids[reused]:
+            reused += 1
+        with self.lock:
+            if reused == 0:
+                self.stats["misses"] += 1
+                return DynamicCache(), 0
+            self.stats["hits"] += 1
+            self.stats["reused_tokens"] += reused
+        
+        cache.crop(reused)  # Forget the part that no longer matches
+        return cache, reused
+    
+    def put(self, session_id, system_prompt, ids, cache):
+        # Keep a session's cache after a turn, evicting others to stay in budget
+        size = _cache_bytes(cache)
+        if size > self.budget_bytes:
+            return  # A single conversation bigger than the whole budget isn't kept
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            self.sessions[session_id] = (system_prompt, list(ids), cache, size)
+            while len(self.sessions) > self.max_sessions or self._total_bytes() > self.budget_bytes:
+                self.sessions.popitem(last=False)
+                self.stats["evictions"] += 1
+    
+    def drop(self, session_id):
+        # Forget a session, e.g. when its conversation is reset
+        with self.lock:
+            self.sessions.pop(session_id, None)
+    
+    def _total_bytes(self) -> int:
+        return sum(entry[3] for entry in self.sessions.values())
+    
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {**self.stats, "sessions": len(self.sessions), "cache_mb": self._total_bytes() / 1024 / 1024}
+
+# Conversation KV caches for generate_reply calls that give a session_id
+prompt_cache = PromptCache()
+
+def _stop_ids() -> set:
+    # Token ids that end a reply (end of turn as well as end of text for Llama 3)
+    tokenizer = get_tokenizer()
+    eos = get_model().generation_config.eos_token_id
+    ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+    ids.add(tokenizer.eos_token_id)
+    ids.add(tokenizer.convert_tokens_to_ids("<|eot_id|>"))
+    return {i for i in ids if i is not None}
+
+def _sample(logits, temperatures, top_ps):
+    # Next token per row: temperature + nucleus sampling like model.generate, greedy for
+    # rows with temperature 0
+    logits = logits.float()
+    greedy = logits.argmax(dim=-1)
+    temperatures = torch.tensor(temperatures, device=logits.device).unsqueeze(1)
+    probs = torch.softmax(logits / temperatures.clamp(min=1e-5), dim=-1)
+    sorted_probs, order = probs.sort(dim=-1, descending=True)
+    # Keep the smallest set of tokens whose probability adds up to top_p
+    outside = sorted_probs.cumsum(dim=-1) - sorted_probs > torch.tensor(top_ps, device=logits.device).unsqueeze(1)
+    sorted_probs = sorted_probs.masked_fill(outside, 0.0)
+    sampled = order.gather(-1, torch.multinomial(sorted_probs, 1)).squeeze(1)
+    return torch.where(temperatures.squeeze(1) > 0, sampled, greedy)
+
+def _left_pad(tensor, length, dim):
+    # Pad a tensor with zeros at the start of `dim` up to `length`
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+class GenerationRequest:
+    # One reply being decoded by the scheduler
+    def __init__(self, prompt_ids, max_new_tokens, cache=None, reused=0, temperature=0.7, top_p=0.9, stream=False):
+        self.prompt_ids = list(prompt_ids)
+        self.max_new_tokens = max_new_tokens
+        self.cache = cache if cache is not None else DynamicCache()  # Covers prompt_ids[:reused]
+        self.reused = reused
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generated = []  # New token ids
+        self.tokens = Queue() if stream else None  # Each new token as it's sampled, then None
+        self.cancelled = False  # Set by a reader that stopped listening
+        self.done = threading.Event()
+        self.error = None
+        self.submitted = time.time()
+        self.prefill_start = None  # perf_counter when its prefill began
+        self.token_times = []  # perf_counter when each new token was sampled
+
+class BatchScheduler:
+    # Continuous batching: replies from every conversation are decoded together, one token
+    # per step for the whole batch. Each new request gets its own prefill (from its
+    # session's cached conversation when there is one) and then joins the batch, and a
+    # request leaves as soon as it hits a stop token or its length limit, so a waiting one
+    # takes its place at the next step rather than when the whole batch is done.
+    # Sequences of different lengths share one left-padded KV cache.
+    def __init__(self, max_batch=MAX_BATCH):
+        self.max_batch = max_batch
+        self.waiting = deque()
+        self.condition = threading.Condition()
+        self.active = []  # Requests in batch row order
+        self.cache = None  # Batched KV cache as legacy (key, value) tuples per layer
+        self.mask = None  # (rows, cache length) attention mask, 0 for padding
+        self.positions = None  # Position of each row's next token
+        self.next_tokens = None  # Last sampled token per row, fed in at the next step
+        self.worker = None
+        self.stop_ids = None
+        self.stats = {"requests": 0, "completed": 0, "failed": 0, "steps": 0, "tokens": 0,
+                      "busy_seconds": 0.0, "occupied_rows": 0}
+    
+    def submit(self, prompt_ids, max_new_tokens, cache=None, reused=0, temperature=0.7, top_p=0.9, stream=False) -> GenerationRequest:
+        # Queue a prompt without waiting - with stream=True, request.tokens yields the
+        # reply's token ids as they're sampled
+        request = GenerationRequest(prompt_ids, max_new_tokens, cache, reused, temperature, top_p, stream)
+        with self.condition:
+            self.waiting.append(request)
+            self.stats["requests"] += 1
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._loop, daemon=True)
+                self.worker.start()
+            self.condition.notify()
+        return request
+    
+    def generate(self, prompt_ids, max_new_tokens, cache=None, reused=0, temperature=0.7, top_p=0.9) -> GenerationRequest:
+        # Queue a prompt and wait for its reply; request.generated holds the new token ids
+        # and request.cache the KV cache of prompt + reply (for the session cache)
+        request = self.submit(prompt_ids, max_new_tokens, cache, reused, temperature, top_p)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request
+    
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.waiting and not self.active:
+                    self.condition.wait()
+                admitted = []
+                while self.waiting and len(self.active) + len(admitted) < self.max_batch:
+                    admitted.append(self.waiting.popleft())
+            
+            started = time.time()
+            try:
+                with torch.no_grad():
+                    for request in admitted:
+                        self._admit(request)
+                    if self.active:
+                        self._step()
+            except Exception as e:
+                # A failed step takes the whole batch with it - fail those replies, keep serving
+                print(f"Batch generation error: {e}")
+                failed = self.active + [request for request in admitted if not request.done.is_set()]
+                self.active, self.cache = [], None
+                for request in failed:
+                    if not request.done.is_set():
+                        request.error = e
+                        self.stats["failed"] += 1
+                        if request.tokens is not None:
+                            request.tokens.put(None)
+                        request.done.set()
+            self.stats["busy_seconds"] += time.time() - started
+    
+    def _admit(self, request):
+        # Prefill the part of the prompt its cache doesn't cover, sample the first token,
+        # and add the request to the batch
+        if self.stop_ids is None:
+            self.stop_ids = _stop_ids()
+        if request.cancelled:
+            self._finish(request, request.cache)  # Nobody is waiting for it any more
+            return
+        request.prefill_start = time.perf_counter()
+        new_ids = request.prompt_ids[request.reused:]
+        positions = torch.arange(request.reused, len(request.prompt_ids), device=_device)
+        output = get_model()(
+            input_ids=torch.tensor([new_ids], device=_device),
+            position_ids=positions.unsqueeze(0),
+            cache_position=positions,
+            past_key_values=request.cache,
+            use_cache=True
+        )
+        token = int(_sample(output.logits[:, -1, :], [request.temperature], [request.top_p])[0])
+        self._emit(request, token)
+        self.stats["tokens"] += 1
+        if token in self.stop_ids or request.max_new_tokens <= 1:
+            self._finish(request, output.past_key_values)
+            return
+        
+        # Join the batch, left-padding whichever side has the shorter cache
+        legacy = output.past_key_values.to_legacy_cache()
+        length = len(request.prompt_ids)
+        row_mask = torch.ones((1, length), dtype=torch.long, device=_device)
+        if self.cache is None:
+            self.cache, self.mask = legacy, row_mask
+            self.positions = torch.tensor([length], device=_device)
+            self.next_tokens = torch.tensor([[token]], device=_device)
+        else:
+            total = max(length, self.mask.shape[1])
+            self.cache = tuple(
+                (torch.cat([_left_pad(key, total, 2), _left_pad(new_key, total, 2)]),
+                 torch.cat([_left_pad(value, total, 2), _left_pad(new_value, total, 2)]))
+                for (key, value), (new_key, new_value) in zip(self.cache, legacy)
+            )
+            self.mask = torch.cat([_left_pad(self.mask, total, 1), _left_pad(row_mask, total, 1)])
+            self.positions = torch.cat([self.positions, torch.tensor([length], device=_device)])
+            self.next_tokens = torch.cat([self.next_tokens, torch.tensor([[token]], device=_device)])
+        self.active.append(request)
+    
+    def _step(self):
+        # One decode step for every row in the batch
+        self.mask = torch.cat([self.mask, torch.ones((len(self.active), 1), dtype=self.mask.dtype, device=_device)], dim=1)
+        output = get_model()(
+            input_ids=self.next_tokens,
+            attention_mask=self.mask,
+            position_ids=self.positions.unsqueeze(1),
+            cache_position=torch.tensor([self.mask.shape[1] - 1], device=_device),
+            past_key_values=DynamicCache.from_legacy_cache(self.cache),
+            use_cache=True
+        )
+        self.cache = output.past_key_values.to_legacy_cache()
+        self.positions = self.positions + 1
+        tokens = _sample(
+            output.logits[:, -1, :],
+            [request.temperature for request in self.active],
+            [request.top_p for request in self.active]
+        )
+        self.next_tokens = tokens.unsqueeze(1)
+        self.stats["steps"] += 1
+        self.stats["tokens"] += len(self.active)
+        self.stats["occupied_rows"] += len(self.active)
+        
+        finished = []
+        for row, (request, token) in enumerate(zip(self.active, tokens.tolist())):
+            self._emit(request, token)
+            if token in self.stop_ids or len(request.generated) >= request.max_new_tokens or request.cancelled:
+                finished.append(row)
+        if finished:
+            self._release(finished)
+    
+    def _release(self, rows):
+        # Hand finished rows their own KV cache and shrink the batch to the rest. The row's
+        # slices are copied: as views they'd keep the whole batch's cache alive for as long
+        # as the prompt cache holds this one.
+        for row in rows:
+            start = int((self.mask[row] == 0).sum())  # Left padding in front of this row
+            cache = DynamicCache.from_legacy_cache(tuple(
+                (key[row:row + 1, :, start:].clone(), value[row:row + 1, :, start:].clone()) for key, value in self.cache
+            ))
+            self._finish(self.active[row], cache)
+        
+        keep = [row for row in range(len(self.active)) if row not in rows]
+        if not keep:
+            self.active, self.cache = [], None
+            return
+        index = torch.tensor(keep, device=_device)
+        self.active = [self.active[row] for row in keep]
+        self.mask = self.mask.index_select(0, index)
+        # Drop padding columns no remaining row needs
+        start = int((self.mask == 0).all(dim=0).long().cumprod(dim=0).sum())
+        self.mask = self.mask[:, start:]
+        self.cache = tuple(
+            (key.index_select(0, index)[:, :, start:], value.index_select(0, index)[:, :, start:])
+            for key, value in self.cache
+        )
+        self.positions = self.positions.index_select(0, index)
+        self.next_tokens = self.next_tokens.index_select(0, index)
+    
+    def _emit(self, request, token):
+        request.token_times.append(time.perf_counter())
+        request.generated.append(token)
+        if request.tokens is not None:
+            request.tokens.put(token)
+    
+    def _finish(self, request, cache):
+        request.cache = cache
+        self.stats["completed"] += 1
+        if request.tokens is not None:
+            request.tokens.put(None)
+        request.done.set()
+    
+    def is_idle(self) -> bool:
+        # Nothing decoding or waiting
+        with self.condition:
+            return not self.waiting and not self.active
+    
+    def get_stats(self) -> dict:
+        # Queue depth, batch occupancy and aggregate throughput
+        with self.condition:
+            queued = len(self.waiting)
+        stats = dict(self.stats)
+        steps = stats["steps"]
+        return {
+            **stats,
+            "queue_depth": queued,
+            "active": len(self.active),
+            "max_batch": self.max_batch,
+            "batch_occupancy": stats["occupied_rows"] / steps / self.max_batch if steps and self.max_batch else 0.0,
+            "tokens_per_second": stats["tokens"] / stats["busy_seconds"] if stats["busy_seconds"] else 0.0
+        }
+
+# Shared decode batch for every conversation
+scheduler = BatchScheduler()
+
+def _draft_for(assisted):
+    # The draft model if this reply should use assisted decoding. It speeds up a lone
+    # conversation, but when others are decoding the shared batch makes better use of
+    # the hardware, so by default (assisted=None) it's only used while the batch is idle.
+    if assisted is False or not runtime.draft_id:
+        return None
+    if assisted is None and scheduler.max_batch and not scheduler.is_idle():
+        return None
+    return runtime.get_draft()
+
+class _ForwardCounter:
+    # Counts the forward passes the model and the draft make on this thread during an
+    # assisted generation. Each model pass checks one round of drafted tokens and adds one
+    # token of its own, so the accepted drafts are the reply's tokens minus the passes.
+    def __init__(self, model, draft):
+        self.modules = {"model": model, "draft": draft}
+        self.counts = {"model": 0, "draft": 0}
+        self.hooks = []
+    
+    def __enter__(self):
+        thread = threading.get_ident()  # The model may be busy on other threads too
+        for name, module in self.modules.items():
+            if module is not None:
+                self.hooks.append(module.register_forward_hook(
+                    lambda *_, name=name: self.counts.__setitem__(name, self.counts[name] + (threading.get_ident() == thread))
+                ))
+        return self
+    
+    def __exit__(self, *exc):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+    
+    def metrics(self, generated) -> dict:
+        passes, drafted = self.counts["model"], self.counts["draft"]
+        accepted = max(generated - passes, 0)
+        return {
+            "draft_model": runtime.draft_id,
+            "draft_tokens": drafted,
+            "draft_acceptance_rate": min(accepted / drafted, 1.0) if drafted else 0.0,
+            "tokens_per_model_pass": generated / passes if passes else 0.0
+        }
+
+def _prepare_turn(user_text, history, system_prompt, session_id, context, history_budget) -> tuple:
+    # Add the user's message to the history and build the prompt for the reply:
+    # (prompt ids, generate inputs, prompt tokens reused from the session cache, first
+    # history turn in the prompt, summary of the turns before it)
+    get_model()  # The first reply loads the model, and settles which device it's on
+    
+    # Add the user's message to conversation history
+    turn = {"role": "user", "content": user_text}
+    if context:
+        turn["context"] = context
+    history.append(turn)
+    
+    # Convert the conversation to tokens and move them to the right device - the turns
+    # that fit the budget, after a summary of the ones before
+    start, summary = conversation_window.window(history, session_id, system_prompt, history_budget)
+    prompt_ids = build_prompt(history[start:], system_prompt, summary)
+    input_ids = torch.tensor([prompt_ids], device=_device)
+    inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    
+    # Pick up the session's cached conversation, so only the new tokens need a prefill
+    reused = 0
+    if session_id is not None:
+        cache, reused = prompt_cache.take(session_id, system_prompt, prompt_ids)
+        inputs["past_key_values"] = cache
+    return prompt_ids, inputs, reused, start, summary
+
+# Where each reply's metrics go besides the caller - see Metrics.py
+metrics_sinks = []
+
+def add_metrics_sink(sink):
+    metrics_sinks.append(sink)
+
+def remove_metrics_sink(sink):
+    if sink in metrics_sinks:
+        metrics_sinks.remove(sink)
+
+def _record_metrics(metrics):
+    for sink in list(metrics_sinks):
+        try:
+            sink.record(metrics)
+        except Exception as e:
+            print(f"⚠️ Metrics sink {type(sink).__name__} failed: {e}")
+
+def _timing_metrics(start_time, end_time, timer, token_count) -> dict:
+    # A reply's latencies from when each of its tokens was actually produced. timer is the
+    # scheduler's GenerationRequest or a _TokenTimer; times are time.perf_counter().
+    times = timer.token_times
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    generation_time = end_time - start_time
+    prefill_start = timer.prefill_start or start_time
+    return {
+        "tokens_generated": token_count,  # Ids the model produced, stop token included
+        "generation_time": generation_time,
+        "tokens_per_second": token_count / generation_time if generation_time > 0 else 0,
+        "queue_time": prefill_start - start_time,  # Waiting for a place in the batch
+        "prefill_time": times[0] - prefill_start if times else 0.0,  # Prompt in, first token out
+        "time_to_first_token": times[0] - start_time if times else generation_time,
+        "inter_token_latency": describe(gaps),
+        "token_latencies": gaps  # Seconds between consecutive tokens
+    }
+
+class _TokenTimer(BaseStreamer):
+    # model.generate streamer that notes when the prompt went in and each new token came out
+    def __init__(self):
+        self.prefill_start = None
+        self.token_times = []
+    
+    def put(self, value):
+        now = time.perf_counter()
+        if self.prefill_start is None:
+            self.prefill_start = now  # The first call is the prompt itself
+            return
+        self.token_times.extend([now] * value.numel())  # Assisted decoding adds several at once
+    
+    def end(self):
+        pass
+
+class _TokenQueue(_TokenTimer):
+    # ...that also hands the new token ids to another thread
+    def __init__(self):
+        super().__init__()
+        self.queue = Queue()
+    
+    def put(self, value):
+        prompt = self.prefill_start is None
+        super().put(value)
+        if not prompt:
+            for token in value.reshape(-1).tolist():
+                self.queue.put(token)
+    
+    def end(self):
+        self.queue.put(None)
+
+class _Cancel(StoppingCriteria):
+    # Stops model.generate after the current token once set, e.g. when the reader of a
+    # streamed reply has gone away
+    def __init__(self):
+        self.event = threading.Event()
+    
+    def set(self):
+        self.event.set()
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def stream_reply(
+    user_text: str,
+    history: list | None = None,
+    system_prompt: str = SYSTEM,
+    max_new_tokens: int = 256,
+    session_id: str | None = None,
+    context: str | None = None,
+    history_budget: int = HISTORY_BUDGET,
+    assisted: bool | None = None,
+):
+    # generate_reply, but as a generator that yields {"token": text} as each piece of the
+    # reply is decoded, then {"done": True, "response", "history", "metrics"} at the end.
+    # Closing it early stops the generation.
+    
+    # Start with empty history if none provided
+    if history is None:
+        history = []
+    prompt_ids, inputs, reused, start, summary = _prepare_turn(user_text, history, system_prompt, session_id, context, history_budget)
+    tokenizer, model = get_tokenizer(), get_model()
+    
+    start_time = time.perf_counter()  # Start measuring generation time
+    request = None
+    cancel = _Cancel()  # Set when we stop reading, so model.generate stops too
+    generated, reply_text = [], ""
+    try:
+        draft = _draft_for(assisted)
+        counter = _ForwardCounter(model, draft)
+        if scheduler.max_batch and draft is None:
+            # Decode alongside the other conversations in the shared batch
+            request = scheduler.submit(prompt_ids, max_new_tokens, inputs.get("past_key_values"), reused, stream=True)
+            tokens = request.tokens
+        else:
+            # Run model.generate in a background thread and read its tokens as they come,
+            # with the draft model proposing tokens when there is one
+            streamer = _TokenQueue()
+            outputs = []  # The finished sequence, for the session cache
+            
+            def run():
+                try:
+                    with torch.no_grad(), counter:
+                        outputs.append(model.generate(
+                            **inputs,
+                            max_new_tokens=max_new_tokens,
+                            temperature=0.7,  # Some randomness in responses
+                            top_p=0.9,  # Nucleus sampling
+                            do_sample=True,  # Enable sampling
+                            streamer=streamer,
+                            stopping_criteria=StoppingCriteriaList([cancel]),
+                            pad_token_id=tokenizer.eos_token_id,
+                            **({"assistant_model": draft} if draft is not None else {})
+                        ))
+                except Exception as e:
+                    outputs.append(e)
+                    streamer.end()
+            
+            threading.Thread(target=run, daemon=True).start()
+            tokens = streamer.queue
+        
+        # Decode the reply so far with every token and pass on whatever text is new
+        # (a character can take more than one token, so wait until it's complete)
+        for token in iter(tokens.get, None):
+            generated.append(token)
+            text = tokenizer.decode(generated, skip_special_tokens=True)
+            if len(text) > len(reply_text) and not text.endswith("\ufffd"):
+                yield {"token": text[len(reply_text):]}
+                reply_text = text
+        end_time = time.perf_counter()  # Stop measuring time
+        
+        if request is not None:
+            if request.error is not None:
+                raise request.error
+            cache, sequence = request.cache, prompt_ids + request.generated
+        else:
+            if not outputs or isinstance(outputs[0], Exception):
+                raise outputs[0] if outputs else RuntimeError("Generation stopped without output")
+            cache, sequence = inputs.get("past_key_values"), outputs[0][0].tolist()
+        if session_id is not None:
+            prompt_cache.put(session_id, system_prompt, sequence, cache)
+        
+        # Calculate performance metrics
+        reply_text = tokenizer.decode(generated, skip_special_tokens=True).strip()
+        metrics = {
+            **_timing_metrics(start_time, end_time, request if request is not None else streamer, len(generated)),
+            "device": _device,
+            "prompt_tokens": len(prompt_ids),
+            "cached_prompt_tokens": reused,  # Prompt tokens taken from the session cache
+            "history_turns_in_prompt": len(history) - start,
+            "summarised": summary is not None,
+            "assisted": draft is not None,
+            **(counter.metrics(len(generated)) if draft is not None else {})
+        }
+        _record_metrics(metrics)
+        
+        # Show performance info
+        print(f"🚀 Generated {metrics['tokens_generated']} tokens in {metrics['generation_time']:.2f}s = "
+              f"{metrics['tokens_per_second']:.1f} tokens/sec on {_device} (first token after {metrics['time_to_first_token']:.2f}s)")
+        
+        # Add response to history and finish
+        history.append({"role": "assistant", "content": reply_text})
+        if session_id is not None:
+            conversation_window.catch_up(history, session_id)
+        yield {"done": True, "response": reply_text, "history": history, "metrics": metrics}
+    
+    except Exception as e:
+        # If something goes wrong, finish with a safe fallback response
+        print(f"Generation error: {e}")
+        fallback_response = "I'm sorry, I'm having trouble processing that right now. Could you try again?"
+        
+        # Create basic metrics for the fallback
+        metrics = {
+            "tokens_generated": 0,  # Nothing came from the model
+            "generation_time": 0.0,
+            "tokens_per_second": 0.0,
+            "device": _device
+        }
+        
+        # Add fallback to history and finish
+        history.append({"role": "assistant", "content": fallback_response})
+        yield {"done": True, "response": fallback_response, "history": history, "metrics": metrics}
+    
+    finally:
+        # If the caller stopped reading (a closed connection), stop decoding for it too
+        cancel.set()
+        if request is not None and not request.done.is_set():
+            request.cancelled = True  # Frees the batch row
 
 def generate_reply(
     user_text: str,
@@ -90,131 +1109,90 @@ def generate_reply(
     system_prompt: str = SYSTEM,
     max_new_tokens: int = 256,
     stream: bool = False,
+    session_id: str | None = None,
+    context: str | None = None,
+    history_budget: int = HISTORY_BUDGET,
+    assisted: bool | None = None,
 ) -> tuple[str, list, dict]:  # Returns response, history, and performance metrics
+    # session_id keeps this conversation's KV cache and summary for the next turn; context
+    # is extra information for this turn only (kept with it in history); history_budget
+    # caps the prompt tokens, older turns beyond it being summarised; assisted turns the
+    # draft model (DRAFT_MODEL_ID) on or off, by default using it when nothing else is running
     
     # Start with empty history if none provided
     if history is None:
         history = []
-
-    # Add the user's message to conversation history
-    history.append({"role": "user", "content": user_text})
     
-    # Build the conversation in the format the model expects
-    dialogue = (
-        "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n"
-        f"{system_prompt}<|eot_id|>"
-    )
+    if stream:
+        # Streaming mode - collect the tokens stream_reply yields as they're generated
+        for event in stream_reply(user_text, history, system_prompt, max_new_tokens, session_id, context, history_budget, assisted):
+            if event.get("done"):
+                return event["response"], event["history"], event["metrics"]
     
-    # Add each turn of the conversation
-    for turn in history:
-        role_tag = "user" if turn["role"] == "user" else "assistant"
-        dialogue += (
-            f"<|start_header_id|>{role_tag}<|end_header_id|>\n"
-            f"{turn['content']}<|eot_id|>"
-        )
+    prompt_ids, inputs, reused, start, summary = _prepare_turn(user_text, history, system_prompt, session_id, context, history_budget)
+    tokenizer, model = get_tokenizer(), get_model()
     
-    # Add the start tag for the assistant's response
-    dialogue += "<|start_header_id|>assistant<|end_header_id|>\n"
-
-    # Convert text to tokens and move to the right device
-    inputs = tokenizer(dialogue, return_tensors="pt").to(_device)
-
     try:
-        if stream:
-            # Streaming mode - get tokens one by one as they're generated
-            streamer = TextIteratorStreamer(
-                tokenizer,
-                skip_prompt=True,  # Don't repeat the input
-                skip_special_tokens=True  # Don't show special tokens
-            )
-            
-            start_time = time.time()  # Start measuring generation time
-            
-            # Set up generation in a separate thread
-            from threading import Thread
-            generation_kwargs = {
-                **inputs,
-                "max_new_tokens": max_new_tokens,
-                "temperature": 0.7,  # Some randomness in responses
-                "top_p": 0.9,  # Nucleus sampling
-                "do_sample": True,  # Enable sampling
-                "streamer": streamer,
-                "pad_token_id": tokenizer.eos_token_id
-            }
-            
-            # Start generation in background thread
-            thread = Thread(target=model.generate, kwargs=generation_kwargs)
-            thread.start()
-            
-            # Collect tokens as they come in
-            reply_text = ""
-            for token in streamer:
-                reply_text += token
-                
-            # Wait for generation to complete
-            thread.join()
-            end_time = time.time()  # Stop measuring time
-            
-            # Calculate performance metrics
-            generation_time = end_time - start_time
-            token_count = count_tokens(reply_text.strip())
-            tokens_per_second = token_count / generation_time if generation_time > 0 else 0
-            
-            metrics = {
-                "tokens_generated": token_count,
-                "generation_time": generation_time,
-                "tokens_per_second": tokens_per_second,
-                "device": _device
-            }
-            
-            # Show performance info
-            print(f"🚀 Generated {token_count} tokens in {generation_time:.2f}s = {tokens_per_second:.1f} tokens/sec on {_device}")
-            
-            # Add response to history and return everything
-            history.append({"role": "assistant", "content": reply_text.strip()})
-            return reply_text.strip(), history, metrics
-            
+        # Non-streaming mode - generate all at once
+        start_time = time.perf_counter()  # Start measuring time
+        
+        draft = _draft_for(assisted)
+        counter = _ForwardCounter(model, draft)
+        if scheduler.max_batch and draft is None:
+            # Decode alongside the other conversations in the shared batch
+            request = scheduler.generate(prompt_ids, max_new_tokens, inputs.get("past_key_values"), reused)
+            output = torch.tensor([prompt_ids + request.generated])
+            inputs["past_key_values"] = request.cache
+            timer = request
         else:
-            # Non-streaming mode - generate all at once
-            start_time = time.time()  # Start measuring time
-            
-            # Generate without keeping gradients (saves memory)
-            with torch.no_grad():
+            timer = _TokenTimer()  # When each token came out
+            # Generate without keeping gradients (saves memory), with the draft model
+            # proposing tokens when there is one
+            with torch.no_grad(), counter:
                 output = model.generate(
                     **inputs,
                     max_new_tokens=max_new_tokens,
                     temperature=0.7,  # Some randomness
                     top_p=0.9,  # Nucleus sampling
                     do_sample=True,  # Enable sampling
-                    pad_token_id=tokenizer.eos_token_id
+                    streamer=timer,
+                    pad_token_id=tokenizer.eos_token_id,
+                    **({"assistant_model": draft} if draft is not None else {})
                 )
-            
-            end_time = time.time()  # Stop measuring time
-            
-            # Extract just the new tokens (not the input)
-            reply_text = tokenizer.decode(
-                output[0][inputs["input_ids"].shape[1]:],  # Skip the input tokens
-                skip_special_tokens=True,  # Don't show special tokens
-            ).strip()
-            
-            # Calculate performance metrics
-            generation_time = end_time - start_time
-            token_count = count_tokens(reply_text)
-            tokens_per_second = token_count / generation_time if generation_time > 0 else 0
-            
-            metrics = {
-                "tokens_generated": token_count,
-                "generation_time": generation_time,
-                "tokens_per_second": tokens_per_second,
-                "device": _device
-            }
-            
-            # Show performance info
-            print(f"🚀 Generated {token_count} tokens in {generation_time:.2f}s = {tokens_per_second:.1f} tokens/sec on {_device}")
-            
-            # Add response to history and return everything
-            history.append({"role": "assistant", "content": reply_text})
-            return reply_text, history, metrics
+        
+        end_time = time.perf_counter()  # Stop measuring time
+        if session_id is not None:
+            prompt_cache.put(session_id, system_prompt, output[0].tolist(), inputs["past_key_values"])
+        
+        # Extract just the new tokens (not the input)
+        reply_text = tokenizer.decode(
+            output[0][inputs["input_ids"].shape[1]:],  # Skip the input tokens
+            skip_special_tokens=True,  # Don't show special tokens
+        ).strip()
+        
+        # Calculate performance metrics, counting the ids the model actually produced
+        token_count = output.shape[1] - inputs["input_ids"].shape[1]
+        metrics = {
+            **_timing_metrics(start_time, end_time, timer, token_count),
+            "device": _device,
+            "prompt_tokens": len(prompt_ids),
+            "cached_prompt_tokens": reused,  # Prompt tokens taken from the session cache
+            "history_turns_in_prompt": len(history) - start,
+            "summarised": summary is not None,
+            "assisted": draft is not None,
+            **(counter.metrics(token_count) if draft is not None else {})
+        }
+        _record_metrics(metrics)
+        
+        # Show performance info
+        print(f"🚀 Generated {token_count} tokens in {metrics['generation_time']:.2f}s = "
+              f"{metrics['tokens_per_second']:.1f} tokens/sec on {_device} (first token after {metrics['time_to_first_token']:.2f}s)")
+        
+        # Add response to history and return everything
+        history.append({"role": "assistant", "content": reply_text})
+        if session_id is not None:
+            conversation_window.catch_up(history, session_id)
+        return reply_text, history, metrics
             
     except Exception as e:
         # If something goes wrong, return a safe fallback response
@@ -223,7 +1201,7 @@ def generate_reply(
         
         # Create basic metrics for the fallback
         metrics = {
-            "tokens_generated": count_tokens(fallback_response),
+            "tokens_generated": 0,  # Nothing came from the model
             "generation_time": 0.0,
             "tokens_per_second": 0.0,
             "device": _device
@@ -238,4 +1216,98 @@ def generate_reply(
         print(f"Generation error: {e}")
         fallback_response = "I'm sorry, I'm having trouble processing that right now. Could you try again?"
         history.append({"role": "assistant", "content": fallback_response})
-        return fallback_response, history
\ No newline at end of file
+        return fallback_response, history
+
+def _tensor_bytes(tensors, seen) -> int:
+    # Bytes held by some tensors, counting shared storage once. Quantized tensor subclasses
+    # (torchao's) are measured by the packed tensors inside them, and int8-dynamic's packed
+    # weights come out of state_dict as (weight, bias) tuples.
+    total = 0
+    for tensor in tensors:
+        if isinstance(tensor, (tuple, list)):
+            total += _tensor_bytes(tensor, seen)
+        elif not isinstance(tensor, torch.Tensor):
+            continue
+        elif hasattr(tensor, "__tensor_flatten__"):
+            names, _ = tensor.__tensor_flatten__()
+            total += _tensor_bytes([getattr(tensor, name) for name in names], seen)
+        elif tensor.data_ptr() not in seen:
+            seen.add(tensor.data_ptr())
+            total += tensor.numel() * tensor.element_size()
+    return total
+
+def _weights_mb(model):
+    # Size of a model's weights and buffers as loaded. Unlike the process's RSS this is
+    # per model - it doesn't include the models loaded before it or allocator leftovers.
+    return _tensor_bytes(list(model.state_dict(keep_vars=True).values()), set()) / 1024 / 1024
+
+def check_quantization(modes=CPU_QUANT_MODES, max_new_tokens=48) -> list[dict]:
+    # Speed, memory and quality of each CPU mode on QUANT_CHECK_PROMPTS. Quality is
+    # measured on fp32's own greedy replies: how often the mode's top next token matches
+    # fp32's, and its perplexity on those replies relative to fp32's (1.0 = identical).
+    tokenizer = get_tokenizer()
+    prompts = [build_prompt([{"role": "user", "content": prompt}]) for prompt in QUANT_CHECK_PROMPTS]
+    reference, reference_nll = None, None
+    results = []
+    
+    for mode in ["fp32"] + [mode for mode in modes if mode != "fp32"]:
+        try:
+            start = time.perf_counter()
+            if mode == "fp32":
+                model = AutoModelForCausalLM.from_pretrained(MODEL_ID, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+            else:
+                model = load_cpu_model(MODEL_ID, mode)
+            model.eval()
+            load_seconds = time.perf_counter() - start
+            
+            replies, seconds, nll, agree, total = [], 0.0, 0.0, 0, 0
+            with torch.no_grad():
+                for i, ids in enumerate(prompts):
+                    input_ids = torch.tensor([ids])
+                    start = time.perf_counter()
+                    output = model.generate(
+                        input_ids=input_ids,
+                        attention_mask=torch.ones_like(input_ids),
+                        max_new_tokens=max_new_tokens,
+                        do_sample=False,  # Greedy, so modes are compared like for like
+                        pad_token_id=tokenizer.eos_token_id
+                    )
+                    seconds += time.perf_counter() - start
+                    replies.append(output[0][len(ids):].tolist())
+                    
+                    # Score fp32's reply with this model
+                    target = reference[i] if reference is not None else replies[-1]
+                    if not target:
+                        continue
+                    logits = model(torch.tensor([ids + target])).logits[0, len(ids) - 1:-1].float()
+                    targets = torch.tensor(target)
+                    agree += int((logits.argmax(dim=-1) == targets).sum())
+                    nll += float(torch.nn.functional.cross_entropy(logits, targets, reduction="sum"))
+                    total += len(target)
+            
+            if reference is None:
+                reference, reference_nll = replies, nll / max(total, 1)
+            result = {
+                "mode": mode,
+                "load_seconds": load_seconds,
+                "tokens_per_second": sum(len(reply) for reply in replies) / seconds if seconds else 0.0,
+                "weights_mb": _weights_mb(model),
+                "top1_agreement": agree / max(total, 1),
+                "perplexity_ratio": math.exp(nll / max(total, 1) - reference_nll)
+            }
+            results.append(result)
+            print(f"📊 {mode:>12}: {result['tokens_per_second']:.1f} tokens/sec, {result['weights_mb']:.0f} MB weights, "
+                  f"top-1 agreement {result['top1_agreement']:.3f}, perplexity x{result['perplexity_ratio']:.3f}")
+        except Exception as e:
+            print(f"⚠️ {mode} check failed: {e}")
+        finally:
+            model = None
+            gc.collect()  # Free one model before loading the next
+    return results
+
+# Run directly to compare the CPU quantization modes: python LLM.py quant-check [modes...]
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "quant-check":
+        check_quantization(sys.argv[2:] or CPU_QUANT_MODES)
+    else:
+        print(f"Usage: python LLM.py quant-check [{' '.join(CPU_QUANT_MODES)}]")
\ No newline at end of file
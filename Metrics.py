@@ -0,0 +1,68 @@
+from collections import deque
+import threading
+import json
+import math
+
+# Per-turn timings and counts summarised by PercentileSink
+TURN_FIELDS = ("time_to_first_token", "prefill_time", "queue_time", "generation_time",
+               "tokens_per_second", "prompt_tokens", "tokens_generated")
+
+def percentile(values, q) -> float | None:
+    # The q-th percentile (0-100) of some numbers, interpolating between neighbours
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+def describe(values, quantiles=(50, 90, 99)) -> dict:
+    # count, mean, max and percentiles of some numbers
+    values = list(values)
+    summary = {"count": len(values), "mean": sum(values) / len(values) if values else None, "max": max(values, default=None)}
+    for q in quantiles:
+        summary[f"p{q}"] = percentile(values, q)
+    return summary
+
+class MetricsSink:
+    # Somewhere generation metrics go after each reply - LLM.add_metrics_sink(sink) to
+    # plug one in. `metrics` is the dict generate_reply returns, including
+    # "token_latencies" (seconds between consecutive generated tokens).
+    def record(self, metrics: dict):
+        raise NotImplementedError
+
+class PercentileSink(MetricsSink):
+    # Percentiles across recent replies: the last `max_turns` replies' timings, and the
+    # gaps between their tokens pooled together (up to `max_token_samples`)
+    def __init__(self, max_turns=1000, max_token_samples=50_000):
+        self.turns = deque(maxlen=max_turns)
+        self.token_latencies = deque(maxlen=max_token_samples)
+        self.lock = threading.Lock()
+        self.recorded = 0
+    
+    def record(self, metrics: dict):
+        turn = {field: metrics[field] for field in TURN_FIELDS if metrics.get(field) is not None}
+        with self.lock:
+            self.turns.append(turn)
+            self.token_latencies.extend(metrics.get("token_latencies") or [])
+            self.recorded += 1
+    
+    def summary(self) -> dict:
+        with self.lock:
+            turns, latencies = list(self.turns), list(self.token_latencies)
+            recorded = self.recorded
+        summary = {"turns": recorded}
+        for field in TURN_FIELDS:
+            summary[field] = describe(turn[field] for turn in turns if field in turn)
+        summary["inter_token_latency"] = describe(latencies)
+        return summary
+
+class JsonlSink(MetricsSink):
+    # Appends each reply's metrics to a JSON lines file, for analysis elsewhere
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+    
+    def record(self, metrics: dict):
+        with self.lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(metrics) + "\n")
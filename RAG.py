@@ -1,50 +1,1349 @@
-from langchain_core.documents import Document  # For storing text with metadata
-from langchain_community.vectorstores import FAISS  # Vector database for similarity search
 from langchain_huggingface import HuggingFaceEmbeddings  # Converts text to vectors
+from langchain_core.embeddings import Embeddings
 from pathlib import Path
 import json
-from datetime import datetime
+import os
+import re
+import sys
+import platform  # Picks the int8 kernels for ONNX quantization
+import base64  # For reading vectors out of old write-ahead log segments
+import pickle  # Only for migrating old index.pkl stores
+import sqlite3  # Document and metadata store
+import threading
+import time
+import atexit  # Last write of pending memories on exit
+import operator
+from datetime import datetime, timedelta
 import uuid  # For generating unique IDs
+import hashlib  # For content-hash cache keys
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import faiss
+
+# Metadata fields with their own indexed column in memories.db, usable in `where` filters
+FILTER_FIELDS = ("timestamp", "source", "importance", "category")
+
+# Filter operators and the SQL they map to
+FILTER_OPS = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<=", "$in": "IN"}
+
+# Errors SQLite (or json.dumps) raises for a row it can't store - unlike a locked or full
+# database, retrying the same row won't help
+ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.ProgrammingError, TypeError, ValueError)
+
+def _column_value(value):
+    # A metadata value as its filter column stores it: text, a number or NULL. Timestamps
+    # become text; anything else (a list, a dict) is stored as JSON so the write can't fail.
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, datetime):
+        return str(value)
+    return json.dumps(value, default=str)
+
+# Metadata fields holding when something happened, stored as naive local ISO time like
+# str(datetime.now()) so they compare and sort correctly as text
+TIME_FIELDS = ("timestamp", "last_seen")
+
+def _local_time(value):
+    # A timestamp as a naive local datetime (an aware one is converted), or None if it isn't one
+    try:
+        moment = value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    return moment
+
+def _check_metadata(metadata: dict) -> dict:
+    # Make the filterable fields of new metadata text or numbers: datetimes are stored as
+    # text, and a list or dict is rejected with ValueError since it couldn't be filtered on.
+    # Timestamps become naive local time; one that can't be parsed is a ValueError too.
+    for field in TIME_FIELDS:
+        if metadata.get(field) is not None:
+            moment = _local_time(metadata[field])
+            if moment is None:
+                raise ValueError(f"Metadata field '{field}' isn't an ISO timestamp: {metadata[field]!r}")
+            metadata[field] = str(moment)
+    for field in FILTER_FIELDS:
+        value = metadata.get(field)
+        if isinstance(value, datetime):
+            metadata[field] = str(value)
+        elif not (value is None or isinstance(value, (str, int, float))):
+            raise ValueError(f"Metadata field '{field}' must be text or a number, not {type(value).__name__}")
+    return metadata
+
+# The same operators in Python, for memories that haven't reached the database yet
+FILTER_TESTS = {
+    "$eq": operator.eq, "$ne": operator.ne, "$gt": operator.gt, "$gte": operator.ge,
+    "$lt": operator.lt, "$lte": operator.le, "$in": lambda value, options: value in options
+}
+
+def matches_filter(metadata: dict, where: dict) -> bool:
+    # Whether a memory's metadata passes a `where` filter, with the same rules as the SQL
+    # (a missing field matches nothing except $ne)
+    for field, condition in where.items():
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Can't filter on '{field}' - filterable fields are {', '.join(FILTER_FIELDS)}")
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        value = metadata.get(field)
+        for op, expected in condition.items():
+            if op not in FILTER_TESTS:
+                raise ValueError(f"Unknown filter operator '{op}' - use one of {', '.join(FILTER_OPS)}")
+            if value is None:
+                if op == "$ne":
+                    continue
+                return False
+            if op == "$in":
+                expected = [str(v) if isinstance(v, datetime) else v for v in expected]
+            elif isinstance(expected, datetime):
+                expected = str(expected)  # Timestamps are stored as text
+            try:
+                if not FILTER_TESTS[op](value, expected):
+                    return False
+            except TypeError:
+                return False  # e.g. comparing text with a number
+    return True
+
+# Words left out of keyword searches - they match most memories, which makes BM25 score
+# thousands of rows per query while adding nothing to the ranking
+STOPWORDS = frozenset("""
+    a about after again all am an and any are as at be been before being but by can could
+    did do does doing for from had has have having he her here hers him his how i if in into
+    is it its me more most my no nor not of on or our ours she should so some such than that
+    the their them then there these they this those to too up very was we were what when
+    where which while who whom why will with would you your yours tell remember know
+""".split())
+
+# Most memories a word can match and still be ranked on in keyword searches
+KEYWORD_MATCH_LIMIT = 1000
+
+# When a new fact updates a near-identical memory rather than being a different fact.
+# Sentence embeddings score different facts about the same thing ("my son lives in Leeds",
+# "my daughter lives in Leeds") very close together, so similarity alone would merge them.
+# An update keeps the subject - the first DEDUP_SUBJECT_WORDS meaningful words, like
+# "sister lives" - changes only what follows, and shares DEDUP_WORD_OVERLAP of its words.
+DEDUP_SUBJECT_WORDS = 2
+DEDUP_WORD_OVERLAP = 0.5
+
+# Pairs of facts and whether the second should replace the first - python RAG.py dedup-check
+DEDUP_CHECK_CASES = [
+    ("My sister lives in Leeds", "my sister lives in Leeds!", True),
+    ("My sister lives in Leeds", "My sister lives in York", True),
+    ("My son lives in Leeds", "My daughter lives in Leeds", False),
+    ("My cat is called Max", "My dog is called Max", False),
+    ("My sister Sarah lives in Leeds", "My sister Anna lives in Leeds", False),
+    ("My sister lives in York", "My sister works in York", False),
+    ("I love tea", "I love coffee", False),
+    ("My sister lives in Leeds", "My sister lives near the sea and loves swimming", False),
+]
+
+def _words(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+def _same_words(a: str, b: str) -> bool:
+    # Whether two facts are worded the same, ignoring case and punctuation
+    return _words(a) == _words(b)
+
+def _word_overlap(a: str, b: str) -> float:
+    # Share of the meaningful (non-stopword) words two facts have in common
+    words_a = set(_words(a)) - STOPWORDS
+    words_b = set(_words(b)) - STOPWORDS
+    if not words_a and not words_b:
+        return 1.0
+    return len(words_a & words_b) / len(words_a | words_b)
+
+def _restates(old: str, new: str) -> bool:
+    # Whether `new` repeats `old` or updates it (see DEDUP_SUBJECT_WORDS), rather than
+    # being a different fact that happens to embed close to it
+    if _same_words(old, new):
+        return True
+    old_words = [word for word in _words(old) if word not in STOPWORDS]
+    new_words = [word for word in _words(new) if word not in STOPWORDS]
+    if len(old_words) <= DEDUP_SUBJECT_WORDS or old_words[:DEDUP_SUBJECT_WORDS] != new_words[:DEDUP_SUBJECT_WORDS]:
+        return False
+    return _word_overlap(old, new) >= DEDUP_WORD_OVERLAP
+
+def check_dedup(cases=DEDUP_CHECK_CASES) -> list:
+    # Run the duplicate rules over known pairs; returns the ones they get wrong
+    wrong = [(old, new, expected) for old, new, expected in cases if _restates(old, new) != expected]
+    for old, new, expected in cases:
+        mark = "❌" if (old, new, expected) in wrong else "✅"
+        print(f"{mark} '{old}' -> '{new}': {'replaces' if expected else 'kept separately'}")
+    return wrong
+
+# Runs the keyword half of hybrid searches alongside the vector half (shared by all stores)
+KEYWORD_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="keyword-search")
+
+class MemoryDB:
+    # SQLite home for memory text, metadata and the exact float32 vectors.
+    # Documents are fetched by id only when a search returns them, so opening a store
+    # reads nothing up front, and every add is one appended row - with SQLite's own
+    # write-ahead journal that makes the database the durable log for new memories too.
+    def __init__(self, file):
+        self.file = Path(file)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.file), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")  # Appends go to SQLite's write-ahead log
+        self.conn.execute("PRAGMA synchronous=FULL")  # Every commit reaches the disk
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS memories (
+                    id INTEGER PRIMARY KEY,  -- Also the vector's id in the FAISS index
+                    uid TEXT UNIQUE NOT NULL,  -- The uuid kept in the metadata
+                    content TEXT NOT NULL,
+                    metadata TEXT NOT NULL,  -- JSON
+                    vector BLOB NOT NULL  -- float32 bytes
+                )
+            """)
+            # Memories deleted since the last snapshot - their vectors are still in vectors.faiss
+            self.conn.execute("CREATE TABLE IF NOT EXISTS removed (id INTEGER PRIMARY KEY)")
+            self._upgrade()
+            self.keywords = self.conn.execute("PRAGMA user_version").fetchone()[0] >= 3  # Keyword index available
+    
+    def _upgrade(self):
+        # Bring older databases up to date (transaction held by the caller)
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            # Metadata index: the fields we filter on get their own indexed columns,
+            # filled from the JSON for rows written before they existed
+            for field in FILTER_FIELDS:
+                self.conn.execute(f"ALTER TABLE memories ADD COLUMN {field}")
+                self.conn.execute(f"UPDATE memories SET {field} = json_extract(metadata, '$.{field}')")
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS memories_{field} ON memories ({field})")
+        if version < 2:
+            # Lifecycle: how often and when each memory was recalled, and a table for
+            # memories taken out of the index (kept, so nothing is lost for good)
+            self.conn.execute("ALTER TABLE memories ADD COLUMN access_count INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("ALTER TABLE memories ADD COLUMN last_access TEXT")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS archive (
+                    id INTEGER PRIMARY KEY,
+                    uid TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    metadata TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    archived TEXT NOT NULL,  -- When it left the store
+                    reason TEXT NOT NULL  -- "decayed", "expired", "over_limit" or "consolidated"
+                )
+            """)
+        if version < 3:
+            # Keyword index: an FTS5 table (BM25 ranking) over the memory text, kept in step
+            # with the memories table by triggers so every add and delete updates it
+            try:
+                self.conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5("
+                    "content, content='memories', content_rowid='id', tokenize='porter unicode61')"
+                )
+                self.conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS memories_fts_insert AFTER INSERT ON memories BEGIN
+                        INSERT INTO memories_fts (rowid, content) VALUES (new.id, new.content);
+                    END
+                """)
+                self.conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS memories_fts_delete AFTER DELETE ON memories BEGIN
+                        INSERT INTO memories_fts (memories_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                    END
+                """)
+                self.conn.execute("""
+                    CREATE TRIGGER IF NOT EXISTS memories_fts_update AFTER UPDATE OF content ON memories BEGIN
+                        INSERT INTO memories_fts (memories_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                        INSERT INTO memories_fts (rowid, content) VALUES (new.id, new.content);
+                    END
+                """)
+                self.conn.execute("INSERT INTO memories_fts (memories_fts) VALUES ('rebuild')")  # Index existing rows
+            except sqlite3.OperationalError as e:
+                # SQLite built without FTS5 - search stays vector-only, and we try again next time
+                print(f"Keyword index unavailable: {e}")
+                self.conn.execute("PRAGMA user_version = 2")
+                return
+        self.conn.execute("PRAGMA user_version = 3")
+    
+    def insert(self, rows):
+        # rows: (id, uid, content, metadata dict, vector) - written in one transaction
+        columns = ", ".join(FILTER_FIELDS)
+        marks = ", ".join("?" * len(FILTER_FIELDS))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT INTO memories (id, uid, content, metadata, vector, {columns}) VALUES (?, ?, ?, ?, ?, {marks})",
+                [(i, uid, content, json.dumps(metadata), np.asarray(vector, dtype=np.float32).tobytes(),
+                  *(_column_value(metadata.get(field)) for field in FILTER_FIELDS))
+                 for i, uid, content, metadata, vector in rows]
+            )
+    
+    def _filter_sql(self, where: dict):
+        # SQL conditions and parameters for a metadata filter
+        clauses, params = [], []
+        for field, condition in where.items():
+            if field not in FILTER_FIELDS:
+                raise ValueError(f"Can't filter on '{field}' - filterable fields are {', '.join(FILTER_FIELDS)}")
+            # A bare value means equality, otherwise {"$op": value, ...}
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for op, value in condition.items():
+                if op not in FILTER_OPS:
+                    raise ValueError(f"Unknown filter operator '{op}' - use one of {', '.join(FILTER_OPS)}")
+                if op == "$in":
+                    values = [str(v) if isinstance(v, datetime) else v for v in value]
+                    clauses.append(f"{field} IN ({','.join('?' * len(values))})")
+                    params.extend(values)
+                elif op == "$ne":
+                    # SQL's != is never true for NULL, but a memory without the field isn't equal to it
+                    clauses.append(f"({field} IS NULL OR {field} != ?)")
+                    params.append(str(value) if isinstance(value, datetime) else value)
+                else:
+                    clauses.append(f"{field} {FILTER_OPS[op]} ?")
+                    params.append(str(value) if isinstance(value, datetime) else value)  # Timestamps are stored as text
+        return clauses, params
+    
+    def filter_ids(self, where: dict) -> np.ndarray:
+        # Ids of memories matching a metadata filter, answered from the column indexes
+        clauses, params = self._filter_sql(where)
+        query = "SELECT id FROM memories" + (" WHERE " + " AND ".join(clauses) if clauses else "")
+        with self.lock:
+            return np.array([row[0] for row in self.conn.execute(query, params)], dtype=np.int64)
+    
+    def keyword_search(self, query: str, k: int, where: dict | None = None) -> list[tuple[int, float]]:
+        # BM25 keyword matches as (id, score), best first (FTS5 scores are negative - lower is better)
+        words = list(dict.fromkeys(word for word in re.findall(r"\w+", query.lower()) if word not in STOPWORDS))
+        if not self.keywords or not words:
+            return []
+        
+        # BM25 scores every memory that matches, so only rank on the selective words: those
+        # in at most KEYWORD_MATCH_LIMIT memories, or else just the rarest one
+        with self.lock:
+            counts = {
+                word: self.conn.execute("SELECT COUNT(*) FROM memories_fts WHERE memories_fts MATCH ?", (f'"{word}"',)).fetchone()[0]
+                for word in words
+            }
+        words = [word for word in words if counts[word]]
+        if not words:
+            return []
+        words = [word for word in words if counts[word] <= KEYWORD_MATCH_LIMIT] or [min(words, key=counts.get)]
+        match = " OR ".join(f'"{word}"' for word in words)  # Any of the words, quoted so none reads as syntax
+        clauses, params = self._filter_sql(where or {})
+        sql = (
+            "SELECT memories.id, bm25(memories_fts) AS score FROM memories_fts "
+            "JOIN memories ON memories.id = memories_fts.rowid WHERE memories_fts MATCH ?"
+            + "".join(f" AND {clause}" for clause in clauses)
+            + " ORDER BY score LIMIT ?"
+        )
+        with self.lock:
+            return [(row_id, score) for row_id, score in self.conn.execute(sql, (match, *params, k))]
+    
+    def vectors_for(self, ids):
+        # Exact vectors for specific ids as (ids, matrix)
+        found_ids, found = [], []
+        ids = [int(i) for i in ids]
+        with self.lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cursor = self.conn.execute(
+                    f"SELECT id, vector FROM memories WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                )
+                for row_id, vector in cursor:
+                    found_ids.append(row_id)
+                    found.append(np.frombuffer(vector, dtype=np.float32))
+        return np.array(found_ids, dtype=np.int64), np.vstack(found) if found else None
+    
+    def fetch(self, ids) -> dict:
+        # Load documents by id: {id: {"content": ..., "metadata": ...}}
+        found = {}
+        ids = [int(i) for i in ids]
+        with self.lock:
+            # Stay under SQLite's limit on query parameters
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                cursor = self.conn.execute(
+                    f"SELECT id, content, metadata FROM memories WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                )
+                for row_id, content, metadata in cursor:
+                    found[row_id] = {"content": content, "metadata": json.loads(metadata)}
+        return found
+    
+    def documents(self, page_size=1000, vectors=False):
+        # Every document, oldest first, read one page at a time (with its vector bytes if asked)
+        last_id = 0
+        while True:
+            with self.lock:
+                page = self.conn.execute(
+                    f"SELECT id, content, metadata{', vector' if vectors else ''} FROM memories WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, page_size)
+                ).fetchall()
+            if not page:
+                return
+            for row in page:
+                doc = {"content": row[1], "metadata": json.loads(row[2])}
+                if vectors:
+                    doc["vector"] = row[3]
+                yield row[0], doc
+            last_id = page[-1][0]
+    
+    def page(self, cursor=None, limit=20, newest_first=True) -> list:
+        # One page of (id, document) in insertion order, starting after `cursor` (an id).
+        # Keyset pagination on the primary key, so any page costs the same.
+        if newest_first:
+            condition, order = ("WHERE id < ?" if cursor is not None else ""), "DESC"
+        else:
+            condition, order = ("WHERE id > ?" if cursor is not None else ""), "ASC"
+        params = ([cursor] if cursor is not None else []) + [limit]
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT id, content, metadata FROM memories {condition} ORDER BY id {order} LIMIT ?", params
+            ).fetchall()
+        return [(row_id, {"content": content, "metadata": json.loads(metadata)}) for row_id, content, metadata in rows]
+    
+    def existing_uids(self, uids) -> set:
+        # Which of these memory uuids are already stored
+        found = set()
+        uids = list(uids)
+        with self.lock:
+            for start in range(0, len(uids), 500):
+                chunk = uids[start:start + 500]
+                cursor = self.conn.execute(f"SELECT uid FROM memories WHERE uid IN ({','.join('?' * len(chunk))})", chunk)
+                found.update(row[0] for row in cursor)
+        return found
+    
+    def vectors(self, after_id=0, up_to_id=None, page_size=10_000):
+        # Stored vectors in id order as (ids, matrix) pages
+        last_id = after_id
+        up_to_id = sys.maxsize if up_to_id is None else up_to_id
+        while True:
+            with self.lock:
+                page = self.conn.execute(
+                    "SELECT id, vector FROM memories WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                    (last_id, up_to_id, page_size)
+                ).fetchall()
+            if not page:
+                return
+            ids = np.array([row[0] for row in page], dtype=np.int64)
+            vectors = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in page])
+            yield ids, vectors
+            last_id = page[-1][0]
+    
+    def dimension(self):
+        # Vector size of the stored memories, or None for an empty store
+        with self.lock:
+            row = self.conn.execute("SELECT vector FROM memories LIMIT 1").fetchone()
+        return len(row[0]) // 4 if row else None
+    
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+    
+    def max_id(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM memories").fetchone()[0]
+    
+    def removed_ids(self) -> set:
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT id FROM removed")}
+    
+    def update_metadata(self, updates: dict):
+        # Replace memories' metadata ({id: metadata}), keeping the filter columns in step
+        assignments = ", ".join(f"{field} = ?" for field in FILTER_FIELDS)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"UPDATE memories SET metadata = ?, {assignments} WHERE id = ?",
+                [(json.dumps(metadata), *(_column_value(metadata.get(field)) for field in FILTER_FIELDS), int(row_id))
+                 for row_id, metadata in updates.items()]
+            )
+    
+    def record_access(self, accesses: dict):
+        # Add recall counts: {id: (times recalled, last recalled)}
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE memories SET access_count = access_count + ?, last_access = ? WHERE id = ?",
+                [(count, last, int(row_id)) for row_id, (count, last) in accesses.items()]
+            )
+    
+    def lifecycle_rows(self, page_size=10_000):
+        # What the lifecycle scoring needs for every memory, one page at a time:
+        # (id, timestamp, importance, access_count, last_access, last_seen, source)
+        last_id = 0
+        while True:
+            with self.lock:
+                page = self.conn.execute(
+                    "SELECT id, timestamp, importance, access_count, last_access, "
+                    "json_extract(metadata, '$.last_seen'), source FROM memories WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, page_size)
+                ).fetchall()
+            if not page:
+                return
+            yield page
+            last_id = page[-1][0]
+    
+    def archive(self, ids, reason) -> list[int]:
+        # Move memories to the archive table and mark their vectors for removal from the
+        # snapshot, all in one transaction. Returns the ids that were moved - ids with no
+        # row here (e.g. a memory not written yet) are left alone.
+        ids = [int(i) for i in ids]
+        now = str(datetime.now())
+        moved = []
+        with self.lock, self.conn:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                chunk = [row[0] for row in self.conn.execute(f"SELECT id FROM memories WHERE id IN ({marks})", chunk)]
+                if not chunk:
+                    continue
+                marks = ",".join("?" * len(chunk))
+                self.conn.execute(
+                    f"INSERT OR REPLACE INTO archive (id, uid, content, metadata, vector, archived, reason) "
+                    f"SELECT id, uid, content, metadata, vector, ?, ? FROM memories WHERE id IN ({marks})",
+                    (now, reason, *chunk)
+                )
+                self.conn.execute(f"DELETE FROM memories WHERE id IN ({marks})", chunk)
+                self.conn.executemany("INSERT OR IGNORE INTO removed (id) VALUES (?)", [(i,) for i in chunk])
+                moved.extend(chunk)
+        return moved
+    
+    def archived_count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM archive").fetchone()[0]
+    
+    def clear_removed(self, ids):
+        # Forget deletions that a new snapshot has taken care of
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM removed WHERE id = ?", [(int(i),) for i in ids])
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class CachedEmbeddings(Embeddings):
+    # Wraps an embeddings model with a content-hash keyed cache:
+    #  1. an in-process LRU of recent vectors
+    #  2. an optional memory-mapped file per model that survives restarts
+    # HuggingFaceEmbeddings embeds queries and documents the same way, so one cache
+    # serves both - a fact stored by add_fact is a cache hit when recall searches for it.
+    def __init__(self, inner, max_entries=4096, disk_folder=None, disk_entries=100_000):
+        self.inner = inner
+        self.model_name = getattr(inner, "model_name", type(inner).__name__)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.lru = OrderedDict()  # key -> vector, most recently used last
+        
+        # Hit/miss counters reported through EchoMemory.get_memory_stats()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        
+        # The disk tier is opened lazily once we know the vector size
+        self.disk_folder = Path(disk_folder) if disk_folder else None
+        self.disk_entries = disk_entries
+        self.disk = None  # Structured memmap of (key, vector) slots
+        self.disk_head = None  # Next slot to overwrite (ring buffer)
+        self.disk_slots = {}  # key -> slot
+        if self.disk_folder and (self.disk_folder / f"{self._file_stem()}.head").exists():
+            try:
+                self._open_disk(None)
+            except Exception as e:
+                print(f"Embedding disk cache unavailable: {e}")
+                self.disk_folder = None
+    
+    def _file_stem(self):
+        # One cache file per model, so switching models never mixes vectors
+        return self.model_name.replace("/", "__")
+    
+    def _open_disk(self, dimension):
+        # Map the cache files into memory, creating them on first use
+        self.disk_folder.mkdir(parents=True, exist_ok=True)
+        stem = self._file_stem()
+        head_file = self.disk_folder / f"{stem}.head"
+        if head_file.exists():
+            # Header layout: [next slot, vector size, capacity]
+            self.disk_head = np.memmap(head_file, dtype=np.int64, mode="r+", shape=(3,))
+            dimension, self.disk_entries = int(self.disk_head[1]), int(self.disk_head[2])
+            mode = "r+"
+        else:
+            self.disk_head = np.memmap(head_file, dtype=np.int64, mode="w+", shape=(3,))
+            self.disk_head[:] = [0, dimension, self.disk_entries]
+            mode = "w+"
+        
+        slot_type = np.dtype([("key", "S40"), ("vector", np.float32, (dimension,))])
+        self.disk = np.memmap(self.disk_folder / f"{stem}.cache", dtype=slot_type, mode=mode, shape=(self.disk_entries,))
+        
+        # Rebuild the key lookup from the filled slots
+        keys = self.disk["key"]
+        self.disk_slots = {key.decode("ascii"): slot for slot, key in enumerate(keys) if key}
+    
+    def _key(self, text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+    
+    def _lookup(self, key):
+        # Check the in-process LRU, then the disk tier
+        vector = self.lru.get(key)
+        if vector is not None:
+            self.lru.move_to_end(key)
+            self.memory_hits += 1
+            return vector
+        
+        if self.disk is not None:
+            slot = self.disk_slots.get(key)
+            if slot is not None:
+                vector = self.disk["vector"][slot].tolist()
+                self._remember(key, vector)
+                self.disk_hits += 1
+                return vector
+        
+        self.misses += 1
+        return None
+    
+    def _remember(self, key, vector):
+        # Put a vector in the LRU, evicting the least recently used one when full
+        self.lru[key] = vector
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.max_entries:
+            self.lru.popitem(last=False)
+    
+    def _store(self, key, vector):
+        # Save a freshly computed vector in both tiers
+        self._remember(key, vector)
+        if self.disk_folder is None:
+            return
+        try:
+            if self.disk is None:
+                self._open_disk(len(vector))
+            
+            # Overwrite the oldest slot once the file is full
+            slot = int(self.disk_head[0]) % self.disk_entries
+            old_key = self.disk["key"][slot]
+            if old_key:
+                self.disk_slots.pop(old_key.decode("ascii"), None)
+            
+            # Clear the key before writing the vector so a crash can't pair a key with the wrong vector
+            self.disk["key"][slot] = b""
+            self.disk["vector"][slot] = vector
+            self.disk["key"][slot] = key.encode("ascii")
+            self.disk_slots[key] = slot
+            self.disk_head[0] = slot + 1
+        except Exception as e:
+            print(f"Embedding disk cache write failed: {e}")
+    
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._key(text) for text in texts]
+        vectors = [None] * len(texts)
+        
+        with self.lock:
+            for i, key in enumerate(keys):
+                vectors[i] = self._lookup(key)
+        
+        # Embed all the misses in a single model call
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            fresh = self.inner.embed_documents([texts[i] for i in missing])
+            with self.lock:
+                for i, vector in zip(missing, fresh):
+                    vector = list(vector)
+                    self._store(keys[i], vector)
+                    vectors[i] = vector
+        return vectors
+    
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+    
+    def stats(self) -> dict:
+        # Cache counters for the memory stats
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "model": self.model_name,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self.lru),
+            "disk_entries": len(self.disk_slots)
+        }
+
+
+# Starting guess at the search effort for a recall target - (recall target, HNSW efSearch,
+# IVF nprobe), first row that meets the target wins - used until a snapshot is calibrated
+SEARCH_EFFORT = [
+    (0.80, 16, 4),
+    (0.90, 32, 8),
+    (0.95, 64, 16),
+    (0.99, 128, 48),
+    (1.00, 256, 128),
+]
+
+# Efforts tried when calibrating a snapshot, cheapest first: (HNSW efSearch, IVF nprobe)
+EFFORT_LADDER = [(16, 4), (32, 8), (64, 16), (128, 32), (256, 64), (512, 128), (1024, 256)]
+
+# Search effort for duplicate checks - a near-identical vector is the easiest neighbour
+# to find, so they don't need the calibrated effort recall uses
+DEDUP_EFFORT = (32, 8)
+
+# Nearest memories checked for being the one a new fact repeats or updates
+DEDUP_CANDIDATES = 4
+
+# Calibration measures recall@CALIBRATION_K for this many stored vectors used as queries
+CALIBRATION_QUERIES = 200
+CALIBRATION_K = 10
+
+def index_kind(index) -> str:
+    # Name the FAISS index family: "flat", "hnsw" or "ivfpq"
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)  # Look through the id wrapper
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivfpq"
+    return "flat"
+
+# How snapshot vectors can be stored: full float32, float16 (half the memory) or 8-bit
+# scalar quantization (a quarter) - searches over the compressed ones are re-ranked with
+# the exact vectors from memories.db
+VECTOR_CODECS = {"fp32": None, "fp16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}
+
+def index_codec(index) -> str:
+    # How an index stores its vectors: "fp32", "fp16", "sq8" or "pq" (IVF-PQ)
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)  # The graph keeps its vectors in a storage index
+    if isinstance(index, faiss.IndexIVF):
+        return "pq"
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return next((name for name, qtype in VECTOR_CODECS.items() if qtype == index.sq.qtype), "sq")
+    return "fp32"
+
+def reconstruct_rows(index, start, count) -> np.ndarray:
+    # Read stored vectors back out of any of our index types
+    if count <= 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()  # IVF lists need a row -> list map to reconstruct
+    return index.reconstruct_n(start, count)
+
+def read_snapshot(file):
+    # Open a vectors.faiss snapshot memory-mapped where FAISS supports it (flat and HNSW
+    # storage), so startup time and RSS don't grow with the number of memories
+    mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if mmap_flag is not None:
+        try:
+            return faiss.read_index(str(file), mmap_flag | faiss.IO_FLAG_READ_ONLY)
+        except Exception:
+            pass  # Older FAISS or an index type it can't map
+    return faiss.read_index(str(file))
+
+class VectorIndex:
+    # The FAISS side of a memory store, in two parts:
+    #  - base: the last snapshot (vectors.faiss), opened read-only and memory-mapped
+    #  - delta: a small in-RAM flat index for memories added since that snapshot
+    # Both return MemoryDB ids, and searches merge the two result lists.
+    def __init__(self, file, dimension):
+        self.file = Path(file)
+        self.dimension = dimension
+        self.base = None
+        self.base_max_id = 0  # Newest memory the snapshot covers
+        self.codec = "fp32"  # How the snapshot stores vectors
+        if self.file.exists():
+            self.open_base()
+        self.delta = faiss.IndexIDMap(faiss.IndexFlatL2(self.dimension))
+        self.removed = set()  # Deleted ids whose vectors are still in the snapshot
+    
+    def open_base(self):
+        # (Re)open the snapshot file
+        self.base = read_snapshot(self.file)
+        self.dimension = self.base.d
+        self.codec = index_codec(self.base)
+        # Snapshots are always written in id order, so the last id is the newest
+        self.base_max_id = int(self.base.id_map.at(self.base.ntotal - 1)) if self.base.ntotal else 0
+    
+    @property
+    def ntotal(self) -> int:
+        return (self.base.ntotal if self.base is not None else 0) + self.delta.ntotal
+    
+    def kind(self) -> str:
+        return index_kind(self.base) if self.base is not None else "flat"
+    
+    def add(self, ids, vectors):
+        self.delta.add_with_ids(np.asarray(vectors, dtype=np.float32), np.asarray(ids, dtype=np.int64))
+    
+    def discard(self, ids):
+        # Drop deleted memories: straight out of the delta, and hidden from searches of the
+        # snapshot until the next one is written without them
+        ids = np.asarray(ids, dtype=np.int64)
+        self.delta.remove_ids(faiss.IDSelectorBatch(ids))
+        self.removed.update(int(i) for i in ids)
+    
+    def delta_rows(self):
+        # Everything in the delta as (ids, vectors)
+        ids = faiss.vector_to_array(self.delta.id_map).astype(np.int64)
+        return ids, reconstruct_rows(faiss.downcast_index(self.delta.index), 0, self.delta.ntotal)
+    
+    def _params(self, index, ef_search, nprobe, allowed=None):
+        # Per-search parameters: the effort for this index type, restricted to `allowed`
+        # ids when filtering, minus deleted ids
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = ef_search
+        elif isinstance(inner, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF()
+            params.nprobe = min(nprobe, inner.nlist)
+        else:
+            params = faiss.SearchParameters()
+        selectors = []
+        if allowed is not None:
+            selectors.append(faiss.IDSelectorBatch(allowed))
+        if self.removed:
+            removed = faiss.IDSelectorBatch(np.fromiter(self.removed, dtype=np.int64))
+            selectors += [removed, faiss.IDSelectorNot(removed)]
+        if selectors:
+            if allowed is not None and self.removed:
+                params.sel = faiss.IDSelectorAnd(selectors[0], selectors[-1])
+            else:
+                params.sel = selectors[-1]
+            params.referenced = (selectors, params.sel)  # Keep the selectors alive during the search
+        return params
+    
+    def search(self, vector, k, ef_search=64, nprobe=16, allowed=None) -> list[tuple[int, float]]:
+        # Nearest memories as (id, L2 distance), closest first. `allowed` restricts the
+        # search to those ids inside FAISS rather than filtering results afterwards.
+        return self.search_many([vector], k, ef_search, nprobe, allowed)[0]
+    
+    def search_many(self, vectors, k, ef_search=64, nprobe=16, allowed=None) -> list[list[tuple[int, float]]]:
+        # search for several vectors at once - one FAISS call per index
+        queries = np.asarray(vectors, dtype=np.float32)
+        hits = [[] for _ in range(len(queries))]
+        for index in (self.base, self.delta):
+            if index is None or index.ntotal == 0:
+                continue
+            params = self._params(index, ef_search, nprobe, allowed)
+            distances, ids = index.search(queries, min(k, index.ntotal), params=params)
+            for row, (row_ids, row_distances) in enumerate(zip(ids, distances)):
+                hits[row].extend((int(i), float(d)) for i, d in zip(row_ids, row_distances) if i != -1)
+        for row in hits:
+            row.sort(key=lambda hit: hit[1])
+        return [row[:k] for row in hits]
+    
+    def swap_base(self, covered_id):
+        # A new snapshot covering every id up to covered_id has been written - map it in
+        # and keep only the delta rows it doesn't cover
+        self.open_base()
+        ids, vectors = self.delta_rows()
+        keep = ids > covered_id
+        self.delta = faiss.IndexIDMap(faiss.IndexFlatL2(self.dimension))
+        if keep.any():
+            self.add(ids[keep], vectors[keep])
+
+def migrate_legacy_store(path) -> int:
+    # One-shot conversion of an old store (index.faiss + pickled index.pkl, plus any
+    # write-ahead log segments) into memories.db + vectors.faiss. The old files are
+    # renamed with a .legacy suffix rather than deleted. Returns how many memories moved.
+    path = Path(path)
+    if not (path / "index.pkl").exists() or (path / "memories.db").exists():
+        return 0
+    
+    print(f"📦 Migrating {path} to the SQLite + memory-mapped index layout...")
+    rows = []
+    seen = set()
+    
+    # Snapshot documents, in index order so ids keep their insertion order
+    index = faiss.read_index(str(path / "index.faiss"))
+    with open(path / "index.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)  # Our own file, read once
+    known = min(index.ntotal, len(index_to_docstore_id))
+    vectors = reconstruct_rows(index, 0, known)
+    for row in range(known):
+        doc = docstore.search(index_to_docstore_id[row])
+        if isinstance(doc, str) or doc.metadata.get("temp", False):
+            continue  # Missing entry or the old placeholder document
+        uid = doc.metadata.get("id") or str(uuid.uuid4())
+        rows.append((uid, doc.page_content, {**doc.metadata, "id": uid}, vectors[row]))
+        seen.add(uid)
+    
+    # Memories still waiting in the old write-ahead log
+    for segment in sorted((path / "wal").glob("segment-*.log")):
+        with open(segment, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    vector = np.frombuffer(base64.b64decode(record["vector"]), dtype=np.float32)
+                except Exception:
+                    break  # Torn last line
+                if record["id"] not in seen:
+                    rows.append((record["id"], record["content"], record["metadata"], vector))
+                    seen.add(record["id"])
+    
+    # Write the new database and a flat snapshot of the same vectors
+    db = MemoryDB(path / "memories.db")
+    db.insert([(i, uid, content, metadata, vector) for i, (uid, content, metadata, vector) in enumerate(rows, 1)])
+    db.close()
+    if rows:
+        snapshot = faiss.IndexIDMap(faiss.IndexFlatL2(len(rows[0][3])))
+        snapshot.add_with_ids(np.vstack([row[3] for row in rows]).astype(np.float32), np.arange(1, len(rows) + 1, dtype=np.int64))
+        faiss.write_index(snapshot, str(path / "vectors.faiss"))
+    
+    # Keep the old files around under a new name
+    for name in ("index.faiss", "index.pkl", "wal"):
+        if (path / name).exists():
+            os.replace(path / name, path / f"{name}.legacy")
+    
+    print(f"✅ Migrated {len(rows)} memories in {path}")
+    return len(rows)
+
+EMBEDDINGS_MODEL = "intfloat/e5-small-v2"
+BACKUP_EMBEDDINGS_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Sentences the ONNX model is checked against PyTorch on, and the lowest cosine
+# similarity between their two vectors that still counts as the same embedding
+PARITY_TEXTS = [
+    "My daughter Sarah lives in Boston with her two children.",
+    "I worked as a nurse at St Mary's hospital for thirty years.",
+    "Max is our golden retriever and he loves the park.",
+    "What did I tell you about my brother?",
+    "I like gardening, especially growing tomatoes and roses.",
+    "We went to Scotland for our honeymoon in 1968.",
+    "Do you remember my favourite song?",
+    "Tea with two sugars, please.",
+]
+PARITY_TOLERANCE = 0.99
+
+def _normalizes(model_name) -> bool:
+    # Whether the model's sentence-transformers pipeline ends with a Normalize layer
+    # (HuggingFaceEmbeddings applies it, so the ONNX backend has to as well)
+    try:
+        from huggingface_hub import hf_hub_download
+        modules = json.loads(Path(hf_hub_download(model_name, "modules.json")).read_text())
+        return any(module.get("type", "").endswith("Normalize") for module in modules)
+    except Exception:
+        return False  # No modules.json - sentence-transformers only mean-pools
+
+class OnnxEmbeddings(Embeddings):
+    # The embeddings model run by ONNX Runtime instead of eager PyTorch, with weights
+    # quantized to int8 (dynamic quantization - activations are quantized on the fly, so
+    # no calibration data is needed). Mean pooling matches sentence-transformers.
+    # The exported model is cached under `cache_folder`, so only the first run exports.
+    def __init__(self, model_name=EMBEDDINGS_MODEL, cache_folder="models/onnx", quantize=True, batch_size=32):
+        self.base_model = model_name
+        self.folder = Path(cache_folder) / model_name.replace("/", "__")
+        self.batch_size = batch_size
+        self.settings_file = self.folder / "echopaw.json"
+        
+        exported = False
+        if not self.settings_file.exists():
+            self._export(quantize)
+            exported = True
+        self._load()
+        
+        # A fresh int8 export has to agree with PyTorch, otherwise use the fp32 ONNX model
+        if exported and self.file_name != "model.onnx":
+            report = compare_embeddings(HuggingFaceEmbeddings(model_name=model_name), self)
+            if not report["passed"]:
+                print(f"⚠️ int8 embeddings drift from PyTorch (min cosine {report['min_cosine']:.4f}) - using fp32 ONNX")
+                self._save_settings(file_name="model.onnx")
+                self._load()
+    
+    def _export(self, quantize):
+        # Convert the model to ONNX (and int8) once, into the cache folder
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+        
+        print(f"📦 Exporting {self.base_model} to ONNX (first run only)...")
+        self.folder.mkdir(parents=True, exist_ok=True)
+        ORTModelForFeatureExtraction.from_pretrained(self.base_model, export=True).save_pretrained(self.folder)
+        AutoTokenizer.from_pretrained(self.base_model).save_pretrained(self.folder)
+        file_name = "model.onnx"
+        
+        if quantize:
+            if platform.machine().lower() in ("arm64", "aarch64"):
+                config = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+            else:
+                config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            quantizer = ORTQuantizer.from_pretrained(self.folder, file_name="model.onnx")
+            quantizer.quantize(save_dir=self.folder, quantization_config=config)  # Writes model_quantized.onnx
+            file_name = "model_quantized.onnx"
+        
+        self._save_settings(file_name=file_name, normalize=_normalizes(self.base_model))
+    
+    def _save_settings(self, **changes):
+        settings = json.loads(self.settings_file.read_text()) if self.settings_file.exists() else {}
+        settings.update(changes)
+        self.settings_file.write_text(json.dumps(settings, indent=2))
+    
+    def _load(self):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        
+        settings = json.loads(self.settings_file.read_text())
+        self.file_name = settings["file_name"]
+        self.normalize = settings["normalize"]
+        # Its own name, so the embedding cache never mixes ONNX and PyTorch vectors
+        self.model_name = f"{self.base_model}@onnx-{'fp32' if self.file_name == 'model.onnx' else 'int8'}"
+        self.tokenizer = AutoTokenizer.from_pretrained(self.folder)
+        self.max_length = min(self.tokenizer.model_max_length, 512)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(self.folder, file_name=self.file_name)
+    
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = self.tokenizer(
+                texts[start:start + self.batch_size], padding=True, truncation=True,
+                max_length=self.max_length, return_tensors="np"
+            )
+            hidden = np.asarray(self.model(**batch).last_hidden_state)
+            
+            # Mean of the token vectors, ignoring padding
+            mask = batch["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            vectors.extend(pooled.astype(np.float32).tolist())
+        return vectors
+    
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+def compare_embeddings(reference, candidate, texts=PARITY_TEXTS, tolerance=PARITY_TOLERANCE) -> dict:
+    # Check two embedding backends give the same vectors (cosine per text) and time a
+    # single query on each - pass the raw models, not CachedEmbeddings
+    a = np.array(reference.embed_documents(texts), dtype=np.float32)
+    b = np.array(candidate.embed_documents(texts), dtype=np.float32)
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + 1e-12)
+    
+    def latency_ms(embed):
+        embed.embed_query(texts[0])  # Warm up
+        start = time.perf_counter()
+        for text in texts:
+            embed.embed_query(text)
+        return (time.perf_counter() - start) / len(texts) * 1000
+    
+    reference_ms = latency_ms(reference)
+    candidate_ms = latency_ms(candidate)
+    report = {
+        "reference": getattr(reference, "model_name", type(reference).__name__),
+        "candidate": getattr(candidate, "model_name", type(candidate).__name__),
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+        "tolerance": tolerance,
+        "passed": bool(cosine.min() >= tolerance),
+        "reference_ms_per_query": reference_ms,
+        "candidate_ms_per_query": candidate_ms,
+        "speedup": reference_ms / candidate_ms if candidate_ms else 0.0
+    }
+    print(f"{'✅' if report['passed'] else '❌'} Embedding parity: min cosine {report['min_cosine']:.4f} "
+          f"(mean {report['mean_cosine']:.4f}, tolerance {tolerance})")
+    print(f"⏱️ Per query: {report['reference']} {reference_ms:.1f} ms, "
+          f"{report['candidate']} {candidate_ms:.1f} ms ({report['speedup']:.1f}x)")
+    return report
+
+def load_embeddings(backend=None):
+    # Load the text-to-vector model. backend: "torch" (default) or "onnx" for the int8
+    # ONNX Runtime model, also settable with the ECHOPAW_EMBED_BACKEND environment variable
+    backend = backend or os.environ.get("ECHOPAW_EMBED_BACKEND", "torch")
+    if backend == "onnx":
+        try:
+            embed = OnnxEmbeddings()
+            print(f"Embeddings model loaded successfully ({embed.model_name})")
+            return embed
+        except Exception as e:
+            print(f"ONNX embeddings unavailable, using PyTorch: {e}")
+    elif backend != "torch":
+        print(f"Unknown embeddings backend '{backend}', using PyTorch")
+    
+    try:
+        # Try the main embeddings model first
+        embed = HuggingFaceEmbeddings(model_name=EMBEDDINGS_MODEL)
+        print("Embeddings model loaded successfully")
+    except Exception as e:
+        print(f"Error loading embeddings model: {e}")
+        # Use a backup model if the main one fails
+        embed = HuggingFaceEmbeddings(model_name=BACKUP_EMBEDDINGS_MODEL)
+    return embed
+
+class MemoryLifecycle:
+    # Keeps a store from growing forever. Each pass scores every memory as
+    #   importance weight × 0.5^(days since last used / half_life_days) × (1 + ln(1 + times recalled))
+    # where "used" is the latest of being stored, repeated (last_seen) or recalled, then:
+    #  1. archives memories whose score has decayed below `evict_below`, or that nobody
+    #     has touched for `ttl_days` (both only once they're `min_age_days` old)
+    #  2. archives the lowest scorers while the store holds more than `max_memories`
+    #  3. folds groups of near-identical memories older than `consolidate_after_days`
+    #     into a single consolidated memory
+    # Archived memories leave the index but stay in memories.db's archive table.
+    # The policy holds no state, so one instance can serve any number of stores.
+    IMPORTANCE = {"high": 1.0, "medium": 0.5, "low": 0.25}  # Anything else counts as medium
+    
+    def __init__(self, half_life_days=30.0, evict_below=0.05, min_age_days=14, ttl_days=None,
+                 max_memories=None, consolidate_after_days=60, consolidate_threshold=0.9,
+                 consolidate_batch=256, consolidate_max_chars=1000):
+        self.half_life_days = half_life_days
+        self.evict_below = evict_below
+        self.min_age_days = min_age_days
+        self.ttl_days = ttl_days
+        self.max_memories = max_memories
+        self.consolidate_after_days = consolidate_after_days  # None = never consolidate
+        self.consolidate_threshold = consolidate_threshold  # Cosine similarity within a group
+        self.consolidate_batch = consolidate_batch  # Memories examined per pass
+        self.consolidate_max_chars = consolidate_max_chars
+    
+    def score(self, importance, access_count, idle_days) -> float:
+        weight = self.IMPORTANCE.get(importance, 0.5)
+        return weight * 0.5 ** (idle_days / self.half_life_days) * (1 + np.log1p(access_count or 0))
+    
+    def run(self, mem, stop=None) -> dict:
+        # One pass over `mem`; `stop` is checked between steps so shutdown isn't held up
+        start = time.perf_counter()
+        archived = self._evict(mem)
+        consolidated = 0
+        if self.consolidate_after_days is not None and not (stop and stop.is_set()):
+            consolidated, merged = self._consolidate(mem, stop)
+            archived += merged
+        return {"archived": archived, "consolidated": consolidated, "seconds": time.perf_counter() - start}
+    
+    def _evict(self, mem) -> int:
+        # Score every memory and archive the ones that have faded
+        now = datetime.now()
+        ids, scores, ages, idles = [], [], [], []
+        unreadable = 0
+        for page in mem.db.lifecycle_rows():
+            for row_id, timestamp, importance, access_count, last_access, last_seen, _ in page:
+                if not timestamp:
+                    continue  # Can't age a memory without a timestamp
+                created = _local_time(timestamp)
+                if created is None:
+                    unreadable += 1  # Stored before timestamps were checked - leave it be
+                    continue
+                last_used = max(t for t in (created, _local_time(last_seen or ""), _local_time(last_access or "")) if t)
+                age = (now - created).total_seconds() / 86400
+                idle = (now - last_used).total_seconds() / 86400
+                ids.append(row_id)
+                scores.append(self.score(importance, access_count, idle))
+                ages.append(age)
+                idles.append(idle)
+        if unreadable:
+            print(f"⚠️ Skipped {unreadable} memories with unreadable timestamps")
+        if not ids:
+            return 0
+        ids, scores, ages, idles = np.array(ids), np.array(scores), np.array(ages), np.array(idles)
+        
+        archived = 0
+        old = ages >= self.min_age_days
+        decayed = old & (scores < self.evict_below)
+        archived += mem._archive(ids[decayed], "decayed")
+        expired = np.zeros(len(ids), dtype=bool)
+        if self.ttl_days is not None:
+            expired = old & ~decayed & (idles >= self.ttl_days)
+            archived += mem._archive(ids[expired], "expired")
+        
+        # Still too many - drop the least valuable of the rest
+        if self.max_memories is not None:
+            keep = ~(decayed | expired)
+            excess = int(keep.sum()) - self.max_memories
+            if excess > 0:
+                candidates = np.flatnonzero(keep)
+                lowest = candidates[np.argsort(scores[candidates])[:excess]]
+                archived += mem._archive(ids[lowest], "over_limit")
+        return archived
+    
+    def _consolidate(self, mem, stop=None) -> tuple[int, int]:
+        # Merge groups of old memories that say nearly the same thing.
+        # Returns (groups consolidated, memories merged away).
+        cutoff = str(datetime.now() - timedelta(days=self.consolidate_after_days))
+        old = {"timestamp": {"$lt": cutoff}, "source": {"$ne": "consolidation"}}
+        allowed = mem.db.filter_ids(old)
+        if len(allowed) < 2:
+            return 0, 0
+        
+        # Work through the old memories a batch per pass, carrying on where the last pass stopped
+        cursor = mem.stats.get("consolidation_cursor", 0)
+        seeds = allowed[allowed > cursor][:self.consolidate_batch]
+        if len(seeds) == 0:
+            seeds = allowed[:self.consolidate_batch]
+        mem.stats["consolidation_cursor"] = int(seeds[-1])
+        
+        grouped = set()
+        groups = 0
+        merged = 0
+        for seed in seeds:
+            if stop and stop.is_set():
+                break
+            seed = int(seed)
+            if seed in grouped:
+                continue
+            _, seed_vectors = mem.db.vectors_for([seed])
+            if seed_vectors is None:
+                continue  # Archived since the pass started
+            
+            # Nearest old memories, kept if they're close enough to the seed
+            neighbours = [i for i, _ in mem._search_allowed(seed_vectors[0], 8, allowed) if i != seed and i not in grouped]
+            ids, vectors = mem.db.vectors_for(neighbours)
+            if vectors is None:
+                continue
+            similarity = vectors @ seed_vectors[0] / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(seed_vectors[0]) + 1e-12)
+            members = [seed] + [int(i) for i in ids[similarity >= self.consolidate_threshold]]
+            if len(members) < 2:
+                continue
+            
+            grouped.update(members)
+            archived = self._merge(mem, members)
+            if archived:
+                merged += archived
+                groups += 1
+        return groups, merged
+    
+    def _merge(self, mem, members) -> int:
+        # Replace a group of memories with one that carries all of their text. Members that
+        # don't fit in consolidate_max_chars stay as they are.
+        docs = mem.db.fetch(members)
+        texts, included = [], []
+        for i in sorted(docs, key=lambda i: docs[i]["metadata"].get("timestamp", "")):
+            content = docs[i]["content"]
+            if content in texts:
+                included.append(i)
+            elif not texts or len("; ".join(texts + [content])) <= self.consolidate_max_chars:
+                texts.append(content)
+                included.append(i)
+        if len(included) < 2:
+            return 0
+        members = included
+        metadatas = [docs[i]["metadata"] for i in members]
+        
+        content = "; ".join(texts)
+        metadata = {
+            "source": "consolidation",
+            "timestamp": str(datetime.now()),
+            "id": str(uuid.uuid4()),
+            "consolidated_from": [m.get("id") for m in metadatas],
+            "mentions": sum(m.get("mentions", 1) for m in metadatas)
+        }
+        # The group is as important as its most important member
+        importances = [m["importance"] for m in metadatas if m.get("importance")]
+        if importances:
+            metadata["importance"] = max(importances, key=lambda value: self.IMPORTANCE.get(value, 0.5))
+        category = next((m["category"] for m in metadatas if m.get("category")), None)
+        if category:
+            metadata["category"] = category
+        
+        vector = mem.embed.embed_documents([content])[0]
+        mem._insert([content], [vector], [metadata])
+        return mem._archive(members, "consolidated")
 
 class EchoMemory:
-    def __init__(self, path="memory"):
+    def __init__(self, path="memory", compact_every=500, compact_interval=60.0, compact_ratio=0.1,
+                 embed_cache_size=4096, embed_cache_disk=True, embed_cache_disk_entries=100_000,
+                 hnsw_threshold=20_000, ivfpq_threshold=1_000_000, recall_target=0.95, embed=None,
+                 exact_filter_limit=4096, dedup_threshold=0.95, lifecycle=None, lifecycle_interval=6 * 3600,
+                 hybrid=True, rrf_k=60, candidate_budget=None, embed_backend=None,
+                 persist_interval=0.2, persist_batch=256, vector_codec="fp32", rerank_factor=4):
         # Create the memory folder if it doesn't exist
         self.path = Path(path)
-        self.path.mkdir(exist_ok=True)
+        self.path.mkdir(parents=True, exist_ok=True)
         
-        # Initialize the text-to-vector converter
-        try:
-            # Try the main embeddings model first
-            self.embed = HuggingFaceEmbeddings(model_name="intfloat/e5-small-v2")
-            print("Embeddings model loaded successfully")
-        except Exception as e:
-            print(f"Error loading embeddings model: {e}")
-            # Use a backup model if the main one fails
-            self.embed = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+        # Guards the vector index - adds, searches and snapshot swaps
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()  # One snapshot write at a time
+        
+        # Index type follows the store size: exact flat search while small, HNSW graph
+        # once it grows, IVF-PQ with trained centroids for millions of memories
+        self.hnsw_threshold = hnsw_threshold
+        self.ivfpq_threshold = ivfpq_threshold
+        self.recall_target = recall_target
+        self.exact_filter_limit = exact_filter_limit  # Filtered searches this small skip FAISS
+        
+        # Snapshot vectors as float32, or compressed ("fp16" halves the memory, "sq8" quarters
+        # it) with the top rerank_factor*k candidates re-scored exactly. IVF-PQ, used for
+        # the largest stores, is compressed anyway and gets the same re-ranking.
+        if vector_codec not in VECTOR_CODECS:
+            raise ValueError(f"Unknown vector_codec '{vector_codec}' - use one of {', '.join(VECTOR_CODECS)}")
+        self.vector_codec = vector_codec
+        self.rerank_factor = rerank_factor
+        self.dedup_threshold = dedup_threshold  # Cosine similarity at which add_fact merges instead (None = off)
+        self._migration = None  # Background thread while an index migration runs
+        
+        # Hybrid retrieval: BM25 keyword matches fused with vector neighbours (reciprocal
+        # rank fusion), so names like "Sarah" rank well without raising k. Both searches
+        # together fetch `candidate_budget` candidates (default 4*k).
+        self.hybrid = hybrid
+        self.rrf_k = rrf_k
+        self.candidate_budget = candidate_budget
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self.compact_ratio = compact_ratio
+        
+        # Decay, eviction and consolidation policy (see MemoryLifecycle), run every
+        # `lifecycle_interval` seconds in the background (None = never)
+        self.lifecycle = lifecycle or MemoryLifecycle()
+        self.lifecycle_interval = lifecycle_interval
+        self._accesses = {}  # id -> (times recalled, last recalled) not yet written to the database
+        
+        # New memories and metadata changes are written to memories.db by a background
+        # thread - at most `persist_interval` seconds late, or sooner once `persist_batch`
+        # are waiting - so adding a memory never waits on the disk. Until then they're
+        # served from these, so reads see every write straight away.
+        self.persist_interval = persist_interval
+        self.persist_batch = persist_batch
+        self._pending = OrderedDict()  # id -> (uid, content, metadata, vector) not yet in the database
+        self._pending_metadata = {}  # id -> metadata not yet written
+        self._pending_archive = {}  # id -> reason, for memories already hidden from the index
+        self._stats_dirty = False
+        self._persist_lock = threading.Lock()  # One writer at a time
+        
+        # Initialize the text-to-vector converter (shards share one passed in)
+        if isinstance(embed, CachedEmbeddings):
+            self.embed = embed
+        else:
+            self.embed = embed or load_embeddings(embed_backend)
+            # Cache vectors so the same text is never embedded twice (e.g. add_fact then recall)
+            self.embed = CachedEmbeddings(
+                self.embed,
+                max_entries=embed_cache_size,
+                disk_folder=self.path / "embed_cache" if embed_cache_disk else None,
+                disk_entries=embed_cache_disk_entries
+            )
         
         # File to store memory statistics
         self.stats_file = self.path / "memory_stats.json"
         self.load_stats()  # Load existing stats or create new ones
         
-        # Check if we have an existing memory database
-        if (self.path / "index.faiss").exists() and (self.path / "index.pkl").exists():
-            try:
-                # Load the existing vector database
-                self.vstore = FAISS.load_local(
-                    str(self.path), 
-                    self.embed, 
-                    allow_dangerous_deserialization=True  # We trust our own files
-                )
-                print(f"✅ Loaded existing memory with {self._count_real_docs()} memories")
-            except Exception as e:
-                print(f"Failed to load existing memory: {e}")
-                self._create_new_store()  # Create new if loading fails
-        else:
-            # No existing database, create a new one
-            self._create_new_store()
+        # Convert an old pickle-based store the first time it's opened
+        migrate_legacy_store(self.path)
+        
+        # Documents live in SQLite, vectors in a memory-mapped snapshot plus a RAM delta
+        self.db = MemoryDB(self.path / "memories.db")
+        dimension = self.db.dimension() or len(self.embed.embed_query("dimension probe"))
+        self.index = VectorIndex(self.path / "vectors.faiss", dimension)
+        
+        # Replay memories added after the last snapshot (e.g. before a crash)
+        replayed = 0
+        for ids, vectors in self.db.vectors(after_id=self.index.base_max_id):
+            self.index.add(ids, vectors)
+            replayed += len(ids)
+        if replayed:
+            print(f"♻️ Replayed {replayed} memories written after the last snapshot")
+        self.index.removed = self.db.removed_ids()
+        
+        # Live counters - no scans needed after this
+        self._count = self.db.count()
+        self._next_id = self.db.max_id() + 1
+        print(f"✅ Loaded memory with {self._count} memories ({self.index.kind()} index)")
+        
+        # A store may have crossed a size threshold since it was last opened
+        self._maybe_migrate()
         
-        # Set up the retriever for searching memories
-        self.retriever = self.vstore.as_retriever(search_kwargs={"k": 5})
+        # Background compaction folds new memories into the snapshot once they're worth a
+        # rewrite (see _compaction_due), checked on every add and every `compact_interval` seconds
+        self._compact_wakeup = threading.Event()
+        self._stop_compactor = threading.Event()
+        self._compactor = threading.Thread(target=self._compaction_loop, daemon=True)
+        self._compactor.start()
+        
+        self._persist_wakeup = threading.Event()
+        self._stop_persister = threading.Event()
+        self._persister = threading.Thread(target=self._persist_loop, daemon=True)
+        self._persister.start()
+        atexit.register(self._persist)  # Don't lose the last writes if the process exits without close()
+        
+        self._stop_lifecycle = threading.Event()
+        self._lifecycle_thread = None
+        if self.lifecycle_interval:
+            self._lifecycle_thread = threading.Thread(target=self._lifecycle_loop, daemon=True)
+            self._lifecycle_thread.start()
     
     def load_stats(self):
         # Load memory statistics from file
@@ -67,72 +1366,559 @@ class EchoMemory:
         except Exception as e:
             print(f"Failed to save stats: {e}")
     
-    def _count_real_docs(self):
-        # Count actual memories (not dummy initialization documents)
+    def count(self) -> int:
+        # Number of stored memories - constant time
+        return self._count
+    
+    def _persist_loop(self):
+        # Background thread: write pending memories every `persist_interval` seconds,
+        # or as soon as `persist_batch` of them are waiting
+        while not self._stop_persister.is_set():
+            self._persist_wakeup.wait(self.persist_interval)
+            self._persist_wakeup.clear()
+            self._persist()
+    
+    def _persist(self):
+        # Write everything pending to memories.db in one go
+        with self._persist_lock:
+            with self._lock:
+                rows = [(i, *row) for i, row in self._pending.items()]
+                updates, self._pending_metadata = self._pending_metadata, {}
+                stats_dirty, self._stats_dirty = self._stats_dirty, False
+                archives, self._pending_archive = self._pending_archive, {}
+            try:
+                if rows:
+                    self._write_rows(rows)
+                if updates:
+                    self._write_updates(updates)
+            except Exception as e:
+                print(f"Failed to write memories to disk (will retry): {e}")
+                with self._lock:
+                    self._pending_metadata = {**updates, **self._pending_metadata}
+                    self._pending_archive = {**archives, **self._pending_archive}
+                    self._stats_dirty = self._stats_dirty or stats_dirty
+                return False
+            
+            # Archive memories that were already taken out of the index (after the rows
+            # above, so one replaced before it was ever written is archived too)
+            by_reason = {}
+            for row_id, reason in archives.items():
+                by_reason.setdefault(reason, []).append(row_id)
+            for reason, ids in by_reason.items():
+                try:
+                    self.db.archive(ids, reason)
+                except Exception as e:
+                    print(f"Failed to archive {len(ids)} memories (will retry): {e}")
+                    with self._lock:
+                        for row_id in ids:
+                            self._pending_archive.setdefault(row_id, reason)
+            
+            self._flush_accesses()
+            if stats_dirty:
+                self.save_stats()
+            return True
+    
+    def _write_rows(self, rows):
+        # db.insert, dropping the rows from RAM only once they're on disk so a read always
+        # finds them somewhere. If SQLite refuses a row, the batch is written a row at a
+        # time and the refused ones are set aside, so one bad memory can't hold up the rest.
         try:
-            count = 0
-            if hasattr(self.vstore.docstore, '_dict'):
-                # For InMemoryDocstore - check each document
-                for doc in self.vstore.docstore._dict.values():
-                    if not doc.metadata.get("temp", False):  # Skip temporary docs
-                        count += 1
-            elif hasattr(self.vstore.docstore, 'search'):
-                # Alternative method for different docstore types
+            self.db.insert(rows)
+            written = rows
+        except ROW_ERRORS:
+            written = []
+            for row in rows:
                 try:
-                    # Go through all document IDs
-                    for doc_id in self.vstore.index_to_docstore_id.values():
-                        doc = self.vstore.docstore.search(doc_id)
-                        if doc and not doc.metadata.get("temp", False):
-                            count += 1
-                except:
-                    pass  # Ignore errors in counting
-            return count
-        except Exception as e:
-            print(f"Error counting docs: {e}")
-            return 0
+                    self.db.insert([row])
+                    with self._lock:
+                        self._pending.pop(row[0], None)
+                except ROW_ERRORS as e:
+                    self._set_aside([row], e)
+        with self._lock:
+            for row in written:
+                self._pending.pop(row[0], None)
     
-    def _get_real_docs(self):
-        # Get all actual memory documents (excluding dummy ones)
+    def _write_updates(self, updates):
+        # db.update_metadata, one memory at a time if some metadata can't be written
         try:
-            real_docs = []
-            if hasattr(self.vstore.docstore, '_dict'):
-                # For InMemoryDocstore
-                for doc in self.vstore.docstore._dict.values():
-                    if not doc.metadata.get("temp", False):  # Skip temporary docs
-                        real_docs.append(doc)
-            elif hasattr(self.vstore.docstore, 'search'):
-                # Alternative access method
+            self.db.update_metadata(updates)
+        except ROW_ERRORS:
+            for row_id, metadata in updates.items():
                 try:
-                    for doc_id in self.vstore.index_to_docstore_id.values():
-                        doc = self.vstore.docstore.search(doc_id)
-                        if doc and not doc.metadata.get("temp", False):
-                            real_docs.append(doc)
-                except:
-                    pass  # Ignore errors
-            return real_docs
+                    self.db.update_metadata({row_id: metadata})
+                except ROW_ERRORS as e:
+                    print(f"⚠️ Couldn't update memory {row_id}'s metadata, keeping the old: {e}")
+    
+    def _set_aside(self, rows, reason):
+        # Take pending memories that can't be written out of the store, saving them to
+        # rejected.jsonl (in export_jsonl's format, so they can be fixed and imported)
+        with self._lock:
+            rows = [row for row in rows if row[0] in self._pending]
+        if not rows:
+            return
+        try:
+            with open(self.path / "rejected.jsonl", "a", encoding="utf-8") as f:
+                for _, _, content, metadata, _ in rows:
+                    f.write(json.dumps({"content": content, "metadata": metadata, "error": str(reason)}, default=str) + "\n")
+        except OSError as e:
+            print(f"⚠️ Couldn't set aside {len(rows)} unsaved memories: {e}")
+            return
+        with self._lock:
+            for row in rows:
+                self._pending.pop(row[0], None)
+            self.index.discard([row[0] for row in rows])
+            # One already replaced by a newer wording was counted out when it was hidden
+            self._count -= sum(self._pending_archive.pop(row[0], None) is None for row in rows)
+        self.stats["rejected_memories"] = self.stats.get("rejected_memories", 0) + len(rows)
+        print(f"⚠️ Set aside {len(rows)} memories that couldn't be saved ({reason}) in {self.path / 'rejected.jsonl'}")
+    
+    def _fetch(self, ids) -> dict:
+        # db.fetch, including memories and metadata changes that are still pending
+        ids = [int(i) for i in ids]
+        with self._lock:
+            found = {i: {"content": self._pending[i][1], "metadata": self._pending[i][2]} for i in ids if i in self._pending}
+            updates = {i: self._pending_metadata[i] for i in ids if i in self._pending_metadata}
+        rest = [i for i in ids if i not in found]
+        if rest:
+            found.update(self.db.fetch(rest))
+        for i, metadata in updates.items():
+            if i in found:
+                found[i]["metadata"] = metadata
+        return found
+    
+    def _vectors_for(self, ids):
+        # db.vectors_for, including pending memories
+        ids = [int(i) for i in ids]
+        with self._lock:
+            pending = [(i, self._pending[i][3]) for i in ids if i in self._pending]
+        found_ids, vectors = self.db.vectors_for([i for i in ids if i not in dict(pending)])
+        if pending:
+            pending_ids = np.array([i for i, _ in pending], dtype=np.int64)
+            pending_vectors = np.array([vector for _, vector in pending], dtype=np.float32)
+            found_ids = np.concatenate([found_ids, pending_ids])
+            vectors = pending_vectors if vectors is None else np.vstack([vectors, pending_vectors])
+        return found_ids, vectors
+    
+    def _filter_ids(self, where) -> np.ndarray:
+        # db.filter_ids, including pending memories
+        with self._lock:
+            pending = [i for i, row in self._pending.items() if matches_filter(self._pending_metadata.get(i, row[2]), where)]
+        return np.concatenate([self.db.filter_ids(where), np.array(pending, dtype=np.int64)])
+    
+    def _keyword_search(self, query, k, where=None) -> list[tuple[int, float]]:
+        # db.keyword_search, then pending memories sharing a query word (they have no
+        # BM25 score until they're written, so they rank after the database's matches)
+        hits = self.db.keyword_search(query, k, where)
+        words = set(re.findall(r"\w+", query.lower())) - STOPWORDS
+        with self._lock:
+            pending = [
+                (i, row[1]) for i, row in self._pending.items()
+                if not where or matches_filter(self._pending_metadata.get(i, row[2]), where)
+            ]
+        matched = [(i, len(words & set(re.findall(r"\w+", content.lower())))) for i, content in pending]
+        matched = sorted((hit for hit in matched if hit[1]), key=lambda hit: -hit[1])
+        return (hits + [(i, 0.0) for i, _ in matched])[:k]
+    
+    def _insert(self, texts, vectors, metadatas):
+        # Store pre-embedded memories: index them now, write them to the database in the background
+        with self._lock:
+            ids = list(range(self._next_id, self._next_id + len(texts)))
+            for i, text, metadata, vector in zip(ids, texts, metadatas, vectors):
+                self._pending[i] = (metadata["id"], text, metadata, vector)
+            self.index.add(ids, vectors)
+            self._next_id += len(texts)
+            self._count += len(texts)
+        
+        if len(self._pending) >= self.persist_batch:
+            self._persist_wakeup.set()
+        
+        # Wake the compactor once enough new memories have piled up
+        if self._compaction_due():
+            self._compact_wakeup.set()
+        self._maybe_migrate()
+    
+    def _target_kind(self, count) -> str:
+        # Which index family suits a store of this size
+        if count >= self.ivfpq_threshold:
+            return "ivfpq"
+        if count >= self.hnsw_threshold:
+            return "hnsw"
+        return "flat"
+    
+    def _search_effort(self):
+        # HNSW efSearch and IVF nprobe that meet the configured recall target - as measured
+        # on the current snapshot, or the table's guess until it's been calibrated
+        effort = self.stats.get("search_effort")
+        if effort and effort["kind"] == self.index.kind() and effort["recall_target"] == self.recall_target:
+            return effort["ef_search"], effort["nprobe"]
+        for target, ef_search, nprobe in SEARCH_EFFORT:
+            if self.recall_target <= target:
+                break
+        return ef_search, nprobe
+    
+    def _calibration_stale(self, kind, size) -> bool:
+        # Whether a snapshot of this kind and size needs its search effort measured
+        effort = self.stats.get("search_effort")
+        return (kind != "flat" and size > CALIBRATION_K + 1 and
+                (not effort or effort["kind"] != kind or effort["codec"] != self._codec_for(kind) or
+                 effort["recall_target"] != self.recall_target or size >= 2 * effort["size"]))
+    
+    def _calibrate(self, index, kind, up_to_id) -> dict:
+        # The least search effort at which an approximate snapshot meets recall_target,
+        # measured against exact search. Queries are blends of two random stored memories -
+        # like real questions they land between memories rather than on one - and
+        # recall@CALIBRATION_K is the share of the snapshot's top k (searched the way
+        # _search does, re-ranked for compressed codecs) no further away than the true
+        # k-th nearest, so equally close memories count the same.
+        start = time.perf_counter()
+        k = CALIBRATION_K
+        rng = np.random.default_rng(0)
+        step = max(1, index.ntotal // (2 * CALIBRATION_QUERIES))
+        sample, position = [], 0
+        for ids, vectors in self.db.vectors(up_to_id=up_to_id):
+            sample.extend(vectors[np.arange(-position % step, len(ids), step)])
+            position += len(ids)
+        sample = np.array(sample, dtype=np.float32)[rng.permutation(len(sample))]
+        half = min(CALIBRATION_QUERIES, len(sample) // 2)
+        queries = (sample[:half] + sample[half:2 * half]) / 2
+        if np.allclose(np.linalg.norm(sample, axis=1), 1.0, atol=1e-3):
+            queries /= np.linalg.norm(queries, axis=1, keepdims=True) + 1e-12  # Stay on the unit sphere
+        
+        # Exact k-th nearest distance, a page of stored vectors at a time
+        best = np.full((len(queries), 0), np.inf, dtype=np.float32)
+        for ids, vectors in self.db.vectors(up_to_id=up_to_id):
+            distances, _ = faiss.knn(queries, vectors, min(k, len(ids)))
+            best = np.sort(np.hstack([best, distances]), axis=1)[:, :k]
+        limit = best[:, -1] * (1 + 1e-4) + 1e-6  # Float rounding differs between search paths
+        
+        inner = faiss.downcast_index(index.index)
+        rerank = self._codec_for(kind) != "fp32"
+        fetch = k * (self.rerank_factor if rerank else 1)
+        for ef_search, nprobe in EFFORT_LADDER:
+            if isinstance(inner, faiss.IndexHNSW):
+                params = faiss.SearchParametersHNSW()
+                params.efSearch = ef_search
+            else:
+                params = faiss.SearchParametersIVF()
+                params.nprobe = min(nprobe, inner.nlist)
+            _, found = index.search(queries, min(fetch, index.ntotal), params=params)
+            # Exact distances for what it found (the re-ranking step, for compressed codecs)
+            candidate_ids, candidate_vectors = self.db.vectors_for(np.unique(found[found != -1]))
+            exact = dict(zip(candidate_ids.tolist(), candidate_vectors))
+            hits = []
+            for row, query, bound in zip(found, queries, limit):
+                scored = [(float(((exact[i] - query) ** 2).sum()), i) for i in row.tolist() if i in exact]
+                top = sorted(scored)[:k] if rerank else scored[:k]
+                hits.append(sum(distance <= bound for distance, _ in top) / k)
+            recall = float(np.mean(hits))
+            if recall >= self.recall_target:
+                break
+        
+        print(f"🎯 Calibrated {kind} search: efSearch {ef_search}, nprobe {nprobe} → recall@{k} {recall:.3f} "
+              f"(target {self.recall_target}, {time.perf_counter() - start:.1f}s)")
+        return {"kind": kind, "codec": self._codec_for(kind), "size": int(index.ntotal), "recall_target": self.recall_target,
+                "ef_search": ef_search, "nprobe": nprobe, "measured_recall": recall}
+    
+    def _recalibrate(self):
+        # Calibrate the current snapshot (e.g. one written before calibration existed)
+        try:
+            with self._lock:
+                index, kind, up_to_id = self.index.base, self.index.kind(), self.index.base_max_id
+            effort = self._calibrate(index, kind, up_to_id)
+            with self._lock:
+                self.stats["search_effort"] = effort
+            self.save_stats()
         except Exception as e:
-            print(f"Error getting docs: {e}")
+            print(f"Search calibration failed: {e}")
+    
+    def _search(self, vector, k, where=None) -> list[tuple[int, float]]:
+        # Nearest memories to a vector as (id, distance), optionally only those matching
+        # a metadata filter
+        ef_search, nprobe = self._search_effort()
+        if not where:
+            if self.index.codec == "fp32":
+                with self._lock:
+                    return self.index.search(vector, k, ef_search, nprobe)
+            # Compressed vectors give approximate distances - take extra candidates and
+            # re-rank them with the exact vectors
+            with self._lock:
+                hits = self.index.search(vector, k * self.rerank_factor, ef_search, nprobe)
+            return self._rerank(vector, hits, k)
+        
+        # The metadata index gives the candidate ids, so cost follows the filtered set
+        return self._search_allowed(vector, k, self._filter_ids(where))
+    
+    def _rerank(self, vector, hits, k) -> list[tuple[int, float]]:
+        # Exact distances for candidate hits from their stored float32 vectors, best k kept
+        ids, vectors = self._vectors_for([row_id for row_id, _ in hits])
+        if vectors is None:
             return []
+        distances = ((vectors - np.asarray(vector, dtype=np.float32)) ** 2).sum(axis=1)
+        best = np.argsort(distances)[:k]
+        return [(int(ids[i]), float(distances[i])) for i in best]
+    
+    def _retrieve(self, query, k, where=None) -> list[tuple[int, float, float]]:
+        # Memories for a text query as (id, distance, fusion score), best first. The keyword
+        # search starts first and runs while the query is embedded and the vector search runs.
+        per_search = max(k, (self.candidate_budget or 4 * k) // 2)  # Each half gets an equal share
+        keyword = None
+        if self.hybrid and self.db.keywords:
+            keyword = KEYWORD_POOL.submit(self._keyword_search, query, per_search, where)
+        vector = self.embed.embed_query(query)
+        dense = self._search(vector, per_search if keyword else k, where)
+        
+        lexical = []
+        if keyword is not None:
+            try:
+                lexical = keyword.result()
+            except Exception as e:
+                print(f"Keyword search failed, using vector search only: {e}")
+        
+        # Reciprocal rank fusion: each list contributes 1 / (rrf_k + rank)
+        scores = {}
+        for hits in (dense, lexical):
+            for rank, (row_id, _) in enumerate(hits, 1):
+                scores[row_id] = scores.get(row_id, 0.0) + 1.0 / (self.rrf_k + rank)
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        
+        # Keyword-only hits still get a vector distance, from their stored vectors
+        distances = dict(dense)
+        missing = [row_id for row_id in best if row_id not in distances]
+        if missing:
+            ids, vectors = self._vectors_for(missing)
+            if vectors is not None:
+                found = ((vectors - np.asarray(vector, dtype=np.float32)) ** 2).sum(axis=1)
+                distances.update(zip(ids.tolist(), found.tolist()))
+        return [(row_id, float(distances.get(row_id, np.inf)), scores[row_id]) for row_id in best]
+    
+    def _search_allowed(self, vector, k, allowed) -> list[tuple[int, float]]:
+        # Nearest memories among the `allowed` ids
+        ef_search, nprobe = self._search_effort()
+        if len(allowed) == 0:
+            return []
+        if len(allowed) <= self.exact_filter_limit:
+            # Few enough to score exactly straight from the stored vectors
+            ids, vectors = self._vectors_for(allowed)
+            if vectors is None:
+                return []
+            distances = ((vectors - np.asarray(vector, dtype=np.float32)) ** 2).sum(axis=1)
+            best = np.argsort(distances)[:k]
+            return [(int(ids[i]), float(distances[i])) for i in best]
+        
+        # Otherwise let FAISS skip everything outside the filter with an id selector,
+        # searching harder since the graph/lists hold fewer eligible vectors
+        if self.index.codec == "fp32":
+            with self._lock:
+                return self.index.search(vector, k, ef_search * 2, nprobe * 2, allowed=allowed)
+        with self._lock:
+            hits = self.index.search(vector, k * self.rerank_factor, ef_search * 2, nprobe * 2, allowed=allowed)
+        return self._rerank(vector, hits, k)
+    
+    def _build_index(self, kind, up_to_id):
+        # Build a fresh snapshot index of the given family from the exact vectors in the
+        # database (so deleted memories drop out and IVF-PQ never re-encodes lossy vectors)
+        dimension = self.index.dimension
+        count = self.count()
+        qtype = VECTOR_CODECS[self.vector_codec]
+        if kind == "hnsw":
+            # 32 graph links per node, vectors stored as vector_codec says
+            inner = faiss.IndexHNSWFlat(dimension, 32) if qtype is None else faiss.IndexHNSWSQ(dimension, qtype, 32)
+            inner.hnsw.efConstruction = 80
+        elif kind == "ivfpq" and self.index.kind() == "ivfpq":
+            # Rebuilding to drop deleted memories - the trained centroids are still good
+            inner = faiss.clone_index(faiss.downcast_index(self.index.base.index))
+            inner.reset()
+        elif kind == "ivfpq":
+            # About 4*sqrt(n) coarse centroids (k-means wants ~39 points each),
+            # and PQ sub-vectors that divide the dimension
+            nlist = int(max(1, min(65536, 4 * np.sqrt(count), count // 39)))
+            m = next(m for m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1) if dimension % m == 0 and m <= max(1, dimension // 4))
+            inner = faiss.IndexIVFPQ(faiss.IndexFlatL2(dimension), dimension, nlist, m, 8)
+            # Train the centroids on an evenly spread sample - plenty for k-means
+            step = max(1, count // (64 * nlist))
+            sample = np.vstack([vectors[::step] for _, vectors in self.db.vectors(up_to_id=up_to_id)])
+            inner.train(sample)
+        else:
+            inner = faiss.IndexFlatL2(dimension) if qtype is None else faiss.IndexScalarQuantizer(dimension, qtype, faiss.METRIC_L2)
+        
+        if not inner.is_trained:
+            # 8-bit quantization learns each dimension's range - a sample of up to ~100k vectors covers it
+            step = max(1, count // 100_000)
+            inner.train(np.vstack([vectors[::step] for _, vectors in self.db.vectors(up_to_id=up_to_id)]))
+        
+        index = faiss.IndexIDMap(inner)
+        for ids, vectors in self.db.vectors(up_to_id=up_to_id):
+            index.add_with_ids(vectors, ids)
+        return index
+    
+    def _codec_for(self, kind) -> str:
+        # How a snapshot of this kind should store vectors (IVF-PQ always uses its own codes)
+        return "pq" if kind == "ivfpq" else self.vector_codec
+    
+    def _maybe_migrate(self):
+        # Start a background migration if the store has outgrown its index type, or its
+        # snapshot stores vectors differently from vector_codec
+        current = self.index.kind()
+        target = self._target_kind(self.count())
+        if target == "flat" or current == "ivfpq":
+            target = current  # Never migrate back down, and IVF-PQ is the last tier
+        if self._migration is not None and self._migration.is_alive():
+            return
+        if target == current and (self.index.base is None or self.index.codec == self._codec_for(current)):
+            if self.index.base is not None and self._calibration_stale(current, self.index.base.ntotal):
+                self._migration = threading.Thread(target=self._recalibrate, daemon=True)
+                self._migration.start()
+            return
+        self._migration = threading.Thread(target=self.compact, args=(target,), daemon=True)
+        self._migration.start()
+    
+    def _compaction_due(self) -> bool:
+        # A snapshot rewrite costs as much as the whole index, so it waits until the changes
+        # since the last one - new vectors in the delta plus deleted ids - reach
+        # `compact_ratio` of the snapshot (and at least `compact_every`). Until then new
+        # memories are searched in the RAM delta and replayed from memories.db on open.
+        changes = self.index.delta.ntotal + len(self.index.removed)
+        base_size = self.index.base.ntotal if self.index.base is not None else 0
+        return changes > 0 and changes >= max(self.compact_every, self.compact_ratio * base_size)
+    
+    def _compaction_loop(self):
+        # Background thread: fold new memories into the snapshot once enough have piled up
+        while not self._stop_compactor.is_set():
+            self._compact_wakeup.wait(self.compact_interval)
+            self._compact_wakeup.clear()
+            if self._stop_compactor.is_set():
+                break
+            if self._compaction_due():
+                self.compact()
+    
+    def _lifecycle_loop(self):
+        # Background thread: decay, evict and consolidate every `lifecycle_interval` seconds
+        while not self._stop_lifecycle.wait(self.lifecycle_interval):
+            self.run_lifecycle()
     
-    def _create_new_store(self):
-        # Create a new empty vector database
+    def run_lifecycle(self) -> dict:
+        # One lifecycle pass now - what the background job does on its schedule
         try:
-            print("Creating new memory store")
-            
-            # FAISS needs at least one document to initialize, so we create a dummy one
-            dummy_doc = Document(
-                page_content="This is a temporary initialization document", 
-                metadata={"temp": True, "id": "dummy"}  # Mark as temporary
-            )
-            
-            # Create the vector store with the dummy document
-            self.vstore = FAISS.from_documents([dummy_doc], self.embed)
-            print("✅ Created new empty memory store")
-            
+            self._persist()  # Score what's on disk, including the latest recalls
+            report = self.lifecycle.run(self, self._stop_lifecycle)
+            self.stats["archived"] = self.stats.get("archived", 0) + report["archived"]
+            self.stats["consolidated"] = self.stats.get("consolidated", 0) + report["consolidated"]
+            self.stats["total_memories"] = self.count()
+            self.stats["last_lifecycle_run"] = str(datetime.now())
+            self.save_stats()
+            if report["archived"]:
+                print(f"🧹 Memory lifecycle: archived {report['archived']}, "
+                      f"consolidated {report['consolidated']} groups ({report['seconds']:.1f}s)")
+            return report
         except Exception as e:
-            print(f"Error creating new store: {e}")
-            raise
-
+            print(f"Memory lifecycle failed: {e}")
+            return {"archived": 0, "consolidated": 0, "seconds": 0.0}
+    
+    def _note_access(self, ids):
+        # Count recalls in RAM - written to the database in batches, not per search
+        now = str(datetime.now())
+        with self._lock:
+            for row_id in ids:
+                count, _ = self._accesses.get(row_id, (0, None))
+                self._accesses[row_id] = (count + 1, now)
+    
+    def _flush_accesses(self):
+        with self._lock:
+            accesses, self._accesses = self._accesses, {}
+        if accesses:
+            self.db.record_access(accesses)
+    
+    def _archive(self, ids, reason) -> int:
+        # Take memories out of the store (they're kept in the archive table)
+        if not len(ids):
+            return 0
+        self._persist()
+        with self._lock:
+            moved = self.db.archive(ids, reason)  # Only what's on disk - a memory still pending stays
+            if moved:
+                self.index.discard(moved)
+            self._count -= len(moved)
+            for row_id in moved:
+                self._accesses.pop(row_id, None)
+        self._compact_wakeup.set()  # Flat snapshots can drop them once enough are gone
+        return len(moved)
+    
+    def compact(self, kind=None):
+        # Write a new vectors.faiss snapshot covering everything added so far.
+        # Passing a different index kind migrates the store to it. The new index is built
+        # without holding the lock, so recall and add_fact keep working meanwhile.
+        with self._compact_lock:
+            try:
+                start = time.perf_counter()
+                self._persist()  # Rebuilds read the database, so it needs the latest memories
+                with self._lock:
+                    current = self.index.kind()
+                    kind = kind or current
+                    delta_ids, delta_vectors = self.index.delta_rows()
+                    removed = set(self.index.removed)
+                    covered_id = int(delta_ids.max()) if len(delta_ids) else self.index.base_max_id
+                    # Newest memory that's certainly in the database (more may arrive meanwhile)
+                    persisted_id = next(iter(self._pending)) - 1 if self._pending else covered_id
+                    # Only flat snapshots can drop vectors in place (HNSW graphs can't delete,
+                    # IVF lists don't renumber), so for the others deleted ids stay masked out
+                    # of searches until they're a tenth of the index and worth a rebuild
+                    base_size = self.index.base.ntotal if self.index.base is not None else 0
+                    if current != "flat" and len(removed) <= base_size // 10:
+                        removed = set()
+                    # A snapshot storing vectors differently from vector_codec gets re-encoded
+                    recode = self.index.codec != self._codec_for(kind) if self.index.base is not None else self.vector_codec != "fp32"
+                    if not len(delta_ids) and not removed and kind == current and not (recode and self.index.base is not None):
+                        return True  # Nothing new since the last snapshot
+                
+                if kind != current:
+                    print(f"🔧 Migrating memory index: {current} → {kind} ({self.count()} vectors)")
+                elif recode and self.index.base is not None:
+                    print(f"🔧 Re-encoding memory vectors: {self.index.codec} → {self._codec_for(kind)} ({self.count()} vectors)")
+                
+                if kind != current or recode or (self.index.base is None and kind != "flat") or (removed and kind != "flat"):
+                    # Rebuild from the database - memories it doesn't have yet stay in the delta
+                    covered_id = min(covered_id, persisted_id)
+                    snapshot = self._build_index(kind, covered_id)
+                else:
+                    # Update a full in-RAM copy of the current snapshot: drop deleted
+                    # vectors (flat only), append the delta
+                    if self.index.base is not None:
+                        snapshot = faiss.read_index(str(self.index.file))
+                    else:
+                        snapshot = faiss.IndexIDMap(faiss.IndexFlatL2(self.index.dimension))
+                    if removed:
+                        snapshot.remove_ids(faiss.IDSelectorBatch(np.fromiter(removed, dtype=np.int64)))
+                    snapshot.add_with_ids(delta_vectors, delta_ids)
+                
+                # Measure the search effort a new or much bigger approximate index needs
+                effort = None
+                if self._calibration_stale(kind, snapshot.ntotal):
+                    effort = self._calibrate(snapshot, kind, min(covered_id, persisted_id))
+                
+                # Write to a temporary file first so a crash never leaves a half-written snapshot
+                tmp_file = self.path / "vectors.faiss.tmp"
+                faiss.write_index(snapshot, str(tmp_file))
+                with open(tmp_file, "rb+") as f:
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.index.file)
+                del snapshot
+                
+                with self._lock:
+                    self.index.swap_base(covered_id)
+                    self.index.removed -= removed
+                    if effort is not None:
+                        self.stats["search_effort"] = effort
+                self.db.clear_removed(removed)
+                if effort is not None:
+                    self.save_stats()
+                
+                if kind != current:
+                    print(f"✅ Memory index is now {kind} ({time.perf_counter() - start:.1f}s)")
+                return True
+            except Exception as e:
+                print(f"Memory compaction failed: {e}")
+                return False
+    
     def add_fact(self, fact: str, metadata: dict | None = None):
         # Add a new memory to the database
         try:
@@ -143,64 +1929,214 @@ class EchoMemory:
             # Add timestamp and unique ID to the metadata
             if metadata is None:
                 metadata = {}
+            metadata.setdefault("source", "conversation")  # Where it came from, unless the caller said
             metadata.update({
                 "timestamp": str(datetime.now()),  # When this was stored
-                "source": "conversation",  # Where it came from
                 "id": str(uuid.uuid4())  # Unique identifier
             })
+            _check_metadata(metadata)
             
-            # Create a document object
-            doc = Document(page_content=fact.strip(), metadata=metadata)
-            
-            # Check if this is our first real memory
-            real_count = self._count_real_docs()
+            # Convert the memory to a vector, then add it to the index. Writing it to the
+            # database and compacting it into the snapshot happen in the background.
+            content = fact.strip()
+            vector = self.embed.embed_documents([content])[0]
+            with self._lock:
+                # Something the user already told us refreshes that memory instead
+                duplicate = self._find_duplicate(vector, content)
+                if duplicate is not None:
+                    reworded = self._refresh(duplicate, content, vector, metadata)
+                else:
+                    self._insert([content], [vector], [metadata])
             
-            if real_count == 0:
-                # Replace the dummy document with the first real memory
-                self.vstore = FAISS.from_documents([doc], self.embed)
-            else:
-                # Add to the existing store
-                self.vstore.add_documents([doc])
-            
-            # Save the database to disk immediately
-            self.vstore.save_local(str(self.path))
+            if duplicate is not None:
+                self._stats_dirty = True  # Saved by the persistence thread
+                print(f"🔁 Already remembered: {fact[:50]}... ({'updated' if reworded else 'refreshed'})")
+                return True
             
             # Update our statistics
-            new_count = self._count_real_docs()
+            new_count = self.count()
             self.stats["total_memories"] = new_count
             self.stats["last_updated"] = str(datetime.now())
-            self.save_stats()
+            self._stats_dirty = True
             
             # Show confirmation message
             print(f"💾 Remembered: {fact[:50]}... (Total: {new_count})")
             return True
-            
+        
         except Exception as e:
             print(f"Failed to add memory: {e}")
             import traceback
             traceback.print_exc()  # Show full error for debugging
             return False
-
-    def recall(self, query: str, k=5) -> list[str]:
-        # Search for relevant memories based on a query
+    
+    def _find_duplicate(self, vector, content):
+        # Id of an existing memory that says the same thing as `content`, if any
+        return self._find_duplicates([vector], [content])[0]
+    
+    def _find_duplicates(self, vectors, contents) -> list:
+        # _find_duplicate for a batch of facts, with one index search for all of them
+        found = [None] * len(contents)
+        if self.dedup_threshold is None or self.count() == 0 or not contents:
+            return found
+        self.stats["dedup_checks"] = self.stats.get("dedup_checks", 0) + len(contents)
+        
+        # A few nearest neighbours from the index - the closest may be a different fact
+        # about something else ("my son..." for "my daughter...") - then exact cosine
+        # checks on their stored vectors (index distances can be approximate)
+        k = max(DEDUP_CANDIDATES, 1 if self.index.codec == "fp32" else self.rerank_factor)
+        with self._lock:
+            hits = self.index.search_many(vectors, k, *DEDUP_EFFORT)
+        ids, stored = self._vectors_for({row_id for row_hits in hits for row_id, _ in row_hits})
+        if stored is None:
+            return found
+        stored = dict(zip(ids.tolist(), stored / (np.linalg.norm(stored, axis=1, keepdims=True) + 1e-12)))
+        
+        candidates = {}
+        for row, (vector, row_hits) in enumerate(zip(np.asarray(vectors, dtype=np.float32), hits)):
+            vector = vector / (np.linalg.norm(vector) + 1e-12)
+            similarities = sorted(((float(stored[row_id] @ vector), row_id) for row_id, _ in row_hits if row_id in stored), reverse=True)
+            candidates[row] = [row_id for similarity, row_id in similarities if similarity >= self.dedup_threshold]
+        
+        # The most similar that's the same fact, or an update to it, rather than a different one
+        existing = self._fetch({row_id for row_ids in candidates.values() for row_id in row_ids})
+        for row, row_ids in candidates.items():
+            found[row] = next((row_id for row_id in row_ids if row_id in existing and _restates(existing[row_id]["content"], contents[row])), None)
+        self.stats["dedup_hits"] = self.stats.get("dedup_hits", 0) + sum(row_id is not None for row_id in found)
+        return found
+    
+    def _refresh(self, row_id, content, vector, metadata) -> bool:
+        # Merge a repeated fact into the memory it duplicates: keep its first timestamp,
+        # take any new metadata, and count the mention. If the wording changed ("lives in
+        # Leeds" -> "lives in York") the latest text wins: it's added as a new memory with
+        # the old text in "previous_text", and the old one is hidden and queued for the archive.
+        existing = self._fetch([row_id])[row_id]
+        old = existing["metadata"]
+        merged = {**old, **{key: value for key, value in metadata.items() if key not in ("id", "timestamp")}}
+        merged["timestamp"] = old.get("timestamp", metadata["timestamp"])
+        merged["last_seen"] = metadata["timestamp"]
+        merged["mentions"] = old.get("mentions", 1) + 1
+        
+        if _same_words(existing["content"], content):
+            merged["id"] = old["id"]
+            self._pending_metadata[row_id] = merged  # Written by the persistence thread
+            return False
+        merged["id"] = metadata["id"]
+        merged["supersedes"] = old["id"]
+        merged["previous_text"] = existing["content"]
+        self._insert([content], [vector], [merged])
+        self._supersede(row_id)
+        return True
+    
+    def _supersede(self, row_id):
+        # Hide a replaced memory straight away and leave moving it to the archive table to
+        # the persistence thread, so a reworded fact never waits on the disk. Lock held.
+        self.index.discard([row_id])
+        self._count -= 1
+        self._accesses.pop(row_id, None)
+        self._pending_archive[row_id] = "superseded"
+        self._persist_wakeup.set()
+    
+    def add_facts(self, facts: list[str], metadatas: dict | list[dict] | None = None, batch_size: int = 64,
+                  dedup: bool = True) -> dict:
+        # Add many memories at once - for importing history or migrating stores.
+        # Embeds in batches, adds everything to the index in one go and persists once.
+        # dedup=False skips checking against stored memories, for imports known to be new.
+        start = time.perf_counter()
         try:
-            # Check if we have any real memories stored
-            real_count = self._count_real_docs()
+            # Accept one metadata dict for every fact, or one per fact
+            if metadatas is None or isinstance(metadatas, dict):
+                metadatas = [dict(metadatas or {}) for _ in facts]
+            elif len(metadatas) != len(facts):
+                raise ValueError(f"Got {len(metadatas)} metadata dicts for {len(facts)} facts")
             
-            if real_count == 0:
+            # Drop empty facts and stamp the rest like add_fact does
+            texts, metas = [], []
+            for fact, metadata in zip(facts, metadatas):
+                if not fact.strip():
+                    continue
+                metadata = dict(metadata or {})
+                metadata.setdefault("source", "conversation")  # Where it came from, unless the caller said
+                metadata.update({
+                    "timestamp": str(datetime.now()),  # When this was stored
+                    "id": str(uuid.uuid4())  # Unique identifier
+                })
+                texts.append(fact.strip())
+                metas.append(_check_metadata(metadata))
+            
+            # Embed batch by batch - one model call per batch instead of per fact
+            vectors = []
+            for i in range(0, len(texts), batch_size):
+                vectors.extend(self.embed.embed_documents(texts[i:i + batch_size]))
+            
+            # Facts we already remember refresh (or update) those memories like add_fact,
+            # and a fact repeated within the import is only added once
+            new_texts, new_vectors, new_metas, superseded = [], [], [], []
+            first_seen = {}
+            refreshed = 0
+            with self._lock:
+                duplicates = self._find_duplicates(vectors, texts) if dedup else [None] * len(texts)
+                for text, vector, metadata, duplicate in zip(texts, vectors, metas, duplicates):
+                    words = tuple(re.findall(r"\w+", text.lower()))
+                    if words in first_seen:
+                        earlier = new_metas[first_seen[words]]
+                        earlier["mentions"] = earlier.get("mentions", 1) + 1
+                        refreshed += 1
+                        continue
+                    if duplicate is not None and duplicate in superseded:
+                        duplicate = self._find_duplicate(vector, text)  # Reworded earlier in this import
+                    if duplicate is not None:
+                        if self._refresh(duplicate, text, vector, metadata):
+                            superseded.append(duplicate)
+                        refreshed += 1
+                        continue
+                    first_seen[words] = len(new_texts)
+                    new_texts.append(text)
+                    new_vectors.append(vector)
+                    new_metas.append(metadata)
+                
+                if new_texts:
+                    # One index add for the whole import (and one database transaction, in the background)
+                    self._insert(new_texts, new_vectors, new_metas)
+            
+            if texts:
+                # Update our statistics
+                self.stats["total_memories"] = self.count()
+                self.stats["last_updated"] = str(datetime.now())
+                self._stats_dirty = True
+            
+            # Report throughput for the whole call
+            elapsed = time.perf_counter() - start
+            docs_per_sec = len(texts) / elapsed if elapsed > 0 else 0.0
+            print(f"💾 Bulk-added {len(new_texts)} memories ({refreshed} already remembered) in {elapsed:.2f}s = {docs_per_sec:.1f} docs/sec")
+            return {
+                "added": len(new_texts),
+                "refreshed": refreshed,
+                "skipped": len(facts) - len(texts),
+                "seconds": elapsed,
+                "docs_per_sec": docs_per_sec
+            }
+        
+        except Exception as e:
+            print(f"Failed to add memories: {e}")
+            import traceback
+            traceback.print_exc()  # Show full error for debugging
+            return {"added": 0, "refreshed": 0, "skipped": len(facts), "seconds": time.perf_counter() - start, "docs_per_sec": 0.0}
+    
+    def recall(self, query: str, k=5, where: dict | None = None) -> list[str]:
+        # Search for relevant memories based on a query.
+        # `where` filters on metadata, e.g. {"importance": "high"} or
+        # {"source": "web_chat", "timestamp": {"$gt": "2025-07-01"}}
+        try:
+            # Check if we have any memories stored
+            if self.count() == 0:
                 print("🧠 No memories stored yet")
                 return []
             
-            # Search for similar memories (get extra results to filter out dummy docs)
-            docs_and_scores = self.vstore.similarity_search_with_score(query, k=k*2)
-            
-            # Filter out dummy documents and keep the best matches
-            real_memories = []
-            for doc, score in docs_and_scores:
-                if not doc.metadata.get("temp", False):  # Skip temporary docs
-                    real_memories.append(doc.page_content)
-                if len(real_memories) >= k:  # Stop when we have enough
-                    break
+            # Search for relevant memories, then load just those documents
+            hits = self._retrieve(query, k, where)
+            docs = self._fetch([doc_id for doc_id, _, _ in hits])
+            real_memories = [docs[doc_id]["content"] for doc_id, _, _ in hits if doc_id in docs]
+            self._note_access([doc_id for doc_id, _, _ in hits if doc_id in docs])  # Recalled memories stay fresh
             
             if real_memories:
                 print(f"🔍 Recalled {len(real_memories)} relevant memories")
@@ -211,68 +2147,415 @@ class EchoMemory:
                 print("🧠 No relevant memories found")
             
             return real_memories
-            
+        
         except Exception as e:
             print(f"Memory recall failed: {e}")
             return []
-
+    
     def get_all_memories(self) -> list[dict]:
-        # Return all stored memories with their metadata
+        # Return all stored memories with their metadata, oldest first.
+        # Loads the whole store - use page_memories, recent_memories or export_jsonl for big ones.
         try:
-            all_memories = []
-            real_docs = self._get_real_docs()  # Get all real documents
-            
-            # Convert each document to a dictionary
-            for doc in real_docs:
-                all_memories.append({
-                    "content": doc.page_content,  # The actual memory text
-                    "metadata": doc.metadata  # Additional information
-                })
-            return all_memories
+            self._persist()  # Make sure the database has everything first
+            return [doc for _, doc in self.db.documents()]
         except Exception as e:
             print(f"Failed to retrieve all memories: {e}")
             return []
-
-    def search_memories(self, query: str, k=10) -> list[dict]:
-        # Search memories and return results with similarity scores
+    
+    def page_memories(self, cursor=None, limit=20, newest_first=True) -> dict:
+        # One page of memories in the order they were stored, plus the cursor for the next
+        # page (None at the end). Cost follows `limit`, not the size of the store.
+        try:
+            cursor = int(cursor) if cursor not in (None, "") else None
+            limit = max(1, min(int(limit), 1000))
+            
+            # Memories still waiting to be written are the newest ones, so they sit at the
+            # front (or end) of the order
+            def after_cursor(row_id):
+                return cursor is None or (row_id < cursor if newest_first else row_id > cursor)
+            with self._lock:
+                pending = {
+                    i: {"content": row[1], "metadata": self._pending_metadata.get(i, row[2])}
+                    for i, row in self._pending.items() if after_cursor(i)
+                }
+            
+            page = dict(self.db.page(cursor, limit, newest_first))
+            page.update(pending)
+            with self._lock:
+                for i in page:
+                    if i in self._pending_metadata:
+                        page[i]["metadata"] = self._pending_metadata[i]
+            
+            ids = sorted(page, reverse=newest_first)[:limit]
+            return {
+                "memories": [page[i] for i in ids],
+                "next_cursor": ids[-1] if len(ids) == limit else None
+            }
+        except Exception as e:
+            print(f"Failed to page memories: {e}")
+            return {"memories": [], "next_cursor": None}
+    
+    def recent_memories(self, n=5) -> list[dict]:
+        # The n most recently stored memories, newest first - read straight off the id index
+        return self.page_memories(limit=n)["memories"]
+    
+    def export_lines(self, include_vectors=False):
+        # Every memory as a line of JSON, oldest first, read from disk a page at a time.
+        # With include_vectors the embeddings go along too, so importing them into a store
+        # using the same model skips re-embedding.
+        self._persist()
+        for _, doc in self.db.documents(vectors=include_vectors):
+            line = {"content": doc["content"], "metadata": doc["metadata"]}
+            if include_vectors:
+                line["vector"] = base64.b64encode(doc["vector"]).decode("ascii")
+                line["model"] = self.embed.model_name
+            yield json.dumps(line) + "\n"
+    
+    def export_jsonl(self, file, include_vectors=False) -> int:
+        # Back up all memories to a JSONL file; returns how many were written
+        try:
+            count = 0
+            with open(file, "w", encoding="utf-8") as f:
+                for line in self.export_lines(include_vectors):
+                    f.write(line)
+                    count += 1
+            print(f"📤 Exported {count} memories to {file}")
+            return count
+        except Exception as e:
+            print(f"Memory export failed: {e}")
+            return 0
+    
+    def import_jsonl(self, source, batch_size=256) -> dict:
+        # Restore memories from export_jsonl output - a file path or any iterable of lines
+        # (e.g. an open file or an upload stream). Memories already in the store (same id)
+        # are skipped, and metadata is kept as exported.
+        start = time.perf_counter()
+        imported = skipped = 0
+        
+        def add_batch(batch):
+            # Skip memories we already have, reuse exported vectors from the same model, embed the rest
+            with self._lock:
+                pending = {row[0] for row in self._pending.values()}
+            seen = self.db.existing_uids(line["metadata"]["id"] for line in batch) | pending
+            fresh = []
+            for line in batch:
+                if line["metadata"]["id"] not in seen:  # Also drops repeats within the file
+                    seen.add(line["metadata"]["id"])
+                    fresh.append(line)
+            vectors = [None] * len(fresh)
+            for i, line in enumerate(fresh):
+                if line.get("vector") and line.get("model") == self.embed.model_name:
+                    vector = np.frombuffer(base64.b64decode(line["vector"]), dtype=np.float32)
+                    if len(vector) == self.index.dimension:
+                        vectors[i] = vector.tolist()
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+            if missing:
+                for i, vector in zip(missing, self.embed.embed_documents([fresh[i]["content"] for i in missing])):
+                    vectors[i] = vector
+            if fresh:
+                self._insert([line["content"] for line in fresh], vectors, [line["metadata"] for line in fresh])
+            return len(fresh), len(batch) - len(fresh)
+        
         try:
-            real_count = self._count_real_docs()
+            lines = open(source, encoding="utf-8") if isinstance(source, (str, Path)) else source
+            try:
+                batch = []
+                for raw in lines:
+                    if not raw.strip():
+                        continue
+                    line = json.loads(raw)
+                    if not str(line.get("content", "")).strip():
+                        skipped += 1
+                        continue
+                    metadata = dict(line.get("metadata") or {})
+                    metadata.setdefault("id", str(uuid.uuid4()))
+                    metadata.setdefault("timestamp", str(datetime.now()))
+                    try:
+                        line["metadata"] = _check_metadata(metadata)
+                    except ValueError as e:
+                        print(f"⚠️ Skipping imported memory {metadata['id']}: {e}")
+                        skipped += 1
+                        continue
+                    batch.append(line)
+                    if len(batch) >= batch_size:
+                        added, duplicates = add_batch(batch)
+                        imported, skipped = imported + added, skipped + duplicates
+                        batch = []
+                if batch:
+                    added, duplicates = add_batch(batch)
+                    imported, skipped = imported + added, skipped + duplicates
+            finally:
+                if lines is not source:
+                    lines.close()
             
+            self.stats["total_memories"] = self.count()
+            self.stats["last_updated"] = str(datetime.now())
+            self._stats_dirty = True
+            elapsed = time.perf_counter() - start
+            print(f"📥 Imported {imported} memories ({skipped} skipped) in {elapsed:.2f}s")
+            return {"imported": imported, "skipped": skipped, "seconds": elapsed}
+        
+        except Exception as e:
+            print(f"Memory import failed: {e}")
+            return {"imported": imported, "skipped": skipped, "seconds": time.perf_counter() - start, "error": str(e)}
+    
+    def search_memories(self, query: str, k=10, where: dict | None = None) -> list[dict]:
+        # Search memories and return results with similarity scores (`where` as in recall)
+        try:
             # Return empty if no memories exist
-            if real_count == 0:
+            if self.count() == 0:
                 return []
             
             # Search with similarity scores
-            docs_and_scores = self.vstore.similarity_search_with_score(query, k=k)
+            hits = self._retrieve(query, k, where)
+            docs = self._fetch([doc_id for doc_id, _, _ in hits])
+            self._note_access([doc_id for doc_id, _, _ in hits if doc_id in docs])
             
             results = []
-            for doc, score in docs_and_scores:
-                # Skip dummy documents
-                if not doc.metadata.get("temp", False):
-                    results.append({
-                        "content": doc.page_content,  # The memory text
-                        "metadata": doc.metadata,  # Additional info
-                        "similarity_score": float(score)  # How relevant it is
-                    })
+            for doc_id, score, fusion_score in hits:
+                if doc_id not in docs:
+                    continue
+                results.append({
+                    "content": docs[doc_id]["content"],  # The memory text
+                    "metadata": docs[doc_id]["metadata"],  # Additional info
+                    "similarity_score": float(score),  # Vector distance (lower is closer)
+                    "fusion_score": fusion_score  # Combined keyword + vector rank (higher is better)
+                })
             
             return results
-            
+        
         except Exception as e:
             print(f"Memory search failed: {e}")
             return []
-
+    
     def get_memory_stats(self) -> dict:
         # Get current statistics about the memory system
-        current_count = self._count_real_docs()
-        self.stats["current_memories"] = current_count
-        return self.stats
-
-    def flush(self):
-        # Force save everything to disk
+        self.stats["current_memories"] = self.count()
+        checks = self.stats.get("dedup_checks", 0)
+        self.stats["dedup_hit_rate"] = self.stats.get("dedup_hits", 0) / checks if checks else 0.0
+        # Cache counters and index state are live values, so they're reported but not saved
+        return {
+            **self.stats,
+            "pending_writes": len(self._pending),
+            "index_type": self.index.kind(),
+            "index_migrating": self._migration is not None and self._migration.is_alive(),
+            "embedding_cache": self.embed.stats()
+        }
+    
+    def flush(self) -> bool:
+        # Force save everything to disk - writes a fresh snapshot of the index.
+        # Returns False if some new memories are still only in RAM.
         try:
-            self.vstore.save_local(str(self.path))  # Save vector database
+            written = self._persist()  # Write pending memories
+            self.compact()  # Save vector index
             self.save_stats()  # Save statistics
-            real_count = self._count_real_docs()
-            print(f"💾 Memory saved ({real_count} memories)")
+            if not written:
+                print(f"⚠️ Memory snapshot saved, but {len(self._pending)} new memories couldn't be written to the database")
+                return False
+            print(f"💾 Memory saved ({self.count()} memories)")
+            return True
         except Exception as e:
-            print(f"Failed to save memory: {e}")
\ No newline at end of file
+            print(f"Failed to save memory: {e}")
+            return False
+    
+    def close(self):
+        # Stop the background jobs and write a final snapshot
+        if self._migration is not None:
+            self._migration.join()  # Let a running migration finish so the snapshot has the new index
+        self._stop_lifecycle.set()
+        if self._lifecycle_thread is not None:
+            self._lifecycle_thread.join()  # A running pass stops at its next checkpoint
+        self._stop_compactor.set()
+        self._compact_wakeup.set()
+        self._compactor.join(timeout=5)
+        self._stop_persister.set()
+        self._persist_wakeup.set()
+        self._persister.join()
+        if not self.flush():
+            # Last chance - keep what the database wouldn't take in rejected.jsonl
+            with self._lock:
+                rows = [(i, *row) for i, row in self._pending.items()]
+            self._set_aside(rows, "not written to the database before closing")
+        atexit.unregister(self._persist)
+        self.db.close()
+
+class MemoryShards:
+    # One EchoMemory per user or session, each in its own folder under `root`, so tenants
+    # never share an index. Only recently used shards stay open - when there are more
+    # than `max_open`, or their estimated RAM passes `memory_budget_mb`, the coldest ones
+    # are flushed to disk and closed. They reopen (quickly, thanks to the mmapped
+    # snapshot) the next time they're used. All shards share one embeddings model.
+    def __init__(self, root="memory/users", max_open=32, memory_budget_mb=1024, **memory_kwargs):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_open = max_open
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.memory_kwargs = memory_kwargs
+        
+        # One model and one cache for every shard
+        self.embed = CachedEmbeddings(
+            load_embeddings(memory_kwargs.pop("embed_backend", None)),
+            max_entries=memory_kwargs.pop("embed_cache_size", 4096),
+            disk_folder=self.root / "embed_cache" if memory_kwargs.pop("embed_cache_disk", True) else None,
+            disk_entries=memory_kwargs.pop("embed_cache_disk_entries", 100_000)
+        )
+        
+        self.lock = threading.Lock()
+        self.shards = OrderedDict()  # namespace -> EchoMemory, most recently used last
+        self.in_use = {}  # namespace -> number of requests currently using the shard
+        self.closing = {}  # namespace -> event set once an evicted shard is fully closed
+        self.opening = {}  # namespace -> event set once a shard being opened is ready (or failed)
+        self.loads = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def folder_name(namespace: str) -> str:
+        # Safe, stable folder name for any user or session id
+        name = "".join(c for c in str(namespace) if c.isalnum() or c in "-_")[:64]
+        if name != str(namespace) or not name:
+            name = f"{name[:40]}-{hashlib.sha1(str(namespace).encode('utf-8')).hexdigest()[:12]}"
+        return name
+    
+    @staticmethod
+    def footprint(mem) -> int:
+        # Rough resident size of an open shard: the snapshot (its pages end up mapped in as
+        # it's searched) plus the in-RAM delta vectors
+        size = mem.index.delta.ntotal * mem.index.dimension * 4
+        if mem.index.file.exists():
+            size += mem.index.file.stat().st_size
+        return size
+    
+    def exists(self, namespace) -> bool:
+        # Whether a tenant has a memory store yet (open or on disk)
+        with self.lock:
+            if namespace in self.shards or namespace in self.opening:
+                return True
+        return (self.root / self.folder_name(namespace)).exists()
+    
+    def acquire(self, namespace) -> EchoMemory:
+        # Get a tenant's memory, opening it if needed; pair with release()
+        while True:
+            with self.lock:
+                busy = self.closing.get(namespace) or self.opening.get(namespace)
+                if busy is None:
+                    mem = self.shards.get(namespace)
+                    if mem is not None:
+                        cold = self._claim(namespace)
+                        break
+                    opened = self.opening[namespace] = threading.Event()
+            if busy is not None:
+                # Still being written out or opened by another request - wait, then retry
+                busy.wait()
+                continue
+            
+            # Open it without holding the lock, so other tenants aren't held up meanwhile
+            try:
+                mem = EchoMemory(self.root / self.folder_name(namespace), embed=self.embed, **self.memory_kwargs)
+            except Exception:
+                with self.lock:
+                    del self.opening[namespace]
+                opened.set()
+                raise
+            with self.lock:
+                del self.opening[namespace]
+                self.shards[namespace] = mem
+                self.loads += 1
+                cold = self._claim(namespace)
+            opened.set()
+            break
+        self._close(cold)
+        return mem
+    
+    def _claim(self, namespace) -> list:
+        # Mark an open shard in use and pick any others to evict (lock held)
+        self.shards.move_to_end(namespace)
+        self.in_use[namespace] = self.in_use.get(namespace, 0) + 1
+        return self._evict_cold()
+    
+    def release(self, namespace):
+        with self.lock:
+            self.in_use[namespace] -= 1
+            if self.in_use[namespace] <= 0:
+                del self.in_use[namespace]
+            cold = self._evict_cold()
+        self._close(cold)
+    
+    @contextmanager
+    def use(self, namespace):
+        # with shards.use(user_id) as mem: ...
+        mem = self.acquire(namespace)
+        try:
+            yield mem
+        finally:
+            self.release(namespace)
+    
+    def _evict_cold(self) -> list:
+        # Pick least recently used shards to drop until we're under both limits (lock held)
+        cold = []
+        total = sum(self.footprint(mem) for mem in self.shards.values())
+        for namespace in list(self.shards):
+            if len(self.shards) <= self.max_open and total <= self.memory_budget:
+                break
+            if namespace in self.in_use:
+                continue  # Never close a shard a request is using
+            mem = self.shards.pop(namespace)
+            total -= self.footprint(mem)
+            cold.append((namespace, mem))
+            self.closing[namespace] = threading.Event()
+            self.evictions += 1
+        return cold
+    
+    def _close(self, cold):
+        # Flush evicted shards to disk outside the lock, so other tenants aren't held up
+        for namespace, mem in cold:
+            try:
+                mem.close()
+                print(f"💤 Unloaded memory shard {namespace}")
+            finally:
+                with self.lock:
+                    self.closing.pop(namespace).set()
+    
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "open_shards": len(self.shards),
+                "max_open": self.max_open,
+                "estimated_bytes": sum(self.footprint(mem) for mem in self.shards.values()),
+                "memory_budget_bytes": self.memory_budget,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "embedding_cache": self.embed.stats()
+            }
+    
+    def close_all(self):
+        # Flush and close every open shard (e.g. on shutdown)
+        with self.lock:
+            while self.shards:
+                _, mem = self.shards.popitem(last=False)
+                mem.close()
+
+# Run directly to convert old stores (python RAG.py migrate [folders...]), back up and
+# restore one (python RAG.py export|import <folder> <file.jsonl>), to check the ONNX
+# embeddings against PyTorch (python RAG.py embeddings-check) or to check which facts
+# count as duplicates (python RAG.py dedup-check)
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        for folder in sys.argv[2:] or ["memory", "demo_memory"]:
+            if migrate_legacy_store(folder) == 0:
+                print(f"Nothing to migrate in {folder}")
+    elif len(sys.argv) == 4 and sys.argv[1] in ("export", "import"):
+        # Back up or restore a store: python RAG.py export|import <memory folder> <file.jsonl>
+        mem = EchoMemory(sys.argv[2], lifecycle_interval=None)
+        if sys.argv[1] == "export":
+            mem.export_jsonl(sys.argv[3], include_vectors=True)
+        else:
+            mem.import_jsonl(sys.argv[3])
+        mem.close()
+    elif len(sys.argv) >= 2 and sys.argv[1] == "dedup-check":
+        # Check which facts count as repeats or updates: python RAG.py dedup-check
+        sys.exit(1 if check_dedup() else 0)
+    elif len(sys.argv) >= 2 and sys.argv[1] == "embeddings-check":
+        # Compare the ONNX int8 backend with PyTorch: python RAG.py embeddings-check
+        compare_embeddings(HuggingFaceEmbeddings(model_name=EMBEDDINGS_MODEL), OnnxEmbeddings())
+    else:
+        print("Usage: python RAG.py migrate [memory folders...] | export|import <memory folder> <file.jsonl> | embeddings-check | dedup-check")
@@ -0,0 +1,298 @@
+from RAG import EchoMemory, load_embeddings, BACKUP_EMBEDDINGS_MODEL
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import string
+import tempfile
+import time
+import numpy as np
+
+try:
+    import psutil  # For memory usage (RSS)
+except ImportError:
+    psutil = None
+
+# Where EchoMemory's progress messages go while we're timing it
+DEVNULL = open(os.devnull, "w")
+
+# Building blocks for the synthetic memories - the kind of facts EchoPaw stores
+NAMES = ["Sarah", "James", "Margaret", "David", "Helen", "Robert", "Susan", "Peter", "Linda", "Michael",
+         "Anne", "George", "Patricia", "Thomas", "Mary", "William", "Joan", "Richard", "Elizabeth", "Charles",
+         "Barbara", "Edward", "Dorothy", "Frank", "Jean", "Arthur", "Irene", "Harold", "Sheila", "Kenneth",
+         "Brenda", "Ronald", "Maureen", "Alan", "Pauline", "Brian", "Janet", "Keith", "Carol", "Derek"]
+RELATIONS = ["sister", "brother", "daughter", "son", "mother", "father", "grandson", "granddaughter",
+             "neighbour", "friend", "niece", "nephew"]
+PLACES = ["Manchester", "Leeds", "Brighton", "Cardiff", "Glasgow", "Bristol", "York", "Norwich", "Bath",
+          "Oxford", "Liverpool", "Edinburgh", "Belfast", "Plymouth", "Exeter", "Durham", "Chester", "Whitby",
+          "Blackpool", "Dover", "Aberdeen", "Inverness", "Swansea", "Harrogate", "Cambridge", "Lincoln",
+          "Scarborough", "Keswick", "Truro", "Hull"]
+JOBS = ["nurse", "teacher", "postman", "baker", "engineer", "librarian", "farmer", "electrician",
+        "shopkeeper", "policeman", "doctor", "carpenter", "accountant", "hairdresser", "bus driver"]
+HOBBIES = ["gardening", "knitting", "fishing", "ballroom dancing", "birdwatching", "crosswords", "bowls",
+           "painting", "baking", "walking", "choir singing", "bridge", "jigsaw puzzles", "golf", "chess"]
+PETS = ["dog", "cat", "budgie", "rabbit", "tortoise", "goldfish", "horse", "parrot"]
+PET_NAMES = ["Max", "Bella", "Charlie", "Daisy", "Buster", "Molly", "Rex", "Poppy", "Toby", "Rosie",
+             "Sooty", "Bramble", "Pip", "Ginger", "Lady", "Duke"]
+
+# (fact, labelled query) templates. A query is answered by every fact from its template
+# with the same values for the fields the query mentions, and mentions enough of them that
+# it's usually only the fact it came from (about two answers per query at 100k facts).
+TEMPLATES = [
+    ("My {relation} {name} lives in {place} and visits every {year}",
+     "Where does my {relation} {name}, who visits every {year}, live?"),
+    ("My {relation} {name} worked as a {job} in {place} until {year}",
+     "What job did {name} my {relation} do in {place} until {year}?"),
+    ("{name}, my {relation}, has loved {hobby} since {year}", "What has my {relation} {name} loved since {year}?"),
+    ("We had a {pet} called {pet_name} when we lived in {place} in {year}",
+     "Tell me about our {pet} {pet_name} from {place} in {year}"),
+    ("I went to {place} with {name} my {relation} in {year} for a holiday", "When did I go to {place} with my {relation} {name}?"),
+    ("My {relation} {name} taught me {hobby} in {place}", "Which {relation} taught me {hobby} in {place}?"),
+]
+
+class HashEmbeddings(Embeddings):
+    # Deterministic offline embeddings: words and word pairs hashed into a fixed-size
+    # vector. No model download and no GPU, so benchmark numbers only move when the
+    # memory system changes - use --embed torch/onnx to include a real model's cost.
+    # It only matches shared words, so its label hit rate says little about retrieval
+    # quality - use --embed minilm for that.
+    def __init__(self, dimension=384):
+        self.dimension = dimension
+        self.model_name = f"hash-{dimension}"
+    
+    def _vector(self, text):
+        words = [word.strip(".,?!'\"").lower() for word in text.split()]
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = int(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).hexdigest(), 16)
+            vector[digest % self.dimension] += 1.0 if (digest >> 32) & 1 else -1.0  # Signed, so collisions cancel out
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+    
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._vector(text) for text in texts]
+    
+    def embed_query(self, text: str) -> list[float]:
+        return self._vector(text)
+
+def load_minilm():
+    # A small real sentence-transformers model, only ever read from the local Hugging Face
+    # cache so the benchmark stays offline
+    try:
+        embed = HuggingFaceEmbeddings(model_name=BACKUP_EMBEDDINGS_MODEL, model_kwargs={"local_files_only": True})
+    except Exception as e:
+        raise SystemExit(f"❌ Couldn't load {BACKUP_EMBEDDINGS_MODEL} from the local Hugging Face cache ({e}) - "
+                         f"run EchoPaw once online, or use --embed hash")
+    embed.model_name = BACKUP_EMBEDDINGS_MODEL
+    return embed
+
+def make_corpus(size, num_queries, seed=42):
+    # Synthetic facts plus labelled queries: [(query, indexes of every fact that answers it)]
+    rng = random.Random(seed)
+    asked = set(rng.sample(range(size), min(num_queries, size)))
+    facts, asked_keys = [], []
+    answers = {}  # (template, values the query mentions) -> facts that answer it
+    for i in range(size):
+        template = rng.randrange(len(TEMPLATES))
+        fact_template, query_template = TEMPLATES[template]
+        values = {
+            "name": rng.choice(NAMES), "relation": rng.choice(RELATIONS), "place": rng.choice(PLACES),
+            "job": rng.choice(JOBS), "hobby": rng.choice(HOBBIES), "pet": rng.choice(PETS),
+            "pet_name": rng.choice(PET_NAMES), "year": rng.randint(1940, 2024)
+        }
+        facts.append(fact_template.format(**values))
+        fields = sorted({field for _, field, _, _ in string.Formatter().parse(query_template) if field})
+        key = (template, tuple(values[field] for field in fields))
+        answers.setdefault(key, []).append(i)
+        if i in asked:
+            asked_keys.append((query_template.format(**values), key))
+    queries = [(query, frozenset(answers[key])) for query, key in asked_keys]
+    rng.shuffle(queries)
+    return facts, queries
+
+def percentiles(samples) -> dict:
+    # Latency summary in milliseconds
+    samples = np.array(samples) * 1000
+    return {
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "mean": float(samples.mean()),
+        "count": len(samples)
+    }
+
+def rss_mb():
+    return psutil.Process().memory_info().rss / 1024 / 1024 if psutil else None
+
+def folder_bytes(folder) -> dict:
+    # On-disk size of a store's files
+    sizes = {path.name: path.stat().st_size for path in Path(folder).iterdir() if path.is_file()}
+    return {
+        "vectors_faiss": sizes.get("vectors.faiss", 0),
+        "memories_db": sum(size for name, size in sizes.items() if name.startswith("memories.db")),
+        "total": sum(sizes.values())
+    }
+
+def exact_neighbours(mem, query_vectors, k) -> np.ndarray:
+    # Brute-force top-k distances over every stored vector - the ground truth for recall@k.
+    # Reads the vectors a page at a time, so it works for stores larger than RAM.
+    queries = np.asarray(query_vectors, dtype=np.float32)
+    best_ids = np.full((len(queries), 0), -1, dtype=np.int64)
+    best_distances = np.zeros((len(queries), 0), dtype=np.float32)
+    for ids, vectors in mem.db.vectors():
+        distances = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ vectors.T + (vectors ** 2).sum(axis=1)[None, :]
+        all_ids = np.concatenate([best_ids, np.broadcast_to(ids, (len(queries), len(ids)))], axis=1)
+        all_distances = np.concatenate([best_distances, distances], axis=1)
+        keep = np.argsort(all_distances, axis=1)[:, :k]
+        best_ids = np.take_along_axis(all_ids, keep, axis=1)
+        best_distances = np.take_along_axis(all_distances, keep, axis=1)
+    return best_distances
+
+def recall_at_k(mem, query_vectors, k) -> float:
+    # Share of the exact top-k that the index search returns. A result counts if it's at
+    # least as close as the exact k-th neighbour, so ties between equally close memories
+    # don't count as misses.
+    kth = exact_neighbours(mem, query_vectors, k)[:, -1]
+    scores = []
+    for vector, limit in zip(query_vectors, kth):
+        found = [row_id for row_id, _ in mem._search(vector, k)]
+        ids, vectors = mem.db.vectors_for(found)
+        if vectors is None:
+            scores.append(0.0)
+            continue
+        distances = ((vectors - np.asarray(vector, dtype=np.float32)) ** 2).sum(axis=1)
+        scores.append(float((distances <= limit + 1e-4).sum()) / k)
+    return float(np.mean(scores))
+
+def run_size(size, args, embed) -> dict:
+    # Build a store of `size` memories and measure it
+    print(f"\n📏 {size:,} memories")
+    facts, queries = make_corpus(size, args.queries, args.seed)
+    folder = Path(tempfile.mkdtemp(prefix=f"echopaw-bench-{size}-", dir=args.workdir))
+    rss_before = rss_mb()
+    
+    try:
+        with redirect_stdout(DEVNULL):
+            mem = EchoMemory(
+                path=folder, embed=embed, embed_cache_size=args.embed_cache, embed_cache_disk=False,
+                lifecycle_interval=None, recall_target=args.recall_target, vector_codec=args.codec
+            )
+        
+        # Ingest: add_facts in batches, then wait for the snapshot (and any index migration)
+        start = time.perf_counter()
+        with redirect_stdout(DEVNULL):
+            for i in range(0, size, args.batch):
+                mem.add_facts(facts[i:i + args.batch], [{"category": "bench", "bench_index": j} for j in range(i, min(i + args.batch, size))])
+        add_seconds = time.perf_counter() - start
+        with redirect_stdout(DEVNULL):
+            if mem._migration is not None:
+                mem._migration.join()
+            mem.flush()
+        ingest_seconds = time.perf_counter() - start
+        print(f"   💾 Ingested in {ingest_seconds:.1f}s ({size / ingest_seconds:,.0f} facts/sec), {mem.index.kind()} index ({mem.index.codec})")
+        
+        # Query latency - recall prints every hit, so keep that out of the timing
+        recall_times, search_times, label_hits = [], [], 0
+        with redirect_stdout(DEVNULL):
+            for query, _ in queries[:args.warmup]:
+                mem.recall(query, k=args.k)
+            for query, label in queries:
+                start = time.perf_counter()
+                mem.recall(query, k=args.k)
+                recall_times.append(time.perf_counter() - start)
+                
+                start = time.perf_counter()
+                results = mem.search_memories(query, k=args.k)
+                search_times.append(time.perf_counter() - start)
+                label_hits += any(result["metadata"].get("bench_index") in label for result in results)
+        
+        # recall@k: how much of the exact top-k the index search finds
+        query_vectors = embed.embed_documents([query for query, _ in queries])
+        recall = recall_at_k(mem, query_vectors, args.k)
+        
+        result = {
+            "size": size,
+            "index_type": mem.index.kind(),
+            "vector_codec": mem.index.codec,
+            "search_effort": mem.stats.get("search_effort"),  # efSearch/nprobe calibrated for recall_target
+            "ingest": {
+                "seconds": ingest_seconds,
+                "add_seconds": add_seconds,
+                "facts_per_sec": size / ingest_seconds
+            },
+            "latency_ms": {
+                "recall": percentiles(recall_times),
+                "search_memories": percentiles(search_times)
+            },
+            f"recall_at_{args.k}": recall,
+            f"label_hit_rate_at_{args.k}": label_hits / len(queries),  # A result answers the query
+            "answers_per_query": float(np.mean([len(label) for _, label in queries])),
+            "disk_bytes": folder_bytes(folder),
+            "rss_mb": rss_mb(),
+            "rss_growth_mb": rss_mb() - rss_before if psutil else None,
+            "embedding_cache": mem.embed.stats()
+        }
+        print(f"   ⏱️ recall p50 {result['latency_ms']['recall']['p50']:.2f} ms, "
+              f"p99 {result['latency_ms']['recall']['p99']:.2f} ms | "
+              f"recall@{args.k} {recall:.3f} | label hits {result[f'label_hit_rate_at_{args.k}']:.3f}")
+        
+        with redirect_stdout(DEVNULL):
+            mem.close()
+        return result
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark EchoMemory retrieval on synthetic memories")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000],
+                        help="Store sizes to test (up to 1,000,000)")
+    parser.add_argument("--queries", type=int, default=200, help="Labelled queries per size")
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed queries before measuring")
+    parser.add_argument("--k", type=int, default=5, help="Results per query")
+    parser.add_argument("--batch", type=int, default=1000, help="Facts per add_facts call")
+    parser.add_argument("--embed", choices=["hash", "minilm", "torch", "onnx"], default="hash",
+                        help="hash = offline hashing embedder (default), minilm = all-MiniLM-L6-v2 "
+                             "from the local cache, torch/onnx = the real model")
+    parser.add_argument("--embed-cache", type=int, default=4096, help="Embedding LRU size (0 = no cache)")
+    parser.add_argument("--recall-target", type=float, default=0.95, help="EchoMemory recall_target")
+    parser.add_argument("--codec", choices=["fp32", "fp16", "sq8"], default="fp32",
+                        help="How the index snapshot stores vectors (EchoMemory vector_codec)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", default=None, help="Where to build the stores (default: system temp)")
+    parser.add_argument("--keep", action="store_true", help="Keep the stores afterwards")
+    parser.add_argument("--output", default="bench_results.json", help="JSON results file")
+    args = parser.parse_args()
+    
+    if args.embed == "hash":
+        embed = HashEmbeddings()
+    elif args.embed == "minilm":
+        embed = load_minilm()
+    else:
+        embed = load_embeddings(args.embed)
+    print(f"🏁 EchoMemory benchmark: sizes {args.sizes}, {args.queries} queries, k={args.k}, "
+          f"embeddings {getattr(embed, 'model_name', args.embed)}")
+    
+    results = {
+        "created": str(datetime.now()),
+        "config": {**vars(args), "embedding_model": getattr(embed, "model_name", args.embed)},
+        "machine": {"platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count()},
+        "runs": [run_size(size, args, embed) for size in args.sizes]
+    }
+    
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n📄 Results written to {args.output}")
+    return results
+
+# Run with: python RAG_bench.py --sizes 1000 10000 --embed hash
+if __name__ == "__main__":
+    main()
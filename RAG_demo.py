@@ -21,17 +21,14 @@ def main():
     ]
     
     print(f"📥 Adding {len(demo_facts)} personal facts to memory...")
-    success_count = 0  # Track how many facts were successfully stored
-    
-    # Store each fact one by one
     for i, fact in enumerate(demo_facts, 1):
         print(f"  {i:2d}. Storing: {fact}")
-        # Add the fact with metadata tags
-        if mem.add_fact(fact, {"category": "personal", "demo": True}):
-            success_count += 1
-        time.sleep(0.5)  # Pause for visual effect in demo
     
-    print(f"\n✅ Successfully stored {success_count}/{len(demo_facts)} memories")
+    # Store all the facts in one batch with the same metadata tags
+    result = mem.add_facts(demo_facts, {"category": "personal", "demo": True})
+    success_count = result["added"] + result["refreshed"]  # New memories, plus ones already remembered from a previous run
+    
+    print(f"\n✅ Successfully stored {success_count}/{len(demo_facts)} memories, {result['refreshed']} already remembered ({result['docs_per_sec']:.1f} docs/sec)")
     
     # Show current memory statistics
     print(f"\n📊 Memory Status:")
@@ -122,7 +119,7 @@ def main():
     print("=" * 50)
     
     # Count total memories using the proper method
-    total_memories = mem._count_real_docs()
+    total_memories = mem.count()
     print(f"   Total memories stored: {total_memories}")
     
     # Save the current memory state to disk
@@ -1,13 +1,22 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context, g
 from flask_cors import CORS  # Allow cross-origin requests from web browsers
 import os
+import json
+import atexit
+import threading
 import traceback
+import uuid
+from collections import OrderedDict
 from pathlib import Path
 
 # Import the EchoPaw core components
 try:
-    from LLM import generate_reply  # AI text generation
-    from RAG import EchoMemory  # Memory storage and retrieval
+    from LLM import generate_reply, stream_reply, prompt_cache, conversation_window, scheduler  # AI text generation
+    from LLM import is_loaded, preload, startup_report  # Model loading (happens on first use)
+    from LLM import add_metrics_sink  # Per-reply generation telemetry
+    from Metrics import PercentileSink, JsonlSink
+    from RAG import MemoryShards  # Per-user memory storage and retrieval
+    from Cache import ResponseCache  # Reuses replies to repeated small talk
     print("✅ Core modules loaded successfully")
 except ImportError as e:
     print(f"❌ Error importing modules: {e}")
@@ -20,13 +29,78 @@ CORS(app)  # Allow web browsers to access the API
 # Initialize EchoPaw components when server starts
 print("🚀 Initializing EchoPaw web server...")
 try:
-    mem = EchoMemory()  # Create memory system
-    history = []  # Store conversation history
+    # Each user (or browser session) gets its own memory shard; only hot ones stay loaded
+    shards = MemoryShards(root="memory/users", max_open=32, memory_budget_mb=1024)
+    atexit.register(shards.close_all)  # Write open shards to disk on shutdown
     print("✅ Memory system initialized")
+    
+    # Replies to short messages, matched with the memories' embeddings model
+    response_cache = ResponseCache(embed=shards.embed)
+    
+    # Latency percentiles across replies for /status, and optionally every reply's metrics in a file
+    latency = PercentileSink()
+    add_metrics_sink(latency)
+    if os.environ.get("ECHOPAW_METRICS_LOG"):
+        add_metrics_sink(JsonlSink(os.environ["ECHOPAW_METRICS_LOG"]))
 except Exception as e:
     print(f"❌ Memory initialization failed: {e}")
     exit(1)  # Stop if memory system fails
 
+# Conversation history per session, least recently active dropped first
+SESSION_COOKIE = "echopaw_session"
+MAX_SESSIONS = 1000
+histories = OrderedDict()
+histories_lock = threading.Lock()
+
+# How EchoPaw should talk - the same every turn, with recalled memories added per turn
+CHAT_SYSTEM = (
+    "You are EchoPaw, a friendly AI companion.\n\n"
+    "Respond naturally and empathetically. Keep responses concise but warm. "
+    "If you remember something specific about the user, reference it naturally."
+)
+
+def current_session() -> str:
+    # Session id from the request body, a header or our cookie - issue a new one if missing.
+    # Worked out once per request, so a new browser gets the same id everywhere.
+    session_id = g.get('session_id')
+    if session_id:
+        return session_id
+    data = request.get_json(silent=True) or {}
+    session_id = data.get('session_id') or request.headers.get('X-Session-Id') or request.cookies.get(SESSION_COOKIE)
+    if not session_id:
+        session_id = uuid.uuid4().hex
+        g.new_session = session_id  # Set as a cookie on the way out
+    g.session_id = session_id
+    return session_id
+
+def memory_namespace() -> str:
+    # Memories belong to a user when the client says who that is, otherwise to the session
+    data = request.get_json(silent=True) or {}
+    return data.get('user_id') or request.headers.get('X-User-Id') or current_session()
+
+# What a tenant with no memory store yet reads as - looking doesn't create one
+EMPTY_MEMORY_STATS = {"total_memories": 0, "current_memories": 0}
+
+def session_history(session_id) -> list:
+    # The conversation so far for this session
+    with histories_lock:
+        history = histories.setdefault(session_id, [])
+        histories.move_to_end(session_id)
+        while len(histories) > MAX_SESSIONS:
+            dropped, _ = histories.popitem(last=False)
+            prompt_cache.drop(dropped)  # Its cached conversation and summary go too
+            conversation_window.drop(dropped)
+            response_cache.set_enabled(dropped, True)
+        return history
+
+@app.after_request
+def remember_session(response):
+    # Hand new browsers their session cookie
+    new_session = g.pop('new_session', None)
+    if new_session:
+        response.set_cookie(SESSION_COOKIE, new_session, httponly=True, samesite='Lax')
+    return response
+
 @app.route('/')
 def index():
     # Serve the main web interface
@@ -46,7 +120,10 @@ def index():
                 <ul>
                     <li>POST /listen - Speech to text</li>
                     <li>POST /chat - Chat with EchoPaw</li>
+                    <li>POST /chat/stream - Chat with the reply streamed as it's written</li>
                     <li>GET /status - Server status</li>
+                    <li>GET /memory - Stored memories, paged</li>
+                    <li>GET /memory/export, POST /memory/import - Memory backups</li>
                 </ul>
             </body></html>
             """
@@ -68,7 +145,12 @@ def index():
 def status():
     # Return server status and statistics
     try:
-        stats = mem.get_memory_stats()  # Get memory system stats
+        session_id = current_session()
+        namespace = memory_namespace()
+        stats = EMPTY_MEMORY_STATS
+        if shards.exists(namespace):
+            with shards.use(namespace) as mem:
+                stats = mem.get_memory_stats()  # Get memory system stats
         
         # Check what devices each component is using
         try:
@@ -78,7 +160,7 @@ def status():
             stt_device = "unknown"
         
         try:
-            from LLM import _device
+            from LLM import _device  # Doesn't load the model
             llm_device = _device
         except:
             llm_device = "unknown"
@@ -87,11 +169,17 @@ def status():
         return jsonify({
             'status': 'running',
             'memory_stats': stats,
+            'shards': shards.stats(),  # Loaded memory shards across all users
+            'prompt_cache': prompt_cache.get_stats(),  # Cached conversations for faster replies
+            'response_cache': response_cache.get_stats(),  # Hit rate of reused small-talk replies
+            'llm_batch': scheduler.get_stats(),  # Queue depth and batch occupancy of the shared decoder
+            'llm': {'loaded': is_loaded(), 'startup': startup_report()},  # Model load timings so far
+            'llm_latency': latency.summary(),  # TTFT, prefill and per-token latency percentiles
             'devices': {
                 'stt': stt_device,  # Speech-to-text device
                 'llm': llm_device   # Language model device
             },
-            'conversation_length': len(history)  # How many turns in current chat
+            'conversation_length': len(histories.get(session_id, []))  # How many turns in this session's chat
         })
     
     except Exception as e:
@@ -137,6 +225,89 @@ def listen():
         print(traceback.format_exc())  # Show full error for debugging
         return jsonify({'error': error_msg}), 500
 
+def recall_context(user_message) -> tuple[list, str]:
+    # Remember anything important in the message, then recall memories for the reply:
+    # (memories, context text for the language model)
+    
+    # Words that trigger memory storage (important personal info)
+    memory_triggers = [
+        "sister", "brother", "mother", "father", "family", "parent",  # Family
+        "work", "job", "career", "colleague", "boss", "office",  # Work
+        "hobby", "interest", "like", "love", "enjoy", "favorite",  # Interests
+        "pet", "dog", "cat", "animal", "friend", "live", "home", "son", "daughter"  # Personal
+    ]
+    
+    with shards.use(memory_namespace()) as mem:
+        # Store important information in memory
+        if any(trigger in user_message.lower() for trigger in memory_triggers):
+            mem.add_fact(user_message, {"source": "web_chat", "importance": "high"})
+            print("💾 Added to memory")
+        
+        # Search for relevant memories to provide context
+        memories = mem.recall(user_message, k=3)
+    
+    # Build the AI's context using stored memories
+    if memories:
+        memory_context = "Here's what I remember about you:\n" + "\n".join(f"• {m}" for m in memories)
+        print(f"🧠 Using {len(memories)} memories")
+    else:
+        memory_context = "I don't have any specific memories about you yet."
+        print("🧠 No relevant memories found")
+    return memories, memory_context
+
+def audio_file(session_id) -> Path:
+    # Where a session's reply audio goes - one file per session
+    return Path(f"echopaw_response_{MemoryShards.folder_name(session_id)}.wav")
+
+def speak_reply(session_id, assistant_text) -> str | None:
+    # Generate speech audio for a reply - the URL to play it from, or None
+    try:
+        from TTS import speak
+        audio_path = audio_file(session_id)
+        audio_path.unlink(missing_ok=True)  # So a failed synthesis doesn't leave the last reply's audio
+        
+        # Convert text to speech and save as audio file
+        speak(assistant_text, audio_path)
+        
+        if audio_path.exists():
+            print(f"🔊 TTS audio generated: {audio_path.name}")
+            return f'/audio/{audio_path.name}'  # URL to access the audio
+        print("⚠️ TTS audio file not created")
+    
+    except Exception as tts_error:
+        print(f"⚠️ TTS Error: {tts_error}")
+        # Continue without audio if TTS fails
+    return None
+
+def cached_reply(session_id, user_message, memory_context, history) -> dict | None:
+    # A reused reply to a repeated short message, added to the conversation as if it had
+    # just been generated: {"response", "audio_url"}, or None to generate one.
+    # Clients opt a session out with "cache": false in a chat request (true opts back in).
+    data = request.get_json(silent=True) or {}
+    if isinstance(data.get('cache'), bool):
+        response_cache.set_enabled(session_id, data['cache'])
+    
+    hit = response_cache.lookup(session_id, user_message, memory_context, namespace=memory_namespace())
+    if hit is None:
+        return None
+    print(f"♻️ Reusing a cached reply ({hit['match']} match, similarity {hit['similarity']:.2f})")
+    
+    turn = {"role": "user", "content": user_message, "context": memory_context}
+    history.extend([turn, {"role": "assistant", "content": hit["response"]}])
+    
+    # Its audio too, unless there wasn't any - then it's spoken as usual
+    audio_path = audio_file(session_id)
+    if response_cache.restore_audio(hit, audio_path):
+        audio_url = f'/audio/{audio_path.name}'
+    else:
+        audio_url = speak_reply(session_id, hit["response"])
+    return {"response": hit["response"], "audio_url": audio_url}
+
+def cache_reply(session_id, user_message, memory_context, assistant_text, audio_url):
+    # Keep a generated reply and its audio for the next time someone says the same
+    audio_path = audio_file(session_id) if audio_url else None
+    response_cache.store(session_id, user_message, memory_context, assistant_text, audio_path, namespace=memory_namespace())
+
 @app.route('/chat', methods=['POST'])
 def chat():
     # Handle chat requests with EchoPaw AI
@@ -152,76 +323,49 @@ def chat():
         
         print(f"👤 User: {user_message}")
         
-        # Words that trigger memory storage (important personal info)
-        memory_triggers = [
-            "sister", "brother", "mother", "father", "family", "parent",  # Family
-            "work", "job", "career", "colleague", "boss", "office",  # Work
-            "hobby", "interest", "like", "love", "enjoy", "favorite",  # Interests
-            "pet", "dog", "cat", "animal", "friend", "live", "home", "son", "daughter"  # Personal
-        ]
+        session_id = current_session()
+        history = session_history(session_id)
+        memories, memory_context = recall_context(user_message)
         
-        # Store important information in memory
-        if any(trigger in user_message.lower() for trigger in memory_triggers):
-            mem.add_fact(user_message, {"source": "web_chat", "importance": "high"})
-            print("💾 Added to memory")
-        
-        # Search for relevant memories to provide context
-        memories = mem.recall(user_message, k=3)
-        
-        # Build the AI's context using stored memories
-        if memories:
-            memory_context = "Here's what I remember about you:\n" + "\n".join(f"• {m}" for m in memories)
-            print(f"🧠 Using {len(memories)} memories")
-        else:
-            memory_context = "I don't have any specific memories about you yet."
-            print("🧠 No relevant memories found")
-        
-        # Create the system prompt with memory context
-        system_prefix = (
-            f"You are EchoPaw, a friendly AI companion. {memory_context}\n\n"
-            "Respond naturally and empathetically. Keep responses concise but warm. "
-            "If you remember something specific about the user, reference it naturally."
-        )
+        # Small talk we've answered recently skips the language model and TTS
+        cached = cached_reply(session_id, user_message, memory_context, history)
+        if cached is not None:
+            print(f"🐾 EchoPaw: {cached['response']}")
+            return jsonify({
+                'response': cached['response'],
+                'audio_url': cached['audio_url'],
+                'memories_used': len(memories),
+                'cached': True,  # Reused rather than generated
+                'success': True
+            })
         
-        # Generate AI response using the language model
-        global history
-        assistant_text, history = generate_reply(
+        # Generate AI response using the language model. The memories go with this turn
+        # rather than in the system prompt, so the session's cached conversation stays valid.
+        assistant_text, history, metrics = generate_reply(
             user_message,
             history,
-            system_prompt=system_prefix,
-            max_new_tokens=150  # Keep responses reasonably short
+            system_prompt=CHAT_SYSTEM,
+            max_new_tokens=150,  # Keep responses reasonably short
+            session_id=session_id,
+            context=memory_context
         )
         
         print(f"🐾 EchoPaw: {assistant_text}")
         
         # Generate speech audio from the text response
-        audio_url = None
-        try:
-            from TTS import speak
-            audio_filename = "echopaw_response.wav"
-            audio_path = Path(audio_filename)
-            
-            # Convert text to speech and save as audio file
-            speak(assistant_text, audio_path)
-            
-            if audio_path.exists():
-                audio_url = f'/audio/{audio_filename}'  # URL to access the audio
-                print(f"🔊 TTS audio generated: {audio_filename}")
-            else:
-                print("⚠️ TTS audio file not created")
-        
-        except Exception as tts_error:
-            print(f"⚠️ TTS Error: {tts_error}")
-            # Continue without audio if TTS fails
-        
-        # Save memory state to disk
-        mem.flush()
+        audio_url = speak_reply(session_id, assistant_text)
+        cache_reply(session_id, user_message, memory_context, assistant_text, audio_url)
+
+        # No flush here - the persistence thread writes the new memory to memories.db
+        # within a fraction of a second (until then it's only in RAM), and the background
+        # compactor folds it into the snapshot
         
         # Return the response to the web interface
         return jsonify({
             'response': assistant_text,  # The AI's text response
             'audio_url': audio_url,  # URL to the speech audio (if available)
             'memories_used': len(memories),  # How many memories were used for context
+            'cached': False,
             'success': True
         })
     
@@ -231,6 +375,78 @@ def chat():
         print(traceback.format_exc())  # Show full error for debugging
         return jsonify({'error': error_msg}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    # Same as /chat, but the reply comes as Server-Sent Events while it's generated:
+    # "data: {"token": ...}" for each new piece of text, then an "event: done" with the
+    # full response and audio URL
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'No JSON data provided'}), 400
+        
+        user_message = data.get('message', '').strip()
+        if not user_message:
+            return jsonify({'error': 'No message provided'}), 400
+        
+        print(f"👤 User: {user_message}")
+        
+        session_id = current_session()
+        history = session_history(session_id)
+        memories, memory_context = recall_context(user_message)
+        cached = cached_reply(session_id, user_message, memory_context, history)
+    
+    except Exception as e:
+        error_msg = f"Chat processing error: {str(e)}"
+        print(f"❌ {error_msg}")
+        print(traceback.format_exc())  # Show full error for debugging
+        return jsonify({'error': error_msg}), 500
+    
+    def events():
+        if cached is not None:
+            # A reused reply arrives in one piece
+            print(f"🐾 EchoPaw: {cached['response']}")
+            yield f"data: {json.dumps({'token': cached['response']})}\n\n"
+            done = {**cached, 'memories_used': len(memories), 'time_to_first_token': 0.0, 'cached': True, 'success': True}
+            yield f"event: done\ndata: {json.dumps(done)}\n\n"
+            return
+        
+        reply = stream_reply(
+            user_message,
+            history,
+            system_prompt=CHAT_SYSTEM,
+            max_new_tokens=150,  # Keep responses reasonably short
+            session_id=session_id,
+            context=memory_context
+        )
+        # A client that disconnects closes this generator, which closes the reply and
+        # stops its generation
+        try:
+            for event in reply:
+                if not event.get("done"):
+                    yield f"data: {json.dumps({'token': event['token']})}\n\n"
+                    continue
+                
+                assistant_text = event["response"]
+                print(f"🐾 EchoPaw: {assistant_text}")
+                audio_url = speak_reply(session_id, assistant_text)  # Speech audio (if available)
+                cache_reply(session_id, user_message, memory_context, assistant_text, audio_url)
+                done = {
+                    'response': assistant_text,  # The AI's text response
+                    'audio_url': audio_url,
+                    'memories_used': len(memories),  # How many memories were used for context
+                    'time_to_first_token': event["metrics"].get("time_to_first_token"),
+                    'cached': False,
+                    'success': True
+                }
+                yield f"event: done\ndata: {json.dumps(done)}\n\n"
+        finally:
+            reply.close()
+    
+    # No buffering on the way out, so each token reaches the browser straight away
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/audio/<filename>')
 def serve_audio(filename):
     # Serve audio files to the web interface
@@ -254,20 +470,65 @@ def serve_audio(filename):
 
 @app.route('/memory')
 def memory_info():
-    # Return information about stored memories
+    # Return information about stored memories, a page at a time:
+    # /memory?limit=20&cursor=<next_cursor from the previous page>&order=newest|oldest
     try:
-        stats = mem.get_memory_stats()  # Get memory statistics
-        all_memories = mem.get_all_memories()  # Get all stored memories
+        limit = request.args.get('limit', 20, type=int)
+        cursor = request.args.get('cursor', type=int)
+        newest_first = request.args.get('order', 'newest') != 'oldest'
+        
+        namespace = memory_namespace()
+        if not shards.exists(namespace):
+            return jsonify({'stats': EMPTY_MEMORY_STATS, 'total_memories': 0, 'recent_memories': [],
+                            'memories': [], 'next_cursor': None})
         
+        with shards.use(namespace) as mem:
+            stats = mem.get_memory_stats()  # Get memory statistics
+            page = mem.page_memories(cursor, limit, newest_first)  # Just this page, however big the store
+            recent = mem.recent_memories(5)  # Last 5 memories
+
         return jsonify({
             'stats': stats,
-            'total_memories': len(all_memories),
-            'recent_memories': all_memories[-5:] if all_memories else []  # Last 5 memories
+            'total_memories': stats['current_memories'],
+            'recent_memories': recent,
+            'memories': page['memories'],
+            'next_cursor': page['next_cursor']  # None on the last page
         })
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/memory/export')
+def memory_export():
+    # Download every memory as JSON lines (a backup), streamed so big stores never sit in RAM
+    namespace = memory_namespace()
+    include_vectors = request.args.get('vectors', '0') == '1'
+    
+    def lines():
+        if not shards.exists(namespace):
+            return  # Nothing stored - an empty backup
+        with shards.use(namespace) as mem:
+            yield from mem.export_lines(include_vectors)
+    
+    return Response(
+        stream_with_context(lines()),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename=echopaw-memories-{MemoryShards.folder_name(namespace)}.jsonl'}
+    )
+
+@app.route('/memory/import', methods=['POST'])
+def memory_import():
+    # Restore memories from an export (the JSONL file as the request body), read line by line
+    try:
+        with shards.use(memory_namespace()) as mem:
+            result = mem.import_jsonl(request.stream)
+        if 'error' in result:
+            return jsonify(result), 400
+        return jsonify(result)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # Only run the server if this file is executed directly
 if __name__ == '__main__':
     print("\n" + "="*50)
@@ -280,10 +541,16 @@ if __name__ == '__main__':
         from LLM import _device
         print(f"🔧 STT Device: {get_optimal_device()}")
         print(f"🔧 LLM Device: {_device}")
-        print(f"🧠 Memory: {len(mem.vstore.docstore)} stored memories")
+        print(f"🧠 Memory: per-user shards under {shards.root}")
     except Exception as e:
         print(f"⚠️ System check warning: {e}")
     
+    # Load the language model in the background, so the server is up straight away and the
+    # first chat only waits for whatever is left. With the debug reloader only the process
+    # that serves requests loads it.
+    if os.environ.get("ECHOPAW_LLM_PRELOAD", "1") != "0" and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        preload()
+    
     # Show connection information
     print("\n📡 Server will be available at:")
     print("   http://localhost:5000")